@@ -0,0 +1,129 @@
+"""
+Benchmark of the algorithms a MatchPolicy chooses between, to check its
+thresholds (see the MatchPolicy docs).
+
+Run it from the root of the repository, after building the extensions
+with python setup.py build_ext --inplace:
+
+    PYTHONPATH=. python benchmarks/match_policy.py
+
+PYTHONPATH is not needed when scrapely is installed, with pip install -e .
+
+Each algorithm is forced by a policy whose thresholds always select it and
+runs the longest unique match of patterns of several lengths in ranges of
+several sizes, through a TokenIndex of the sequence. The default column is
+the default policy, followed by the algorithm it picked most often. Times
+are in microseconds per search, the best of several runs.
+
+The patterns are runs of tokens taken from the sequence, as the prefixes and
+suffixes of the extraction trees come from similar pages. In the sample
+pages the first token of a pattern is usually rare, in the table rows it
+starts every row of 16 tokens and in the list items every 4 tokens. The
+altered patterns end with a token missing from the sequence, so no match is
+complete: in the rows and items, where most occurrences of the first token
+then start a match almost as long as the pattern, this is the worst case of
+the naive search.
+"""
+import collections
+import glob
+import itertools
+import random
+import timeit
+from os import path
+
+import numpy as np
+
+from scrapely.htmlpage import HtmlPage
+from scrapely.extraction.pageobjects import TokenDict
+from scrapely.extraction.pageparsing import parse_extraction_page
+from scrapely.extraction.similarity import (
+    MatchPolicy, set_match_policy, TokenIndex)
+
+SAMPLES = path.join(path.dirname(__file__), '..', 'tests', 'samples')
+ROW = u'<tr><td><a href="#">name</a></td><td><b>price</b></td></tr>'
+ITEM = u'<li><b>item</b></li>'
+# larger than any range, small enough not to overflow when multiplied
+NEVER = 2 ** 31
+POLICIES = [
+    ('naive', MatchPolicy(kmp_pattern_length=NEVER, index_range_length=NEVER)),
+    # KMP whenever the first item of the pattern is in the range
+    ('kmp', MatchPolicy(kmp_pattern_length=1, kmp_spacing=NEVER,
+                        index_range_length=NEVER)),
+    ('index', MatchPolicy(kmp_pattern_length=NEVER, index_range_length=0)),
+    ('default', MatchPolicy()),
+]
+
+
+def page_tokens(token_dict, body):
+    return parse_extraction_page(token_dict, HtmlPage(body=body)).page_tokens
+
+
+def best_time(function, number=5):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def searches(tokens, pattern_length, range_length, altered, rng, count=10):
+    """(pattern, range_start, range_end) of count random searches"""
+    result = []
+    for _ in range(count):
+        index = rng.randint(0, len(tokens) - pattern_length)
+        pattern = tokens[index:index + pattern_length].copy()
+        if altered:
+            pattern[-1] = tokens.max() + 1
+        start = rng.randint(0, len(tokens) - range_length)
+        result.append((pattern, start, start + range_length))
+    return result
+
+
+def policy_times(index, cases):
+    """Time per search of each policy, and the algorithm the default one
+    chooses most often
+    """
+    times = []
+    for _, policy in POLICIES:
+        set_match_policy(policy)
+        times.append(best_time(lambda: [
+            index.longest_unique_subsequence(*case) for case in cases]) /
+            len(cases))
+    default = POLICIES[-1][1]
+    chosen = collections.Counter(
+        default.choose(index.sequence, pattern, start, end, index)
+        for pattern, start, end in cases)
+    return times, chosen.most_common(1)[0][0]
+
+
+def main():
+    token_dict = TokenDict()
+    samples = [page_tokens(token_dict, open(f, 'rb').read().decode('latin-1'))
+               for f in sorted(glob.glob(path.join(SAMPLES, '*.html')))]
+    sequences = [
+        ('sample pages', np.concatenate(samples * 4)),
+        ('table rows', page_tokens(token_dict, u'<table>%s</table>' % (
+            ROW * 2000))),
+        ('list items', page_tokens(token_dict, u'<ul>%s</ul>' % (
+            ITEM * 8000))),
+    ]
+    rng = random.Random(0)
+    print('%-13s %-7s %7s %6s %9s %9s %9s %9s' % (
+        'sequence', 'pattern', 'length', 'range', 'naive', 'kmp', 'index',
+        'default'))
+    try:
+        for name, tokens in sequences:
+            index = TokenIndex(tokens)
+            # build the occurrences and suffix array before timing
+            index.longest_unique_subsequence(tokens[:1], 0, len(tokens))
+            for altered, pattern_length, range_length in itertools.product(
+                    (False, True), (4, 16, 64), (1024, 8192, 24576)):
+                range_length = min(range_length, len(tokens))
+                cases = searches(tokens, pattern_length, range_length,
+                                 altered, rng)
+                times, chosen = policy_times(index, cases)
+                print('%-13s %-7s %7d %6d %9.1f %9.1f %9.1f %9.1f %s' % (
+                    (name, 'altered' if altered else 'run', pattern_length,
+                     range_length) + tuple(times) + (chosen,)))
+    finally:
+        set_match_policy(MatchPolicy())
+
+
+if __name__ == '__main__':
+    main()
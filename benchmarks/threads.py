@@ -0,0 +1,80 @@
+"""
+Benchmark of parsing pages and matching tokens from several threads, which
+the compiled extensions do without holding the GIL.
+
+Run it from the root of the repository, after building the extensions
+with python setup.py build_ext --inplace:
+
+    PYTHONPATH=. python benchmarks/threads.py
+
+PYTHONPATH is not needed when scrapely is installed, with pip install -e .
+
+The same total work is split among 1, 2, 4... worker threads of a
+concurrent.futures.ThreadPoolExecutor (on python 2 this needs the futures
+package), up to twice the number of CPUs. The speedup over one thread is
+bounded by the number of CPUs; with the pure Python fallbacks there is
+none.
+"""
+from __future__ import division
+
+import glob
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import numpy as np
+
+from scrapely.htmlpage import parse_html
+from scrapely.extraction.similarity import longest_unique_subsequence
+
+SAMPLES = path.join(path.dirname(__file__), '..', 'tests', 'samples')
+
+
+def parse_pages(bodies):
+    for body in bodies:
+        parse_html(body)
+
+
+def match_tokens(sequence, pattern, count):
+    for _ in range(count):
+        longest_unique_subsequence(sequence, pattern)
+
+
+def run(tasks, workers):
+    """Seconds taken to run tasks, callables, with workers threads"""
+    with ThreadPoolExecutor(workers) as executor:
+        start = time.time()
+        for future in [executor.submit(task) for task in tasks]:
+            future.result()
+        return time.time() - start
+
+
+def main():
+    cpus = multiprocessing.cpu_count()
+    bodies = [open(f, 'rb').read().decode('latin-1')
+              for f in sorted(glob.glob(path.join(SAMPLES, '*.html')))]
+    # a periodic sequence and a pattern matching almost every period, the
+    # slowest case of the naive search
+    sequence = np.tile(np.arange(4), 50000)
+    pattern = np.concatenate([np.tile(np.arange(4), 8), [4]])
+    tasks = 16
+    work = [
+        ('parse', lambda: parse_pages(bodies * 2)),
+        ('match', lambda: match_tokens(sequence, pattern, 4)),
+    ]
+    print('%d cpus, %d tasks' % (cpus, tasks))
+    print('%-6s %8s %10s %8s' % ('work', 'threads', 'seconds', 'speedup'))
+    for name, task in work:
+        single = None
+        workers = 1
+        while workers <= max(2 * cpus, 2):
+            seconds = min(run([task] * tasks, workers) for _ in range(3))
+            single = single or seconds
+            print('%-6s %8d %10.3f %8.2f' % (name, workers, seconds,
+                                             single / seconds))
+            workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark of the searches in tokens encoded as text (TokenText) against the
+ones in the arrays of tokens.
+
+Run it from the root of the repository, after building the extensions
+with python setup.py build_ext --inplace:
+
+    PYTHONPATH=. python benchmarks/token_text.py
+
+PYTHONPATH is not needed when scrapely is installed, with pip install -e .
+
+Times are in microseconds per search, the best of several runs. The arrays
+are searched with the compiled matching functions when they are available,
+otherwise with the pure Python ones.
+"""
+import glob
+import random
+import timeit
+from os import path
+
+import numpy as np
+
+from scrapely.htmlpage import HtmlPage
+from scrapely.extraction.pageobjects import TokenDict
+from scrapely.extraction.pageparsing import parse_extraction_page
+from scrapely.extraction.similarity import (
+    longest_unique_subsequence, MatchPolicy, set_match_policy, TokenText)
+
+SAMPLES = path.join(path.dirname(__file__), '..', 'tests', 'samples')
+ROW = u'<tr><td><a href="#">name</a></td><td><b>price</b></td></tr>'
+
+
+def page_tokens(token_dict, body):
+    return parse_extraction_page(token_dict, HtmlPage(body=body)).page_tokens
+
+
+def best_time(function, number=20):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def array_scan(tokens, prefix):
+    """Index of the first exact match of prefix, as RepeatedDataExtractor
+    finds it in the arrays of tokens
+    """
+    for index in range(len(tokens) - len(prefix) + 1):
+        if (tokens[index:index + len(prefix)] == prefix).all():
+            return index
+    return -1
+
+
+def main():
+    token_dict = TokenDict()
+    samples = [page_tokens(token_dict, open(f, 'rb').read().decode('latin-1'))
+               for f in sorted(glob.glob(path.join(SAMPLES, '*.html')))]
+    pages = [
+        ('sample pages', np.concatenate(samples)),
+        ('table rows', page_tokens(token_dict, u'<table>%s</table>' % (
+            ROW * 2000))),
+    ]
+    rng = random.Random(0)
+    print('%-13s %-22s %10s %10s' % ('page', 'search', 'array', 'text'))
+    for name, tokens in pages:
+        text = TokenText(tokens, TokenDict.token_text)
+        for length in (8, 32, 128):
+            patterns = []
+            for _ in range(10):
+                index = rng.randint(length, len(tokens) - 1)
+                patterns.append(tokens[index - length:index][::-1].copy())
+            array_time = best_time(lambda: [
+                longest_unique_subsequence(tokens[::-1], pattern)
+                for pattern in patterns]) / len(patterns)
+            # search the text even if the compiled functions are available
+            set_match_policy(MatchPolicy(text_search=True))
+            try:
+                text_time = best_time(lambda: [
+                    text.reverse.longest_unique_subsequence(pattern)
+                    for pattern in patterns]) / len(patterns)
+            finally:
+                set_match_policy(MatchPolicy())
+            print('%-13s %-22s %10.1f %10.1f' % (
+                name, 'longest match of %d' % length, array_time, text_time))
+        prefix = tokens[len(tokens) - 8:]
+        array_time = best_time(lambda: array_scan(tokens, prefix), 1)
+        text_time = best_time(lambda: text.find(prefix))
+        print('%-13s %-22s %10.1f %10.1f' % (
+            name, 'exact match at end', array_time, text_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,20 @@ from w3lib.util import str_to_unicode
 from scrapely.htmlpage import HtmlPage, page_to_dict, url_to_page
 from scrapely.template import TemplateMaker, best_match
 from scrapely.extraction import InstanceBasedLearningExtractor
+from scrapely.extraction.pageobjects import TokenDict
 from scrapely.version import __version__
 
 
 class Scraper(object):
 
-    def __init__(self, templates=None):
-        """Initialize an empty scraper."""
+    def __init__(self, templates=None, token_dict=None):
+        """Initialize an empty scraper.
+
+        Scrapers created with the same TokenDict can scrape pages tokenized
+        once with tokenize().
+        """
         self._templates = templates or []
+        self._token_dict = TokenDict() if token_dict is None else token_dict
         self._ex = None
 
     @classmethod
@@ -20,13 +26,28 @@ class Scraper(object):
         """Initialize a scraper from a file previously stored by tofile()
         method.
         """
-        templates = [HtmlPage(**x) for x in json.load(file)['templates']]
-        return cls(templates)
+        data = json.load(file)
+        templates = [HtmlPage(**x) for x in data['templates']]
+        tokens = data.get('tokens')
+        return cls(templates, TokenDict(tokens) if tokens is not None else None)
 
     def tofile(self, file):
-        """Store the scraper into the given file-like object"""
-        tpls = [page_to_dict(x) for x in self._templates]
-        json.dump({'templates': tpls}, file)
+        """Store the scraper into the given file-like object
+
+        The token dictionary is stored too if it has tokens, so pages
+        tokenized with it can be used by scrapers loaded from the file. The
+        templates are not tokenized to store it, scrape or tokenize a page
+        first to store their tokens.
+        """
+        data = {'templates': [page_to_dict(x) for x in self._templates]}
+        if self._token_dict.token_ids:
+            data['tokens'] = self._token_dict.tokens()
+        json.dump(data, file)
+
+    @property
+    def token_dict(self):
+        """The TokenDict the scraper tokenizes pages with"""
+        return self._token_dict
 
     def add_template(self, template):
         self._templates.append(template)
@@ -53,7 +74,20 @@ class Scraper(object):
         return self.scrape_page(page)
 
     def scrape_page(self, page):
+        """Extract data from an HtmlPage, or an ExtractionPage returned by
+        tokenize() of this scraper or another sharing its token_dict.
+        """
+        return self._get_extractor().extract(page)[0]
+
+    def tokenize(self, page):
+        """Tokenize an HtmlPage, the result can be passed to scrape_page()
+        of every scraper created with the same token_dict
+        """
+        return self._get_extractor().tokenize(page)
+
+    def _get_extractor(self):
         if self._ex is None:
-            self._ex = InstanceBasedLearningExtractor((t, None) for t in
-                    self._templates)
-        return self._ex.extract(page)[0]
+            self._ex = InstanceBasedLearningExtractor(
+                ((t, None) for t in self._templates),
+                token_dict=self._token_dict)
+        return self._ex
@@ -1,8 +1,17 @@
+cimport cython
 from cpython.version cimport PY_MAJOR_VERSION
-import re
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy
+from libc.stdint cimport uint8_t, uint16_t
+import sys
+import numpy as np
+cimport numpy as np
 
-_ATTR = "((?:[^=/<>\s]|/(?!>))+)(?:\s*=(?:\s*\"(.*?)\"|\s*'(.*?)'|([^>\s]+))?)?"
-_ATTR_REGEXP = re.compile(_ATTR, re.I | re.DOTALL)
+cdef extern from "Python.h" nogil:
+    bint Py_UNICODE_ISSPACE(Py_UCS4 ch)
+    Py_UCS4 Py_UNICODE_TOLOWER(Py_UCS4 ch)
+
+np.import_array()
 
 class HtmlTagType(object):
     OPEN_TAG = 1
@@ -10,6 +19,12 @@ class HtmlTagType(object):
     UNPAIRED_TAG = 3
 
 
+class HtmlFragmentKind(object):
+    DATA = 0
+    TEXT = 1
+    TAG = 2
+
+
 class HtmlDataFragment(object):
     __slots__ = ('start', 'end', 'is_text_content')
 
@@ -42,13 +57,7 @@ class HtmlTag(HtmlDataFragment):
     @property
     def attributes(self):
         if not self._attributes and self._attr_text:
-            for attr_match in _ATTR_REGEXP.findall(self._attr_text):
-                name = attr_match[0].lower()
-                values = [v for v in attr_match[1:] if v]
-                # According to HTML spec if attribute name is repeated only the
-                # first one is taken into account
-                if name not in self._attributes:
-                    self._attributes[name] = values[0] if values else None
+            self._attributes = _tag_attributes(self._attr_text)
         return self._attributes
 
     def __str__(self):
@@ -59,6 +68,113 @@ class HtmlTag(HtmlDataFragment):
         return str(self)
 
 
+class FrozenAttributes(dict):
+    """Read only attributes shared by the tags with the same attribute text"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("shared tag attributes can't be modified")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenAttributes, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+cdef dict _attributes_cache = {}
+cdef Py_ssize_t _attributes_cache_size = 0
+
+
+def set_attributes_cache(Py_ssize_t maxsize):
+    """Share the attributes of tags with identical attribute text
+
+    The attributes of up to `maxsize` distinct attribute texts are kept, the
+    cache is emptied when it is full. Tags then return the same read only
+    FrozenAttributes mapping. A `maxsize` of 0, the default, disables it.
+    """
+    global _attributes_cache_size
+    _attributes_cache.clear()
+    _attributes_cache_size = maxsize
+
+
+cdef _tag_attributes(attr_text):
+    if _attributes_cache_size <= 0:
+        return parse_attributes(attr_text)
+    attributes = _attributes_cache.get(attr_text)
+    if attributes is None:
+        if len(_attributes_cache) >= _attributes_cache_size:
+            _attributes_cache.clear()
+        attributes = FrozenAttributes(parse_attributes(attr_text))
+        _attributes_cache[attr_text] = attributes
+    return attributes
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef dict parse_attributes(attr_text):
+    """Parse the attribute text of a tag into a dict
+
+    Names are lowercased and, according to the HTML spec, only the first of
+    repeated attributes is taken into account. Attributes without a value, or
+    with an empty one, are None.
+    """
+    cdef unicode text = _ustring(attr_text)
+    cdef dict attributes = {}
+    cdef Py_ssize_t length = len(text)
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t start, j, k
+    cdef Py_UCS4 c, quote
+    while i < length:
+        # name: anything but '=', '<', '>', whitespace or the '/' of '/>'
+        start = i
+        while i < length:
+            c = text[i]
+            if (c == u'=' or c == u'<' or c == u'>' or c.isspace() or
+                    c == u'/' and i + 1 < length and text[i + 1] == u'>'):
+                break
+            i += 1
+        if i == start:
+            i += 1
+            continue
+        name = text[start:i].lower()
+        value = None
+        j = i
+        while j < length and text[j].isspace():
+            j += 1
+        if j < length and text[j] == u'=':
+            j += 1
+            i = j
+            # quoted value, if the quote is closed
+            k = j
+            while k < length and text[k].isspace():
+                k += 1
+            if k < length and (text[k] == u'"' or text[k] == u"'"):
+                quote = text[k]
+                start = k + 1
+                k = start
+                while k < length and text[k] != quote:
+                    k += 1
+                if k < length:
+                    value = text[start:k]
+                    i = k + 1
+            if i == j:
+                # unquoted value, starting right after '='
+                k = j
+                while k < length and text[k] != u'>' and not text[k].isspace():
+                    k += 1
+                value = text[j:k]
+                i = k
+        if name not in attributes:
+            attributes[name] = value or None
+    return attributes
+
+
 cdef class CommentParser:
     cdef int start
     cdef int end
@@ -71,13 +187,13 @@ cdef class CommentParser:
         self.end = -1
         self.reset()
 
-    cdef void reset(self):
+    cdef void reset(self) nogil:
         self.open_state = 1
         self.close_state = 1
         self.open_count = 0
         self.close_count = 0
 
-    cdef int parse(self, Py_UCS4 c, int i):
+    cdef int parse(self, Py_UCS4 c, int i) nogil:
         if ((self.open_state == 1 and c == u'<') or
             (self.open_state == 2 and c == u'!') or
             (self.open_state == 3 and c == u'-') or
@@ -88,7 +204,8 @@ cdef class CommentParser:
             if self.open_state == 3 and c == u'>':
                 self.inside_comment = False
                 self.reset()
-                self.start, self.end = i - 2, i
+                self.start = i - 2
+                self.end = i
                 return True
             self.open_state = 1
         if self.open_state == 5:
@@ -141,17 +258,17 @@ cdef class ScriptParser:
         self.end = -1
         self.state = 1
 
-    cdef int parse(self, Py_UCS4 c, int i):
+    cdef int parse(self, Py_UCS4 c, int i) nogil:
         if self.state == 10:
             self.state = 1
         if ((self.state == 1 and c == u'<') or
             (self.state == 2 and c == u'/') or
-            (self.state == 3 and c in u'sS') or
-            (self.state == 4 and c in u'cC') or
-            (self.state == 5 and c in u'rR') or
-            (self.state == 6 and c in u'iI') or
-            (self.state == 7 and c in u'pP') or
-            (self.state == 8 and c in u'tT') or
+            (self.state == 3 and (c == u's' or c == u'S')) or
+            (self.state == 4 and (c == u'c' or c == u'C')) or
+            (self.state == 5 and (c == u'r' or c == u'R')) or
+            (self.state == 6 and (c == u'i' or c == u'I')) or
+            (self.state == 7 and (c == u'p' or c == u'P')) or
+            (self.state == 8 and (c == u't' or c == u'T')) or
             (self.state == 9 and c == u'>')):
             self.state += 1
         else:
@@ -165,6 +282,63 @@ cdef class ScriptParser:
         return self.state == 10
 
 
+cdef unicode _decode_raw(unicode s, encoding):
+    """Decode text holding the raw bytes of `encoding` one per character"""
+    cdef Py_UCS4 c
+    for c in s:
+        if c >= 128:
+            return s.encode('latin-1').decode(encoding, 'replace')
+    return s
+
+
+cdef unicode _lower(unicode s):
+    """s with each character lowered on its own, like the tag names of text"""
+    cdef Py_UCS4 c
+    for c in s:
+        if c >= 128:
+            return u''.join([Py_UNICODE_TOLOWER(c) for c in s])
+    return s.lower()
+
+
+cdef list _space_chars = None
+cdef dict _raw_spaces_cache = {}
+
+
+cdef bytes _raw_spaces(encoding):
+    """The byte sequences of `encoding` standing for whitespace outside ASCII,
+    as records of 4 bytes: the length of the sequence, up to 3, followed by
+    its bytes
+    """
+    global _space_chars
+    cdef Py_UCS4 c
+    records = _raw_spaces_cache.get(encoding)
+    if records is not None:
+        return records
+    if _space_chars is None:
+        # all the whitespace characters are in the BMP
+        _space_chars = [c for c in range(128, 0x10000)
+                        if Py_UNICODE_ISSPACE(c)]
+    sequences = set()
+    # encoded after another character, so that no byte order mark is added
+    prefix = u'a'.encode(encoding)
+    for char in _space_chars:
+        try:
+            data = (u'a' + char).encode(encoding)
+        except UnicodeError:
+            continue
+        if data.startswith(prefix):
+            sequences.add(data[len(prefix):])
+    for x in range(128, 256):
+        data = bytes(bytearray([x]))
+        char = data.decode(encoding, 'replace')
+        if len(char) == 1 and Py_UNICODE_ISSPACE(char):
+            sequences.add(data)
+    records = b''.join(bytes(bytearray([len(data)])) + data.ljust(3, b'\0')
+                       for data in sorted(sequences) if 0 < len(data) <= 3)
+    _raw_spaces_cache[encoding] = records
+    return records
+
+
 # directly copied from cython's docs
 cdef unicode _ustring(s):
     if type(s) is unicode:
@@ -182,137 +356,848 @@ cdef unicode _ustring(s):
         raise TypeError('unicode or str expected')
 
 
-cpdef parse_html(s):
-    cdef int OPEN_TAG = HtmlTagType.OPEN_TAG
-    cdef int CLOSE_TAG = HtmlTagType.CLOSE_TAG
-    cdef int UNPAIRED_TAG = HtmlTagType.UNPAIRED_TAG
+# codec and dtype giving the code units of text as native integers, for
+# python 2 where the characters of strings can't be read in place
+if sys.maxunicode > 0xffff:
+    _CODE_UNITS = ('utf-32-le' if sys.byteorder == 'little' else 'utf-32-be',
+                   np.uint32)
+else:
+    _CODE_UNITS = ('utf-16-le' if sys.byteorder == 'little' else 'utf-16-be',
+                   np.uint16)
+_ERRORS = 'surrogatepass' if PY_MAJOR_VERSION >= 3 else 'strict'
+
+
+cdef np.ndarray _code_units(unicode s):
+    """Array of the code units of s"""
+    codec, dtype = _CODE_UNITS
+    return np.frombuffer(s.encode(codec, _ERRORS), dtype=dtype)
+
+
+cdef extern from *:
+    """
+    /* width in bytes of the characters of a string (1, 2 or 4), 0 if they
+       can't be read in place, -1 on error */
+    static int __pyx_text_kind(PyObject *s) {
+    #if PY_MAJOR_VERSION >= 3
+    #if PY_VERSION_HEX < 0x030C0000
+        if (PyUnicode_READY(s) < 0)
+            return -1;
+    #endif
+        return (int)PyUnicode_KIND(s);
+    #else
+        return 0;
+    #endif
+    }
+
+    static const void *__pyx_text_data(PyObject *s) {
+    #if PY_MAJOR_VERSION >= 3
+        return PyUnicode_DATA(s);
+    #else
+        return NULL;
+    #endif
+    }
+    """
+    int _text_kind "__pyx_text_kind" (unicode s) except -1
+    const void *_text_data "__pyx_text_data" (unicode s)
+
+
+# the code units the parser reads: bytes, or the characters of strings
+ctypedef fused text_unit:
+    uint8_t
+    uint16_t
+    Py_UCS4
+
+
+cdef struct CharBuffer:
+    Py_UCS4 *data
+    Py_ssize_t size
+    Py_ssize_t capacity
+    bint failed
+
+
+cdef void _append_chars(CharBuffer *buffer, const text_unit *chars,
+                        Py_ssize_t count) nogil:
+    """Append count chars to buffer, setting its failed flag instead if it
+    cannot grow
+    """
+    cdef Py_ssize_t capacity, x
+    cdef Py_UCS4 *data
+    if buffer.size + count > buffer.capacity:
+        capacity = max(64, buffer.capacity * 2, buffer.size + count)
+        data = <Py_UCS4 *>realloc(buffer.data, capacity * sizeof(Py_UCS4))
+        if data == NULL:
+            buffer.failed = True
+            return
+        buffer.data = data
+        buffer.capacity = capacity
+    if text_unit is Py_UCS4:
+        memcpy(buffer.data + buffer.size, chars, count * sizeof(Py_UCS4))
+    else:
+        for x in range(count):
+            buffer.data[buffer.size + x] = chars[x]
+    buffer.size += count
+
+
+cdef inline void _append_char(CharBuffer *buffer, Py_UCS4 c) nogil:
+    if buffer.size < buffer.capacity:
+        buffer.data[buffer.size] = c
+        buffer.size += 1
+    else:
+        _append_chars(buffer, &c, 1)
+
+
+cdef inline Py_ssize_t _space_length(const text_unit *text, Py_ssize_t j,
+                                     Py_ssize_t length,
+                                     const unsigned char *spaces,
+                                     Py_ssize_t space_count) nogil:
+    """Number of code units of the whitespace character starting at text[j],
+    0 if there is none. spaces are the records of _raw_spaces if text are
+    bytes, NULL otherwise.
+    """
+    cdef Py_UCS4 c = text[j]
+    cdef const unsigned char *record
+    cdef Py_ssize_t x, y
+    if spaces == NULL or c < 128:
+        return Py_UNICODE_ISSPACE(c)
+    for x in range(space_count):
+        record = spaces + 4 * x
+        if j + record[0] <= length:
+            y = 0
+            while y < record[0] and text[j + y] == record[1 + y]:
+                y += 1
+            if y == record[0]:
+                return y
+    return 0
+
+
+cdef Py_ssize_t _partial_space(const uint8_t *text, Py_ssize_t length,
+                               const unsigned char *spaces,
+                               Py_ssize_t space_count) nogil:
+    """Number of bytes at the end of text that start one of the whitespace
+    sequences of spaces without completing it
+    """
+    cdef const unsigned char *record
+    cdef Py_ssize_t x, y, size
+    for size in range(2, 0, -1):
+        if size > length:
+            continue
+        for x in range(space_count):
+            record = spaces + 4 * x
+            if record[0] > size:
+                y = 0
+                while (y < size and
+                       text[length - size + y] == record[1 + y]):
+                    y += 1
+                if y == size:
+                    return size
+    return 0
+
+
+cdef bint _equals(const CharBuffer *buffer, const char *ascii) nogil:
+    cdef Py_ssize_t i
+    for i in range(buffer.size):
+        if ascii[i] == 0 or buffer.data[i] != <Py_UCS4>ascii[i]:
+            return False
+    return ascii[buffer.size] == 0
+
+
+cdef extern from *:
+    """
+    static PyObject *__pyx_ucs4_text(const Py_UCS4 *data, Py_ssize_t size) {
+    #if PY_MAJOR_VERSION >= 3
+        return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, data, size);
+    #else
+        /* native byte order, so that U+FEFF is not taken as a BOM */
+        int order = 1;
+        order = *(char *)&order ? -1 : 1;
+        return PyUnicode_DecodeUTF32((const char *)data, size * 4, NULL,
+                                     &order);
+    #endif
+    }
+    """
+    unicode _buffer_text "__pyx_ucs4_text" (const Py_UCS4 *data,
+                                             Py_ssize_t size)
+
+
+cdef Py_UCS4[6] _SCRIPT = [u's', u'c', u'r', u'i', u'p', u't']
+
+
+cdef enum:
+    DATA = 0
+    TEXT = 1
+    TAG = 2
 
-    cdef unicode text = _ustring(s)
 
-    parsed = []
-    comment_parser = CommentParser()
-    script_parser = ScriptParser()
+cdef struct PendingTag:
+    Py_ssize_t row
+    Py_ssize_t name_size
+    Py_ssize_t attr_size
 
-    cdef int tag_end = -1         # end position of previous tag
-    cdef int tag_start = -1       # start of current tag
-    cdef int script = False       # True if inside script body
-    cdef int open_tag = False     # True if an open tag symbol has been read
-    cdef int quote_single = False # True if unpaired single quote
-    cdef int quote_double = False # True if unpaired double quote
-    cdef int quoted
 
-    cdef int reset_tag = True
+cdef class FragmentColumns:
+    """Growable column buffers for the fragments found by the parser
+
+    Fragments are added without the GIL. The names and attribute texts of
+    tags are kept as characters until flush() makes them strings.
+    """
+    cdef int *starts
+    cdef int *ends
+    cdef unsigned char *kinds
+    cdef signed char *tag_types
+    cdef int *tag_ids
+    cdef Py_ssize_t size
+    cdef Py_ssize_t capacity
+    cdef bint failed
+    # names and attribute texts of the tags added since the last flush
+    cdef PendingTag *pending
+    cdef Py_ssize_t pending_size
+    cdef Py_ssize_t pending_capacity
+    cdef CharBuffer pending_chars
+    cdef dict tag_name_ids
+    cdef list tag_names
+    cdef list attr_texts
+
+    def __cinit__(self):
+        self.size = 0
+        self.capacity = 0
+        self.tag_name_ids = {}
+        self.tag_names = []
+        self.attr_texts = []
+
+    def __dealloc__(self):
+        free(self.starts)
+        free(self.ends)
+        free(self.kinds)
+        free(self.tag_types)
+        free(self.tag_ids)
+        free(self.pending)
+        free(self.pending_chars.data)
+
+    cdef bint _grow(self) nogil:
+        cdef Py_ssize_t capacity = max(64, self.capacity * 2)
+        cdef int *starts = <int *>realloc(self.starts, capacity * sizeof(int))
+        if starts != NULL:
+            self.starts = starts
+        cdef int *ends = <int *>realloc(self.ends, capacity * sizeof(int))
+        if ends != NULL:
+            self.ends = ends
+        cdef unsigned char *kinds = <unsigned char *>realloc(
+            self.kinds, capacity * sizeof(unsigned char))
+        if kinds != NULL:
+            self.kinds = kinds
+        cdef signed char *tag_types = <signed char *>realloc(
+            self.tag_types, capacity * sizeof(signed char))
+        if tag_types != NULL:
+            self.tag_types = tag_types
+        cdef int *tag_ids = <int *>realloc(self.tag_ids, capacity * sizeof(int))
+        if tag_ids != NULL:
+            self.tag_ids = tag_ids
+        if (starts == NULL or ends == NULL or kinds == NULL or
+                tag_types == NULL or tag_ids == NULL):
+            self.failed = True
+            return False
+        self.capacity = capacity
+        return True
+
+    cdef void add_data(self, int start, int end, int is_text_content) nogil:
+        if self.size == self.capacity and not self._grow():
+            return
+        self.starts[self.size] = start
+        self.ends[self.size] = end
+        self.kinds[self.size] = TEXT if is_text_content else DATA
+        self.tag_types[self.size] = 0
+        self.tag_ids[self.size] = -1
+        self.size += 1
+
+    cdef void add_tag(self, int tag_type, const Py_UCS4 *name,
+                      Py_ssize_t name_size, const Py_UCS4 *attr_text,
+                      Py_ssize_t attr_size, int start, int end) nogil:
+        cdef Py_ssize_t capacity
+        cdef PendingTag *pending
+        if self.size == self.capacity and not self._grow():
+            return
+        if self.pending_size == self.pending_capacity:
+            capacity = max(16, self.pending_capacity * 2)
+            pending = <PendingTag *>realloc(self.pending,
+                                            capacity * sizeof(PendingTag))
+            if pending == NULL:
+                self.failed = True
+                return
+            self.pending = pending
+            self.pending_capacity = capacity
+        self.pending[self.pending_size].row = self.size
+        self.pending[self.pending_size].name_size = name_size
+        self.pending[self.pending_size].attr_size = attr_size
+        self.pending_size += 1
+        _append_chars(&self.pending_chars, name, name_size)
+        _append_chars(&self.pending_chars, attr_text, attr_size)
+        self.starts[self.size] = start
+        self.ends[self.size] = end
+        self.kinds[self.size] = TAG
+        self.tag_types[self.size] = tag_type
+        self.tag_ids[self.size] = -1
+        self.size += 1
+
+    cdef void flush(self, encoding) except *:
+        """Set the tag ids and attribute texts of the pending tags, decoding
+        them from `encoding` if given
+        """
+        cdef Py_ssize_t x, row = len(self.attr_texts), offset = 0
+        cdef PendingTag tag
+        cdef const Py_UCS4 *chars = self.pending_chars.data
+        if self.failed or self.pending_chars.failed:
+            raise MemoryError()
+        for x in range(self.pending_size):
+            tag = self.pending[x]
+            while row < tag.row:
+                self.attr_texts.append(None)
+                row += 1
+            tag_name = _buffer_text(chars + offset, tag.name_size)
+            offset += tag.name_size
+            attr_text = _buffer_text(chars + offset, tag.attr_size)
+            offset += tag.attr_size
+            if encoding is not None:
+                tag_name = _lower(_decode_raw(tag_name, encoding))
+                attr_text = _decode_raw(attr_text, encoding)
+            tag_id = self.tag_name_ids.get(tag_name)
+            if tag_id is None:
+                tag_id = self.tag_name_ids[tag_name] = len(self.tag_names)
+                self.tag_names.append(tag_name)
+            self.tag_ids[row] = tag_id
+            self.attr_texts.append(attr_text)
+            row += 1
+        while row < self.size:
+            self.attr_texts.append(None)
+            row += 1
+        self.pending_size = 0
+        self.pending_chars.size = 0
+
+    cdef _to_array(self, void *data, dtype):
+        cdef np.ndarray array = np.empty(self.size, dtype=dtype)
+        if self.size:
+            memcpy(np.PyArray_DATA(array), data, self.size * array.itemsize)
+        return array
+
+    def columns(self):
+        """(starts, ends, kinds, tag_types, tag_ids, tag_names, attr_texts)"""
+        return (self._to_array(self.starts, np.int32),
+                self._to_array(self.ends, np.int32),
+                self._to_array(self.kinds, np.uint8),
+                self._to_array(self.tag_types, np.int8),
+                self._to_array(self.tag_ids, np.int32),
+                list(self.tag_names), list(self.attr_texts))
+
+
+cdef class HtmlParser:
+    """Incremental html parser
+
+    Text is passed in chunks to feed() and the parsing state is kept between
+    calls, so a document can be parsed while it is being received. Fragments
+    are added to the result as soon as they are complete and close() returns
+    the same columns parse_html_columns would return for the whole text.
+
+    If `encoding` is given, feed() takes bytes in that encoding instead, which
+    must be ASCII compatible. The markup is parsed on the bytes, fragment
+    offsets are byte offsets and only tag names and attributes are decoded.
+    The bytes of whitespace characters outside ASCII separate the markup as
+    the characters do, so the fragments are those of the decoded text. Bytes
+    at the end of a chunk that may start such a character are only parsed
+    with the next chunk.
+
+    The text is scanned without holding the GIL, so several threads can parse
+    pages at the same time. The strings of the tag names and attributes are
+    still created with the GIL held, at the end of each feed(), which limits
+    the speedup (see benchmarks/threads.py).
+    """
+    cdef FragmentColumns parsed
+    cdef CommentParser comment_parser
+    cdef ScriptParser script_parser
+
+    cdef int tag_end
+    cdef int tag_start
+    cdef int script
+    cdef int open_tag
+    cdef int quote_single
+    cdef int quote_double
+    cdef int reset_tag
     cdef int slash
     cdef int has_attributes
     cdef int yield_tag
+    cdef CharBuffer tag_name
+    cdef CharBuffer tag_attributes
+    cdef Py_UCS4 prev_char
+    cdef int position
+    cdef readonly object encoding
+    cdef bytes spaces   # see _raw_spaces
+    cdef bytes held     # bytes left for the next feed()
 
-    cdef unicode tag_name
-    cdef unicode tag_attributes
-    cdef Py_UCS4 curr_char
-    cdef Py_UCS4 prev_char = 0 # previous value of curr_char
-    cdef int i = 0
-    for curr_char in text:
-        if reset_tag:
-            reset_tag = False
-            slash = False
-            has_attributes = False
-            tag_name = u''
-            tag_attributes = u''
-            yield_tag = False
-
-        if open_tag or script:
-            if curr_char == u'"' and not quote_single:
-                quote_double = not quote_double
-            if curr_char == u"'" and not quote_double:
-                quote_single = not quote_single
-        else:
-            quote_single = quote_double = False
-        quoted = quote_double or quote_single
-
-        if not quoted:
-            if comment_parser.parse(curr_char, i):
-                if (tag_end + 1) < comment_parser.start:
-                    parsed.append(
-                        HtmlDataFragment(tag_end + 1, comment_parser.start, not script))
-                tag_end = comment_parser.end
-                parsed.append(
-                    HtmlDataFragment(comment_parser.start, tag_end + 1, False))
-                reset_tag = True
-                if (comment_parser.end - comment_parser.start) == 2:
-                    open_tag = False
+    def __init__(self, encoding=None):
+        self.parsed = FragmentColumns()
+        self.comment_parser = CommentParser()
+        self.script_parser = ScriptParser()
+        self.tag_end = -1
+        self.tag_start = -1
+        self.script = False
+        self.open_tag = False
+        self.quote_single = False
+        self.quote_double = False
+        self.reset_tag = True
+        self.prev_char = 0
+        self.position = 0
+        self.encoding = encoding
+        self.spaces = None if encoding is None else _raw_spaces(encoding)
+        self.held = b''
+
+    def __dealloc__(self):
+        free(self.tag_name.data)
+        free(self.tag_attributes.data)
+
+    def __len__(self):
+        """Number of fragments completed so far"""
+        return self.parsed.size
 
-        if comment_parser.inside_comment:
-            open_tag = False
+    def columns(self):
+        """Columns of the fragments completed so far"""
+        return self.parsed.columns()
+
+    def feed(self, s):
+        """Parse the next chunk of text (or bytes if the parser has an
+        encoding), returning the number of fragments completed so far
+        """
+        self._parse(s, False)
+        return self.parsed.size
+
+    cdef _parse(self, s, bint final):
+        cdef int raw = self.encoding is not None
+        cdef const unsigned char[::1] raw_units
+        cdef np.ndarray units
+        cdef const void *text = NULL
+        cdef Py_ssize_t length, held = 0
+        cdef int kind
+        cdef const unsigned char *spaces = NULL
+        cdef Py_ssize_t space_count = 0
+        cdef FragmentColumns parsed = self.parsed
+        cdef CommentParser comment_parser = self.comment_parser
+        cdef ScriptParser script_parser = self.script_parser
+        # the text is read in place, one byte or character at a time
+        if raw:
+            if self.held:
+                s = self.held + bytes(s)
+            raw_units = s
+            length = raw_units.shape[0]
+            spaces = self.spaces
+            space_count = len(self.spaces) // 4
+            if length:
+                text = &raw_units[0]
+                if not final:
+                    held = _partial_space(<const uint8_t *>text, length,
+                                          spaces, space_count)
+            self.held = bytes(s[length - held:]) if held else b''
+            length -= held
+            kind = 1
         else:
-            if script:
-                open_tag = False
-                if script_parser.parse(curr_char, i):
-                    script = False
-                    if (tag_end + 1) < script_parser.start:
-                        parsed.append(
-                            HtmlDataFragment(tag_end + 1, script_parser.start, False))
-                    tag_end = script_parser.end
-                    parsed.append(
-                        HtmlTag(CLOSE_TAG,
-                                u'script', u'', script_parser.start, tag_end + 1))
+            s = _ustring(s)
+            length = len(s)
+            kind = _text_kind(s)
+            if kind:
+                text = _text_data(s)
+            else:
+                units = _code_units(s)
+                length = units.shape[0]
+                text = np.PyArray_DATA(units)
+                kind = units.itemsize
+        with nogil:
+            if kind == 1:
+                self._feed(<const uint8_t *>text, length, spaces, space_count,
+                           parsed, comment_parser, script_parser)
+            elif kind == 2:
+                self._feed(<const uint16_t *>text, length, spaces,
+                           space_count, parsed, comment_parser, script_parser)
+            else:
+                self._feed(<const Py_UCS4 *>text, length, spaces, space_count,
+                           parsed, comment_parser, script_parser)
+        if self.tag_name.failed or self.tag_attributes.failed:
+            raise MemoryError()
+        self.parsed.flush(self.encoding)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _feed(self, const text_unit *text, Py_ssize_t length,
+                    const unsigned char *spaces, Py_ssize_t space_count,
+                    FragmentColumns parsed, CommentParser comment_parser,
+                    ScriptParser script_parser) nogil:
+        # text are bytes if they have the whitespace sequences of spaces
+        cdef int raw = spaces != NULL
+        # the HtmlTagType values
+        cdef int OPEN_TAG = 1
+        cdef int CLOSE_TAG = 2
+        cdef int UNPAIRED_TAG = 3
+
+        cdef int tag_end = self.tag_end         # end position of previous tag
+        cdef int tag_start = self.tag_start     # start of current tag
+        cdef int script = self.script           # True if inside script body
+        cdef int open_tag = self.open_tag       # True if an open tag symbol has been read
+        cdef int quote_single = self.quote_single # True if unpaired single quote
+        cdef int quote_double = self.quote_double # True if unpaired double quote
+        cdef int quoted
+        cdef int tag_type
+        cdef Py_ssize_t space
+
+        cdef int reset_tag = self.reset_tag
+        cdef int slash = self.slash
+        cdef int has_attributes = self.has_attributes
+        cdef int yield_tag = self.yield_tag
+
+        cdef CharBuffer *tag_name = &self.tag_name
+        cdef CharBuffer *tag_attributes = &self.tag_attributes
+        # text[attr_start:attr_end] is still to be added to tag_attributes,
+        # so contiguous attribute text is copied once
+        cdef Py_ssize_t attr_start = 0
+        cdef Py_ssize_t attr_end = 0
+        cdef Py_UCS4 curr_char
+        cdef Py_UCS4 prev_char = self.prev_char # previous value of curr_char
+        cdef Py_UCS4 quote
+        cdef int i = self.position
+        cdef Py_ssize_t j = 0                   # position of curr_char in text
+        cdef Py_ssize_t k, x
+        while j < length:
+            if reset_tag:
+                reset_tag = False
+                slash = False
+                has_attributes = False
+                tag_name.size = 0
+                tag_attributes.size = 0
+                attr_start = attr_end = j
+                yield_tag = False
+
+            # Skip ahead over the characters that can't change the state of
+            # the parser, they only need to be added to the current tag
+            k = j
+            if comment_parser.inside_comment:
+                if (not script and not open_tag and
+                        comment_parser.open_state == 1 and
+                        comment_parser.close_state == 1):
+                    while k < length:
+                        curr_char = text[k]
+                        if curr_char == u'<' or curr_char == u'-':
+                            break
+                        k += 1
+                    if k > j:
+                        quote_single = quote_double = False
+            elif script:
+                if quote_single or quote_double:
+                    quote = u'"' if quote_double else u"'"
+                    while k < length:
+                        curr_char = text[k]
+                        if curr_char == u'<' or curr_char == quote:
+                            break
+                        k += 1
+                elif comment_parser.open_state == 1:
+                    while k < length:
+                        curr_char = text[k]
+                        if (curr_char == u'<' or curr_char == u'"' or
+                                curr_char == u"'"):
+                            break
+                        k += 1
+                if k > j and script_parser.state == 10:
+                    script_parser.state = 1
+                if script_parser.state != 1:
+                    k = j
+                open_tag = open_tag and k == j
             elif open_tag:
-                if quoted:
-                    if has_attributes:
-                        tag_attributes += curr_char
-                elif curr_char == u'<':
-                    tag_end = i - 1
-                    yield_tag = True
-                elif curr_char == u'>':
-                    if prev_char == u'/':
-                        slash = True
-                    tag_end = i
-                    yield_tag = True
+                if quote_single or quote_double:
+                    quote = u'"' if quote_double else u"'"
+                    while k < length and text[k] != quote:
+                        k += 1
+                    if has_attributes and k > j:
+                        if attr_end != j:
+                            if attr_end > attr_start:
+                                _append_chars(tag_attributes, text + attr_start,
+                                              attr_end - attr_start)
+                            attr_start = j
+                        attr_end = k
+                elif comment_parser.open_state == 1:
+                    while k < length:
+                        curr_char = text[k]
+                        if (curr_char == u'<' or curr_char == u'>' or
+                                curr_char == u'/' or curr_char == u'"' or
+                                curr_char == u"'"):
+                            break
+                        if ((not has_attributes or
+                             (k == j and prev_char == u'/')) and
+                                _space_length(text, k, length, spaces,
+                                              space_count)):
+                            break
+                        k += 1
+                    if k > j:
+                        if has_attributes:
+                            if attr_end != j:
+                                if attr_end > attr_start:
+                                    _append_chars(tag_attributes,
+                                                  text + attr_start,
+                                                  attr_end - attr_start)
+                                attr_start = j
+                            attr_end = k
+                        else:
+                            for x in range(j, k):
+                                curr_char = text[x]
+                                _append_char(tag_name, curr_char
+                                             if raw and curr_char >= 128
+                                             else Py_UNICODE_TOLOWER(curr_char))
+            elif comment_parser.open_state == 1:
+                while k < length and <Py_UCS4>text[k] != u'<':
+                    k += 1
+                if k > j:
+                    quote_single = quote_double = False
+            if k > j:
+                i += k - j
+                j = k
+                prev_char = text[j - 1]
+                continue
+
+            curr_char = text[j]
+            if open_tag or script:
+                if curr_char == u'"' and not quote_single:
+                    quote_double = not quote_double
+                if curr_char == u"'" and not quote_double:
+                    quote_single = not quote_single
+            else:
+                quote_single = quote_double = False
+            quoted = quote_double or quote_single
+
+            if not quoted:
+                if comment_parser.parse(curr_char, i):
+                    if (tag_end + 1) < comment_parser.start:
+                        parsed.add_data(tag_end + 1, comment_parser.start, not script)
+                    tag_end = comment_parser.end
+                    parsed.add_data(comment_parser.start, tag_end + 1, False)
+                    reset_tag = True
+                    if (comment_parser.end - comment_parser.start) == 2:
+                        open_tag = False
+
+            if comment_parser.inside_comment:
+                open_tag = False
+            else:
+                if script:
                     open_tag = False
-                elif curr_char == u'/':
-                    if prev_char == u'<':
-                        slash = True
-                elif curr_char.isspace():
-                    if has_attributes:
+                    if script_parser.parse(curr_char, i):
+                        script = False
+                        if (tag_end + 1) < script_parser.start:
+                            parsed.add_data(tag_end + 1, script_parser.start, False)
+                        tag_end = script_parser.end
+                        parsed.add_tag(CLOSE_TAG, _SCRIPT, 6, NULL, 0,
+                                       script_parser.start, tag_end + 1)
+                elif open_tag:
+                    space = 0 if quoted else _space_length(
+                        text, j, length, spaces, space_count)
+                    if quoted:
+                        if has_attributes:
+                            if attr_end != j:
+                                if attr_end > attr_start:
+                                    _append_chars(tag_attributes,
+                                                  text + attr_start,
+                                                  attr_end - attr_start)
+                                attr_start = j
+                            attr_end = j + 1
+                    elif curr_char == u'<':
+                        tag_end = i - 1
+                        yield_tag = True
+                    elif curr_char == u'>':
                         if prev_char == u'/':
-                            # feature, bug? Maintain compatilibity with previous
-                            # implementation
-                            tag_attributes += u'/'
-                        tag_attributes += curr_char
-                    elif tag_name:
-                        has_attributes = True
-                else:
-                    if has_attributes:
-                        tag_attributes += curr_char
-                    else:
-                        tag_name += curr_char.lower()
-                if yield_tag:
-                    if not slash:
-                        tag_type = OPEN_TAG
-                    elif prev_char != u'/':
-                        tag_type = CLOSE_TAG
+                            slash = True
+                        tag_end = i
+                        yield_tag = True
+                        open_tag = False
+                    elif curr_char == u'/':
+                        if prev_char == u'<':
+                            slash = True
+                    elif space:
+                        if has_attributes:
+                            if prev_char == u'/':
+                                # feature, bug? Maintain compatilibity with previous
+                                # implementation
+                                _append_chars(tag_attributes, text + attr_start,
+                                              attr_end - attr_start)
+                                _append_char(tag_attributes, u'/')
+                                attr_start = attr_end = j
+                            if attr_end != j:
+                                if attr_end > attr_start:
+                                    _append_chars(tag_attributes,
+                                                  text + attr_start,
+                                                  attr_end - attr_start)
+                                attr_start = j
+                            attr_end = j + space
+                        elif tag_name.size:
+                            has_attributes = True
+                        # the other bytes of a whitespace character
+                        i += space - 1
+                        j += space - 1
                     else:
-                        tag_type = UNPAIRED_TAG
-                    if tag_name != u'!doctype':
-                        parsed.append(
-                            HtmlTag(tag_type, tag_name,
-                                    tag_attributes, tag_start, tag_end + 1))
-                    if tag_name == u'script':
-                        script = True
-                    if open_tag:
+                        if has_attributes:
+                            if attr_end != j:
+                                if attr_end > attr_start:
+                                    _append_chars(tag_attributes,
+                                                  text + attr_start,
+                                                  attr_end - attr_start)
+                                attr_start = j
+                            attr_end = j + 1
+                        elif raw and curr_char >= 128:
+                            _append_char(tag_name, curr_char)
+                        else:
+                            _append_char(tag_name,
+                                         Py_UNICODE_TOLOWER(curr_char))
+                    if yield_tag:
+                        if attr_end > attr_start:
+                            _append_chars(tag_attributes, text + attr_start,
+                                          attr_end - attr_start)
+                            attr_start = attr_end
+                        if not slash:
+                            tag_type = OPEN_TAG
+                        elif prev_char != u'/':
+                            tag_type = CLOSE_TAG
+                        else:
+                            tag_type = UNPAIRED_TAG
+                        if not _equals(tag_name, b'!doctype'):
+                            parsed.add_tag(tag_type, tag_name.data,
+                                           tag_name.size, tag_attributes.data,
+                                           tag_attributes.size, tag_start,
+                                           tag_end + 1)
+                        if _equals(tag_name, b'script'):
+                            script = True
+                        if open_tag:
+                            tag_start = i
+                        reset_tag = True
+                else:
+                    open_tag = False
+                    if curr_char == u'<' and not quoted:
+                        open_tag = True
                         tag_start = i
-                    reset_tag = True
-            else:
-                open_tag = False
-                if curr_char == u'<' and not quoted:
-                    open_tag = True
-                    tag_start = i
-                    if tag_start > tag_end + 1:
-                        parsed.append(
-                            HtmlDataFragment(tag_end + 1, tag_start, True))
-                    tag_end = tag_start
-        prev_char = curr_char
-        i += 1
-
-    if tag_end + 1 < len(text):
-        parsed.append(HtmlDataFragment(tag_end + 1, len(text), True))
-    return parsed
+                        if tag_start > tag_end + 1:
+                            parsed.add_data(tag_end + 1, tag_start, True)
+                        tag_end = tag_start
+            prev_char = curr_char
+            i += 1
+            j += 1
+
+        if attr_end > attr_start:
+            _append_chars(tag_attributes, text + attr_start,
+                          attr_end - attr_start)
+        self.tag_end = tag_end
+        self.tag_start = tag_start
+        self.script = script
+        self.open_tag = open_tag
+        self.quote_single = quote_single
+        self.quote_double = quote_double
+        self.reset_tag = reset_tag
+        self.slash = slash
+        self.has_attributes = has_attributes
+        self.yield_tag = yield_tag
+        self.prev_char = prev_char
+        self.position = i
+
+    def close(self):
+        """Finish parsing, returning the columns of all the fragments"""
+        if self.held:
+            self._parse(b'', True)
+        if self.tag_end + 1 < self.position:
+            self.parsed.add_data(self.tag_end + 1, self.position, True)
+            self.tag_end = self.position - 1
+            self.parsed.flush(self.encoding)
+        return self.parsed.columns()
+
+
+cpdef parse_html_columns(s, encoding=None):
+    """Parse the html in `s` returning its fragments as parallel columns
+
+    The result is a tuple (starts, ends, kinds, tag_types, tag_ids, tag_names,
+    attr_texts) suitable for building an HtmlParsedBody. If `encoding` is
+    given `s` are bytes in that encoding, see HtmlParser.
+    """
+    cdef HtmlParser parser = HtmlParser(encoding)
+    parser.feed(s)
+    return parser.close()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def pair_tags(tag_types, tag_ids, Py_ssize_t name_count):
+    """Match the open and close tags given by the tag_types and tag_ids
+    columns of a parsed body
+
+    Returns the int32 arrays (matches, depths). matches holds, for each paired
+    tag, the position of the other tag of the pair and -1 for everything
+    else. A close tag is paired with the last unpaired open tag of the same
+    name, unpaired close tags are ignored. depths holds the number of pairs
+    enclosing each fragment.
+    """
+    cdef const signed char[:] types = tag_types
+    cdef const int[:] ids = tag_ids
+    cdef Py_ssize_t size = types.shape[0]
+    cdef np.ndarray[np.int32_t] matches = np.full(size, -1, dtype=np.int32)
+    cdef np.ndarray[np.int32_t] depths = np.empty(size, dtype=np.int32)
+    # last unpaired open tag of each name and the one before each open tag
+    cdef np.ndarray[np.int32_t] last_open = np.full(name_count, -1,
+                                                    dtype=np.int32)
+    cdef np.ndarray[np.int32_t] previous = np.empty(size, dtype=np.int32)
+    cdef int OPEN_TAG = HtmlTagType.OPEN_TAG
+    cdef int CLOSE_TAG = HtmlTagType.CLOSE_TAG
+    cdef Py_ssize_t i
+    cdef int j, tag_id, depth = 0
+    for i in range(size):
+        tag_id = ids[i]
+        if types[i] == OPEN_TAG:
+            previous[i] = last_open[tag_id]
+            last_open[tag_id] = i
+        elif types[i] == CLOSE_TAG:
+            j = last_open[tag_id]
+            if j >= 0:
+                matches[i] = j
+                matches[j] = i
+                last_open[tag_id] = previous[j]
+    for i in range(size):
+        if matches[i] > i:
+            depths[i] = depth
+            depth += 1
+        elif matches[i] >= 0:
+            depth -= 1
+            depths[i] = depth
+        else:
+            depths[i] = depth
+    return matches, depths
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tag_tokens(kinds, tag_types, tag_ids, tag_names, tokenid):
+    """Tokens of the tags given by the columns of a parsed body
+
+    Returns the int32 arrays (tokens, indexes) with the token of each tag and
+    its position in the parsed body. Tokens are created by calling
+    tokenid(tag_name, tag_type) once for each distinct name and type, in the
+    order they first appear.
+    """
+    cdef const unsigned char[:] kind_view = kinds
+    cdef const signed char[:] type_view = tag_types
+    cdef const int[:] id_view = tag_ids
+    cdef Py_ssize_t size = kind_view.shape[0]
+    cdef np.ndarray[np.int32_t] tokens = np.empty(size, dtype=np.int32)
+    cdef np.ndarray[np.int32_t] indexes = np.empty(size, dtype=np.int32)
+    # token of each tag name and type, -1 until it is first seen
+    cdef np.ndarray[np.int32_t, ndim=2] known = np.full(
+        (len(tag_names), 4), -1, dtype=np.int32)
+    cdef Py_ssize_t i, count = 0
+    cdef int tag_id, tag_type
+    cdef np.int32_t token
+    for i in range(size):
+        if kind_view[i] != TAG:
+            continue
+        tag_id = id_view[i]
+        tag_type = type_view[i]
+        token = known[tag_id, tag_type]
+        if token < 0:
+            token = known[tag_id, tag_type] = tokenid(tag_names[tag_id],
+                                                      tag_type)
+        tokens[count] = token
+        indexes[count] = i
+        count += 1
+    return tokens[:count], indexes[:count]
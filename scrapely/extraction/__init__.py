@@ -8,7 +8,8 @@ It defines the InstanceBasedLearningExtractor class, which implements this
 extraction algorithm.
 
 Main departures from the original algorithm:
-    * there is no limit in prefix or suffix size
+    * there is no limit in prefix or suffix size, unless max_context_length
+      is given to bound the extraction time
     * we have "attribute adaptors" that allow generic post processing and may
       affect the extraction process. For example, a price field may require a
       numeric value to be present.
@@ -18,7 +19,7 @@ Main departures from the original algorithm:
 """
 from operator import itemgetter
 from .pageparsing import parse_template, parse_extraction_page
-from .pageobjects import TokenDict
+from .pageobjects import TokenDict, ExtractionPage
 from .regionextract import (BasicTypeExtractor, TraceExtractor, RepeatedDataExtractor,
                             AdjacentVariantExtractor, RecordExtractor, TemplatePageExtractor)
 
@@ -36,7 +37,9 @@ class InstanceBasedLearningExtractor(object):
         RecordExtractor,
     ]
 
-    def __init__(self, td_pairs, trace=False, apply_extrarequired=True):
+    def __init__(self, td_pairs, trace=False, apply_extrarequired=True,
+                 freeze_tokens=False, token_dict=None, index_pages=False,
+                 max_context_length=None, text_pages=False):
         """Initialise this extractor
 
         td_pairs is a list of (template, item descriptor) pairs.
@@ -54,8 +57,46 @@ class InstanceBasedLearningExtractor(object):
 
         if trace is true, the returned extracted data will have a 'trace'
         property that contains a trace of the extraction execution.
+
+        if freeze_tokens is true the token dictionary is frozen once the
+        templates are parsed, so tags of extracted pages that are not in any
+        template are not added to it. This keeps the memory used by long
+        running extractors flat.
+
+        token_dict is the TokenDict used to tokenize pages, a new one by
+        default. Pass a dictionary loaded from a previous run to keep the ids
+        of its tokens, or the dictionary of other extractors to share pages
+        tokenized by tokenize() with them. Tokens of the templates are added
+        to it, so it must not be frozen, ValueError is raised otherwise.
+
+        if index_pages is true the tokens of extracted pages are indexed, see
+        ExtractionPage.index_tokens. This makes extraction faster for large
+        pages and templates with many annotations.
+
+        max_context_length is the number of tokens before and after each
+        annotation first compared with the extracted pages. By default all the
+        template is used. With a limit the time taken to find each region is
+        linear in the page size when the limited context tells the best
+        match apart, and more tokens are compared only while other parts of
+        the page match the whole limited context as well, so regions are
+        found where they would be without the limit. It must be positive,
+        ValueError is raised otherwise.
+
+        if text_pages is true the tokens of extracted pages are also encoded
+        as text, see ExtractionPage.encode_tokens. Repeated data is then found
+        with the string search of Python, which is also used to find the
+        regions similar to the template ones when the compiled matching
+        functions are not available. Pages whose tokens cannot be encoded
+        (see TokenDict.token_text) are extracted without it.
         """
-        self.token_dict = TokenDict()
+        if max_context_length is not None and max_context_length < 1:
+            raise ValueError('max_context_length must be positive, got %r'
+                             % (max_context_length,))
+        if token_dict is not None and token_dict.frozen:
+            raise ValueError('token_dict is frozen, template tokens cannot '
+                             'be added to it')
+        self.max_context_length = max_context_length
+        self.token_dict = TokenDict() if token_dict is None else token_dict
         parsed_plus_tdpairs = [(parse_template(self.token_dict, td[0]), td) for td in td_pairs]
         parsed_plus_epages = (
             (p, parse_extraction_page(self.token_dict, td[0]), td)
@@ -86,11 +127,20 @@ class InstanceBasedLearningExtractor(object):
             (td[0].page_id, td[1].validated if td[1] else self._filter_not_none)
             for _, td in sorted_tdpairs
         )
+        if freeze_tokens:
+            self.token_dict.freeze()
+        self.index_pages = index_pages
+        self.text_pages = text_pages
 
-    def build_extraction_tree(self, template, type_descriptor, trace=True):
+    def build_extraction_tree(self, template, type_descriptor, trace=True,
+                              max_context_length=None):
         """Build a tree of region extractors corresponding to the
         template
+
+        max_context_length defaults to the one of this extractor.
         """
+        if max_context_length is None:
+            max_context_length = self.max_context_length
         attribute_map = type_descriptor.attribute_map if type_descriptor else None
         extractors = BasicTypeExtractor.create(template.annotations, attribute_map)
         if trace:
@@ -100,15 +150,35 @@ class InstanceBasedLearningExtractor(object):
             if trace:
                 extractors = TraceExtractor.apply(template, extractors)
 
-        return TemplatePageExtractor(template, extractors)
+        return TemplatePageExtractor(template, extractors, max_context_length)
 
     def extract(self, html, pref_template_id=None):
         """extract data from an html page
 
         If pref_template_url is specified, the template with that url will be
         used first.
+
+        html may also be an ExtractionPage returned by tokenize(), of this
+        extractor or of one sharing its token_dict, so a page extracted with
+        several extractors is tokenized once.
         """
-        extraction_page = parse_extraction_page(self.token_dict, html)
+        if isinstance(html, ExtractionPage):
+            extraction_page = html
+            token_dict = extraction_page.token_dict
+            if (token_dict is not self.token_dict and
+                    token_dict.version != self.token_dict.version):
+                raise ValueError("page tokenized with another token dictionary")
+        else:
+            extraction_page = self.tokenize(html)
+        if self.index_pages:
+            extraction_page.index_tokens()
+        if self.text_pages:
+            try:
+                extraction_page.encode_tokens()
+            except ValueError:
+                # narrow unicode build or too many tokens, the page tokens
+                # are searched instead
+                pass
         if pref_template_id is not None:
             extraction_trees = sorted(self.extraction_trees,
                     key=lambda x: x.template.id != pref_template_id)
@@ -122,6 +192,15 @@ class InstanceBasedLearningExtractor(object):
                 return correctly_extracted, extraction_tree.template
         return None, None
 
+    def tokenize(self, html, parse_cache=None):
+        """Tokenize an html page with this extractor's token_dict, returning
+        an ExtractionPage that can be passed to extract()
+
+        If a scrapely.parsecache.ParseCache is given the tokens are loaded
+        from it when possible.
+        """
+        return parse_extraction_page(self.token_dict, html, parse_cache)
+
     def __str__(self):
         return "InstanceBasedLearningExtractor[\n%s\n]" % \
                 (',\n'.join(map(str, self.extraction_trees)))
@@ -0,0 +1,166 @@
+"""
+Pure Python versions of the matching functions of the _similarity extension,
+used by similarity when it is not compiled.
+"""
+from six.moves import xrange
+
+import six
+import numpy as np
+
+
+def naive_match_length(to_search, subsequence, range_start, range_end):
+    """(index, length) of the matches of subsequence starting at each
+    index of the range where to_search has its first item
+
+    The candidate indexes are all extended together, one item of
+    subsequence at a time.
+    """
+    to_search, subsequence, starts = _range_starts(
+        to_search, subsequence, range_start, range_end)
+    return match_lengths(to_search, subsequence, starts)
+
+
+def match_lengths(sequence, pattern, starts):
+    """(index, length) of the matches of pattern at each of the starts,
+    indexes where sequence has the first item of pattern
+    """
+    lengths = _match_lengths(sequence, pattern, starts)
+    return list(zip(starts.tolist(), lengths.tolist()))
+
+
+def unique_longest_match(sequence, pattern, start, end, kmp=False):
+    """(index, length) of the longest match of pattern starting in
+    [start, end) of sequence if it is unique, otherwise (None, None)
+
+    All the candidate matches are extended together, so `kmp` is
+    ignored.
+    """
+    sequence, pattern, starts = _range_starts(sequence, pattern,
+                                              start, end)
+    return unique_longest_match_at(sequence, pattern, starts)
+
+
+def first_longest_match(sequence, pattern, start, end, kmp=False):
+    """(index, length) of the first longest match of pattern starting in
+    [start, end) of sequence, (None, None) if there is no match
+    """
+    sequence, pattern, starts = _range_starts(sequence, pattern,
+                                              start, end)
+    return first_longest_match_at(sequence, pattern, starts)
+
+
+def unique_longest_match_at(sequence, pattern, starts):
+    """Same as unique_longest_match, for the matches at each of the sorted
+    starts, indexes where sequence has the first item of pattern
+    """
+    lengths = _match_lengths(sequence, pattern, starts)
+    if not len(lengths):
+        return None, None
+    best = lengths.argmax()
+    if np.count_nonzero(lengths == lengths[best]) > 1:
+        return None, None
+    return int(starts[best]), int(lengths[best])
+
+
+def first_longest_match_at(sequence, pattern, starts):
+    """Same as first_longest_match, for the matches at each of the sorted
+    starts, indexes where sequence has the first item of pattern
+    """
+    lengths = _match_lengths(sequence, pattern, starts)
+    if not len(lengths):
+        return None, None
+    best = lengths.argmax()
+    return int(starts[best]), int(lengths[best])
+
+
+def _range_starts(sequence, pattern, start, end):
+    """sequence and pattern as arrays, with the indexes in [start, end)
+    where sequence has the first item of pattern
+    """
+    sequence = _as_array(sequence)
+    pattern = _as_array(pattern)
+    start = max(start, 0)
+    end = max(min(end, len(sequence)), start)
+    if not len(pattern):
+        return sequence, pattern, np.zeros(0, dtype=np.intp)
+    starts = np.flatnonzero(sequence[start:end] == pattern[0]) + start
+    return sequence, pattern, starts
+
+
+def _match_lengths(sequence, pattern, starts):
+    """Array of the lengths of the matches of pattern at each of the
+    starts
+    """
+    sequence = _as_array(sequence)
+    pattern = _as_array(pattern)
+    size = len(sequence)
+    lengths = np.ones(len(starts), dtype=np.intp)
+    # candidates still matching
+    active = np.arange(len(starts))
+    for offset in xrange(1, len(pattern)):
+        positions = starts[active] + offset
+        inside = positions < size
+        active = active[inside]
+        active = active[sequence[positions[inside]] == pattern[offset]]
+        if not len(active):
+            break
+        lengths[active] += 1
+    return lengths
+
+
+def _as_array(sequence):
+    """Array of the items of sequence, the code points for strings"""
+    if not isinstance(sequence, (six.text_type, bytes)):
+        return np.asarray(sequence)
+    text = six.text_type(sequence).encode('utf-32-le')
+    return np.frombuffer(text, dtype='<u4')
+
+
+def suffix_array_match(sequence, suffixes, pattern, start, end, limit):
+    """Longest unique match of pattern in sequence starting in
+    [start, end), using the suffix array of sequence. See TokenIndex.
+
+    Returns (index, length), (None, None) when there is no unique match
+    or None when that needs checking more than `limit` suffixes.
+    """
+    n = len(sequence)
+
+    def bound(lo, hi, offset, value, upper):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            position = suffixes[mid] + offset
+            # suffixes ending before offset sort first
+            if position < n and (sequence[position] > value or
+                                 not upper and sequence[position] == value):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+    # narrow the suffixes to those starting with longer prefixes of
+    # pattern
+    intervals = [(0, len(suffixes))]
+    lo, hi = intervals[0]
+    for length, value in enumerate(pattern):
+        lo = bound(lo, hi, length, value, False)
+        hi = bound(lo, hi, length, value, True)
+        if lo == hi:
+            break
+        intervals.append((lo, hi))
+    # then look for the longest ones starting in range, each step only
+    # checks the suffixes not checked by the previous one
+    lo = hi = intervals[-1][0]
+    found = []
+    for length in xrange(len(intervals) - 1, 0, -1):
+        length_lo, length_hi = intervals[length]
+        if length_hi - length_lo > limit:
+            return None
+        positions = np.concatenate((suffixes[length_lo:lo],
+                                    suffixes[hi:length_hi]))
+        found.extend(positions[(positions >= start) &
+                               (positions < end)].tolist())
+        if len(found) == 1:
+            return found[0], length
+        elif found:
+            break
+        lo, hi = length_lo, length_hi
+    return None, None
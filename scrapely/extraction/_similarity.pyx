@@ -1,139 +1,32 @@
+import sys
 import numpy as np
 cimport numpy as np
 cimport cython
 from cpython.version cimport PY_MAJOR_VERSION
+from libc.stdlib cimport malloc, free
 
-cdef np_kmp_match_length(np.ndarray[np.int64_t, ndim=1] sequence,
-                         np.ndarray[np.int64_t, ndim=1] pattern,
-                         int start=0,
-                         int end=-1):
-    """Adaptated from KMP substring search:
-    http://code.activestate.com/recipes/117214-knuth-morris-pratt-string-matching/
+# codec and dtype giving the code units of text as native integers
+if sys.maxunicode > 0xffff:
+    _CODE_UNITS = ('utf-32-le' if sys.byteorder == 'little' else 'utf-32-be',
+                   np.int32)
+else:
+    _CODE_UNITS = ('utf-16-le' if sys.byteorder == 'little' else 'utf-16-be',
+                   np.uint16)
+_ERRORS = 'surrogatepass' if PY_MAJOR_VERSION >= 3 else 'strict'
+# dtypes of the arrays matched without a copy, one for each token_t
+_TOKEN_DTYPES = (np.dtype(np.uint16), np.dtype(np.int32), np.dtype(np.int64))
 
-    The algorithm is modified to return the match length at the given position
-    """
-    ret = []
-    cdef int m = len(pattern)
-    if end == -1:
-        end = m
-    # build table of shift amounts
-    cdef np.ndarray[np.int64_t, ndim=1] shifts = np.ones((m + 1,), dtype=int)
-    cdef int shift = 1
-    cdef int pos
-    for pos in range(m):
-        while shift <= pos and pattern[pos] != pattern[pos-shift]:
-            shift += shifts[pos-shift]
-        shifts[pos+1] = shift
-
-    # do the actual search
-    cdef int startPos = start
-    cdef int matchLen = 0
-    cdef int c
-    for c in sequence[start:]:
-        if startPos >= end:
-            break
-        while matchLen == m or \
-              matchLen >= 0 and pattern[matchLen] != c:
-            if matchLen > 0:
-                ret.append((startPos, matchLen))
-            startPos += shifts[matchLen]
-            matchLen -= shifts[matchLen]
-        matchLen += 1
-    if matchLen > 0 and startPos < end:
-        ret.append((startPos, matchLen))
+# the token ids of pages fit in int32, see TokenDict
+ctypedef fused token_t:
+    np.uint16_t
+    np.int32_t
+    np.int64_t
 
-    return ret
 
-
-cdef u_kmp_match_length(unicode sequence, unicode pattern, int start=0, int end=-1):
-    """Adaptated from KMP substring search:
-    http://code.activestate.com/recipes/117214-knuth-morris-pratt-string-matching/
-
-    The algorithm is modified to return the match length at the given position
-    """
-    ret = []
-    cdef int m = len(pattern)
-    if end == -1:
-        end = m
-    # build table of shift amounts
-    cdef np.ndarray[np.int64_t, ndim=1] shifts = np.ones((m + 1,), dtype=int)
-    cdef int shift = 1
-    cdef int pos
-    for pos in range(m):
-        while shift <= pos and pattern[pos] != pattern[pos-shift]:
-            shift += shifts[pos-shift]
-        shifts[pos+1] = shift
-
-    # do the actual search
-    cdef int startPos = start
-    cdef int matchLen = 0
-    cdef Py_UCS4 c
-    for c in sequence[start:]:
-        if startPos >= end:
-            break
-        while matchLen == m or \
-              matchLen >= 0 and pattern[matchLen] != c:
-            if matchLen > 0:
-                ret.append((startPos, matchLen))
-            startPos += shifts[matchLen]
-            matchLen -= shifts[matchLen]
-        matchLen += 1
-    if matchLen > 0 and startPos < end:
-        ret.append((startPos, matchLen))
-
-    return ret
-
-
-cdef np_naive_match_length(np.ndarray[np.int64_t, ndim=1] sequence,
-                           np.ndarray[np.int64_t, ndim=1] pattern,
-                           int start=0,
-                           int end=-1):
-    ret = []
-    cdef int m = len(sequence)
-    cdef int n = min(m, len(pattern))
-    cdef int i
-    cdef int j
-    cdef int k
-    if end == -1:
-        end = m
-    else:
-        end = min(end, m)
-    for i in range(start, end):
-        j = 0
-        k = i
-        while sequence[k] == pattern[j]:
-            j += 1
-            k += 1
-            if k == m or j == n:
-                break
-        if j > 0:
-            ret.append((i, j))
-    return ret
-
-
-cdef u_naive_match_length(unicode sequence,
-                          unicode pattern, int start=0, int end=-1):
-    ret = []
-    cdef int m = len(sequence)
-    cdef int n = min(m, len(pattern))
-    cdef int i
-    cdef int j
-    cdef int k
-    if end == -1:
-        end = m
-    else:
-        end = min(end, m)
-    for i in range(start, end):
-        j = 0
-        k = i
-        while sequence[k] == pattern[j]:
-            j += 1
-            k += 1
-            if k == m or j == n:
-                break
-        if j > 0:
-            ret.append((i, j))
-    return ret
+cdef struct Match:
+    Py_ssize_t index
+    Py_ssize_t length
+    bint tied
 
 
 cdef unicode _ustring(s):
@@ -152,22 +45,524 @@ cdef unicode _ustring(s):
         raise TypeError('Expected str or unicode')
 
 
-cpdef naive_match_length(sequence, pattern, int start=0, int end=-1):
-    if isinstance(sequence, np.ndarray):
-        if isinstance(pattern, np.ndarray):
-            return np_naive_match_length(sequence, pattern, start, end)
-        else:
-            raise TypeError('Different types for sequence and pattern')
+cdef _as_array(sequence):
+    """Array of the items of sequence, the code units for strings, with one
+    of the _TOKEN_DTYPES
+    """
+    if isinstance(sequence, (unicode, bytes)):
+        codec, dtype = _CODE_UNITS
+        text = _ustring(sequence).encode(codec, _ERRORS)
+        return np.frombuffer(text, dtype=dtype)
+    array = np.asarray(sequence)
+    if array.dtype in _TOKEN_DTYPES:
+        return array
+    if np.can_cast(array.dtype, np.int32):
+        return array.astype(np.int32)
+    return array.astype(np.int64)
+
+
+cdef _as_arrays(sequence, pattern):
+    """sequence and pattern as arrays of the same dtype, the one of sequence
+    unless pattern has items that do not fit in it
+    """
+    if (isinstance(sequence, (unicode, bytes)) !=
+            isinstance(pattern, (unicode, bytes))):
+        raise TypeError('Different types for sequence and pattern')
+    sequence = _as_array(sequence)
+    pattern = _as_array(pattern)
+    if pattern.dtype == sequence.dtype:
+        return sequence, pattern
+    if np.can_cast(pattern.dtype, sequence.dtype) or not len(pattern):
+        return sequence, pattern.astype(sequence.dtype)
+    info = np.iinfo(sequence.dtype)
+    if pattern.min() >= info.min and pattern.max() <= info.max:
+        return sequence, pattern.astype(sequence.dtype)
+    dtype = np.promote_types(sequence.dtype, pattern.dtype)
+    return sequence.astype(dtype), pattern.astype(dtype)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t _match_length(const token_t[:] sequence,
+                                     const token_t[:] pattern,
+                                     Py_ssize_t i) nogil:
+    """Length of the match of pattern at index i of sequence, which has the
+    first item of pattern
+    """
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t j = 1
+    while j < m and i + j < n and sequence[i + j] == pattern[j]:
+        j += 1
+    return j
+
+
+cdef inline bint _add_match(Match *best, Py_ssize_t i, Py_ssize_t length,
+                            Py_ssize_t m, Py_ssize_t n, bint first) nogil:
+    """Update best with the match of `length` at i. Returns whether the result
+    is decided, as no later match can be longer.
+    """
+    if length > best.length:
+        best.index = i
+        best.length = length
+        best.tied = False
+    elif length == best.length:
+        best.tied = True
+    return ((first or best.tied) and
+            (best.length >= m or best.length >= n - i - 1))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Match _naive_best(const token_t[:] sequence,
+                       const token_t[:] pattern, Py_ssize_t start,
+                       Py_ssize_t end, bint first) nogil:
+    """Best match of pattern starting in [start, end), found by extending a
+    match at each index holding its first item
+    """
+    cdef Match best
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t i
+    best.index = -1
+    best.length = 0
+    best.tied = False
+    for i in range(max(start, 0), min(end, n)):
+        if (sequence[i] == pattern[0] and _add_match(
+                &best, i, _match_length(sequence, pattern, i), m, n, first)):
+            break
+    return best
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t *_kmp_shifts(const token_t[:] pattern) nogil:
+    """Table of shift amounts of pattern for the KMP search, NULL if it
+    cannot be allocated
+    """
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t *shifts = <Py_ssize_t *>malloc((m + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t shift = 1
+    cdef Py_ssize_t pos
+    if shifts == NULL:
+        return NULL
+    shifts[0] = 1
+    for pos in range(m):
+        while shift <= pos and pattern[pos] != pattern[pos - shift]:
+            shift += shifts[pos - shift]
+        shifts[pos + 1] = shift
+    return shifts
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Match _kmp_best(const token_t[:] sequence,
+                     const token_t[:] pattern, const Py_ssize_t *shifts,
+                     Py_ssize_t start, Py_ssize_t end, bint first) nogil:
+    """Same as _naive_best, with the KMP substring search
+
+    Adapted from
+    http://code.activestate.com/recipes/117214-knuth-morris-pratt-string-matching/
+    to give the length of the match at each position it stops at. The
+    positions it skips have shorter matches than an earlier one, so they
+    cannot change the result.
+    """
+    cdef Match best
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t start_pos, match_len = 0, k
+    cdef token_t c
+    best.index = -1
+    best.length = 0
+    best.tied = False
+    start = max(start, 0)
+    end = min(end, n)
+    start_pos = start
+    for k in range(start, n):
+        if start_pos >= end:
+            break
+        c = sequence[k]
+        while match_len == m or match_len >= 0 and pattern[match_len] != c:
+            if match_len > 0 and _add_match(&best, start_pos, match_len,
+                                            m, n, first):
+                return best
+            start_pos += shifts[match_len]
+            match_len -= shifts[match_len]
+        match_len += 1
+    if match_len > 0 and start_pos < end:
+        _add_match(&best, start_pos, match_len, m, n, first)
+    return best
+
+
+cdef Match _search(const token_t[:] sequence, const token_t[:] pattern,
+                   Py_ssize_t start, Py_ssize_t end, bint first,
+                   bint kmp) except *:
+    cdef Py_ssize_t *shifts
+    cdef Match best
+    if kmp:
+        shifts = _kmp_shifts(pattern)
+        if shifts == NULL:
+            raise MemoryError()
+        with nogil:
+            best = _kmp_best(sequence, pattern, shifts, start, end, first)
+        free(shifts)
     else:
-        return u_naive_match_length(
-            _ustring(sequence), _ustring(pattern), start, end)
+        with nogil:
+            best = _naive_best(sequence, pattern, start, end, first)
+    return best
+
+
+cdef _best_match(sequence, pattern, Py_ssize_t start, Py_ssize_t end,
+                 bint first, bint kmp):
+    cdef Match best
+    sequence, pattern = _as_arrays(sequence, pattern)
+    if not len(pattern):
+        return None, None
+    # the specialization for the width of the tokens
+    if sequence.itemsize == 2:
+        best = _search[np.uint16_t](sequence, pattern, start, end, first, kmp)
+    elif sequence.itemsize == 4:
+        best = _search[np.int32_t](sequence, pattern, start, end, first, kmp)
+    else:
+        best = _search[np.int64_t](sequence, pattern, start, end, first, kmp)
+    if best.index < 0 or best.tied and not first:
+        return None, None
+    return best.index, best.length
+
+
+def unique_longest_match(sequence, pattern, Py_ssize_t start,
+                         Py_ssize_t end, bint kmp=False):
+    """(index, length) of the longest match of pattern starting in
+    [start, end) of sequence if it is unique, otherwise (None, None)
+
+    The best two matches are tracked while scanning, which stops once no
+    later match can change the result. If `kmp` is true the KMP search is
+    used instead of extending a match at each candidate index.
+    """
+    return _best_match(sequence, pattern, start, end, False, kmp)
+
+
+def first_longest_match(sequence, pattern, Py_ssize_t start,
+                        Py_ssize_t end, bint kmp=False):
+    """(index, length) of the first longest match of pattern starting in
+    [start, end) of sequence, (None, None) if there is no match. See
+    unique_longest_match.
+    """
+    return _best_match(sequence, pattern, start, end, True, kmp)
 
-cpdef kmp_match_length(sequence, pattern, int start=0, int end=-1):
-    if isinstance(sequence, np.ndarray):
-        if isinstance(pattern, np.ndarray):
-            return np_kmp_match_length(sequence, pattern, start, end)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Match _best_at(const token_t[:] sequence,
+                    const token_t[:] pattern, const np.intp_t[:] starts,
+                    bint first) nogil:
+    cdef Match best
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t x
+    best.index = -1
+    best.length = 0
+    best.tied = False
+    for x in range(starts.shape[0]):
+        if _add_match(&best, starts[x],
+                      _match_length(sequence, pattern, starts[x]),
+                      m, n, first):
+            break
+    return best
+
+
+cdef Match _search_at(const token_t[:] sequence, const token_t[:] pattern,
+                      const np.intp_t[:] starts, bint first):
+    cdef Match best
+    with nogil:
+        best = _best_at(sequence, pattern, starts, first)
+    return best
+
+
+cdef _best_match_at(sequence, pattern, starts, bint first):
+    cdef Match best
+    sequence, pattern = _as_arrays(sequence, pattern)
+    if sequence.itemsize == 2:
+        best = _search_at[np.uint16_t](sequence, pattern, starts, first)
+    elif sequence.itemsize == 4:
+        best = _search_at[np.int32_t](sequence, pattern, starts, first)
+    else:
+        best = _search_at[np.int64_t](sequence, pattern, starts, first)
+    if best.index < 0 or best.tied and not first:
+        return None, None
+    return best.index, best.length
+
+
+def unique_longest_match_at(sequence, pattern, starts):
+    """Same as unique_longest_match, for the matches at each of the sorted
+    starts, indexes where sequence has the first item of pattern
+    """
+    return _best_match_at(sequence, pattern, starts, False)
+
+
+def first_longest_match_at(sequence, pattern, starts):
+    """Same as first_longest_match, for the matches at each of the sorted
+    starts, indexes where sequence has the first item of pattern
+    """
+    return _best_match_at(sequence, pattern, starts, True)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _naive_lengths(const token_t[:] sequence,
+                               const token_t[:] pattern, Py_ssize_t start,
+                               Py_ssize_t end, np.intp_t[:] indexes,
+                               np.intp_t[:] lengths) nogil:
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t i, count = 0
+    for i in range(max(start, 0), min(end, n)):
+        if sequence[i] == pattern[0]:
+            indexes[count] = i
+            lengths[count] = _match_length(sequence, pattern, i)
+            count += 1
+    return count
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _kmp_lengths(const token_t[:] sequence,
+                             const token_t[:] pattern,
+                             const Py_ssize_t *shifts, Py_ssize_t start,
+                             Py_ssize_t end, np.intp_t[:] indexes,
+                             np.intp_t[:] lengths) nogil:
+    cdef Py_ssize_t n = sequence.shape[0]
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t start_pos, match_len = 0, k, count = 0
+    cdef token_t c
+    start = max(start, 0)
+    end = min(end, n)
+    start_pos = start
+    for k in range(start, n):
+        if start_pos >= end:
+            break
+        c = sequence[k]
+        while match_len == m or match_len >= 0 and pattern[match_len] != c:
+            if match_len > 0:
+                indexes[count] = start_pos
+                lengths[count] = match_len
+                count += 1
+            start_pos += shifts[match_len]
+            match_len -= shifts[match_len]
+        match_len += 1
+    if match_len > 0 and start_pos < end:
+        indexes[count] = start_pos
+        lengths[count] = match_len
+        count += 1
+    return count
+
+
+cdef Py_ssize_t _scan(const token_t[:] sequence, const token_t[:] pattern,
+                      Py_ssize_t start, Py_ssize_t end, bint kmp,
+                      np.intp_t[:] indexes, np.intp_t[:] lengths) except -1:
+    cdef Py_ssize_t count
+    cdef Py_ssize_t *shifts
+    if not kmp:
+        with nogil:
+            count = _naive_lengths(sequence, pattern, start, end, indexes,
+                                   lengths)
+        return count
+    shifts = _kmp_shifts(pattern)
+    if shifts == NULL:
+        raise MemoryError()
+    with nogil:
+        count = _kmp_lengths(sequence, pattern, shifts, start, end, indexes,
+                             lengths)
+    free(shifts)
+    return count
+
+
+cdef _all_matches(sequence, pattern, Py_ssize_t start, Py_ssize_t end,
+                  bint kmp):
+    cdef Py_ssize_t count
+    sequence, pattern = _as_arrays(sequence, pattern)
+    if end == -1:
+        end = len(sequence)
+    if not len(pattern):
+        return []
+    # the KMP search may stop once past the end of sequence
+    indexes = np.empty(len(sequence) + 1, dtype=np.intp)
+    lengths = np.empty(len(sequence) + 1, dtype=np.intp)
+    if sequence.itemsize == 2:
+        count = _scan[np.uint16_t](sequence, pattern, start, end, kmp,
+                                   indexes, lengths)
+    elif sequence.itemsize == 4:
+        count = _scan[np.int32_t](sequence, pattern, start, end, kmp,
+                                  indexes, lengths)
+    else:
+        count = _scan[np.int64_t](sequence, pattern, start, end, kmp,
+                                  indexes, lengths)
+    return list(zip(indexes[:count].tolist(), lengths[:count].tolist()))
+
+
+def naive_match_length(sequence, pattern, Py_ssize_t start=0,
+                       Py_ssize_t end=-1):
+    """(index, length) of the matches of pattern starting at each index of
+    [start, end) where sequence has its first item
+    """
+    return _all_matches(sequence, pattern, start, end, False)
+
+
+def kmp_match_length(sequence, pattern, Py_ssize_t start=0,
+                     Py_ssize_t end=-1):
+    """(index, length) of the matches of pattern where the KMP search stops,
+    starting in [start, end)
+    """
+    return _all_matches(sequence, pattern, start, end, True)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t _suffix_bound(const token_t[:] sequence,
+                                     const int[:] suffixes, Py_ssize_t lo,
+                                     Py_ssize_t hi, Py_ssize_t offset,
+                                     token_t value, bint upper) nogil:
+    """First position in suffixes[lo:hi], which share their first `offset`
+    tokens, whose token at `offset` is not below (above if `upper`) value
+    """
+    cdef Py_ssize_t mid, position
+    cdef Py_ssize_t n = sequence.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        position = suffixes[mid] + offset
+        # suffixes ending before offset sort first
+        if position < n and (sequence[position] > value or
+                             not upper and sequence[position] == value):
+            hi = mid
         else:
-            raise TypeError('Different types for sequence and pattern')
+            lo = mid + 1
+    return lo
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _suffix_match(const token_t[:] sequence,
+                              const int[:] suffixes,
+                              const token_t[:] pattern, Py_ssize_t start,
+                              Py_ssize_t end, Py_ssize_t limit,
+                              np.intp_t[:] los, np.intp_t[:] his,
+                              Py_ssize_t *found) nogil:
+    """Length of the unique longest match, with its index in found. 0 when
+    there is no unique match and -1 when that needs checking more than
+    `limit` suffixes.
+    """
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef Py_ssize_t lo = 0, hi = suffixes.shape[0], length = 0
+    cdef Py_ssize_t x, position, count = 0
+    # narrow the suffixes to those starting with longer prefixes of pattern
+    los[0] = lo
+    his[0] = hi
+    while length < m:
+        lo = _suffix_bound(sequence, suffixes, lo, hi, length,
+                           pattern[length], False)
+        hi = _suffix_bound(sequence, suffixes, lo, hi, length,
+                           pattern[length], True)
+        if lo == hi:
+            break
+        length += 1
+        los[length] = lo
+        his[length] = hi
+    # then look for the longest ones starting in range, each step only
+    # checks the suffixes not checked by the previous one
+    lo = hi = los[length]
+    while length > 0:
+        if his[length] - los[length] > limit:
+            return -1
+        for x in range(los[length], lo):
+            position = suffixes[x]
+            if start <= position < end:
+                found[0] = position
+                count += 1
+        for x in range(hi, his[length]):
+            position = suffixes[x]
+            if start <= position < end:
+                found[0] = position
+                count += 1
+        if count == 1:
+            return length
+        elif count > 1:
+            break
+        lo = los[length]
+        hi = his[length]
+        length -= 1
+    return 0
+
+
+cdef Py_ssize_t _suffix_search(const token_t[:] sequence,
+                               const int[:] suffixes,
+                               const token_t[:] pattern, Py_ssize_t start,
+                               Py_ssize_t end, Py_ssize_t limit,
+                               Py_ssize_t *found) except *:
+    cdef Py_ssize_t m = pattern.shape[0]
+    cdef np.intp_t[:] los = np.empty(m + 1, dtype=np.intp)
+    cdef np.intp_t[:] his = np.empty(m + 1, dtype=np.intp)
+    cdef Py_ssize_t length
+    with nogil:
+        length = _suffix_match(sequence, suffixes, pattern, start, end, limit,
+                               los, his, found)
+    return length
+
+
+def suffix_array_match(sequence, suffixes, pattern, Py_ssize_t start,
+                       Py_ssize_t end, Py_ssize_t limit):
+    """Longest unique match of pattern in sequence starting in [start, end),
+    using the suffix array of sequence. See TokenIndex.
+
+    Returns (index, length), (None, None) when there is no unique match or
+    None when that needs checking more than `limit` suffixes.
+    """
+    cdef Py_ssize_t length, found = -1
+    sequence, pattern = _as_arrays(sequence, pattern)
+    if sequence.itemsize == 2:
+        length = _suffix_search[np.uint16_t](sequence, suffixes, pattern,
+                                             start, end, limit, &found)
+    elif sequence.itemsize == 4:
+        length = _suffix_search[np.int32_t](sequence, suffixes, pattern,
+                                            start, end, limit, &found)
+    else:
+        length = _suffix_search[np.int64_t](sequence, suffixes, pattern,
+                                            start, end, limit, &found)
+    if length < 0:
+        return None
+    elif length == 0:
+        return None, None
+    return found, length
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _starts_lengths(const token_t[:] sequence, const token_t[:] pattern,
+                          const np.intp_t[:] starts,
+                          np.intp_t[:] lengths) nogil:
+    cdef Py_ssize_t i
+    for i in range(starts.shape[0]):
+        lengths[i] = _match_length(sequence, pattern, starts[i])
+
+
+cdef np.ndarray _lengths_at(const token_t[:] sequence,
+                            const token_t[:] pattern,
+                            const np.intp_t[:] starts):
+    lengths = np.empty(starts.shape[0], dtype=np.intp)
+    cdef np.intp_t[:] length_view = lengths
+    with nogil:
+        _starts_lengths(sequence, pattern, starts, length_view)
+    return lengths
+
+
+def match_lengths(sequence, pattern, starts):
+    """(index, length) of the matches of pattern at each of the starts,
+    indexes where sequence has the first item of pattern
+    """
+    cdef np.ndarray lengths
+    sequence, pattern = _as_arrays(sequence, pattern)
+    if sequence.itemsize == 2:
+        lengths = _lengths_at[np.uint16_t](sequence, pattern, starts)
+    elif sequence.itemsize == 4:
+        lengths = _lengths_at[np.int32_t](sequence, pattern, starts)
     else:
-        return u_kmp_match_length(
-            _ustring(sequence), _ustring(pattern), start, end)
+        lengths = _lengths_at[np.int64_t](sequence, pattern, starts)
+    return list(zip(np.asarray(starts).tolist(), lengths.tolist()))
@@ -4,10 +4,14 @@ Page objects
 This module contains objects representing pages and parts of pages (e.g. tokens
 and annotations) used in the instance based learning algorithm.
 """
+import sys
+import json
+import hashlib
 from itertools import chain
-from numpy import array, ndarray
+import numpy as np
 
 from scrapely.htmlpage import HtmlTagType, HtmlPageRegion, HtmlPageParsedRegion
+from scrapely.extraction.similarity import TokenContext, TokenIndex, TokenText
 
 
 class TokenType(HtmlTagType):
@@ -30,28 +34,122 @@ class TokenDict(object):
     >>> d.find_token(1)
     'b'
 
-    The lower 24 bits store the token reference and the higher bits the type.
-    """
+    Once frozen, no tokens are added and unknown ones share an id that no
+    known token has
+    >>> d.freeze()
+    >>> d.tokenid('p') == d.tokenid('table')
+    True
+    >>> d.tokenid('p') == d.OUT_OF_VOCABULARY
+    True
+    >>> d.tokenid('b')
+    1
 
-    def __init__(self):
-        self.token_ids = {}
+    Dictionaries created from the tokens of another give the same ids, their
+    version identifies the ids
+    >>> d2 = TokenDict(d.tokens())
+    >>> d2.tokenid('b')
+    1
+    >>> d2.version == d.version
+    True
+
+    The lower 24 bits store the token reference and the higher bits the type,
+    arrays of ids use the 32 bit dtype
+    >>> d.tokenid('p', TokenType.UNPAIRED_TAG) <= np.iinfo(d.dtype).max
+    True
+    """
+    # token reference of unknown tokens in frozen dictionaries
+    OUT_OF_VOCABULARY = 0xFFFFFF
+    # dtype of the arrays of token ids
+    dtype = np.int32
+    # token_text encodes OUT_OF_VOCABULARY and the references below
+    # TEXT_REFERENCES - 1
+    TEXT_REFERENCES = 0x43E00
+
+    def __init__(self, tokens=None):
+        """Create a dictionary, `tokens` is a list of the tokens with ids 0,
+        1, 2... as returned by tokens()
+        """
+        self.token_ids = dict((token, i) for i, token in enumerate(tokens or ()))
+        self.frozen = False
+        self._version = None
 
     def tokenid(self, token, token_type=TokenType.WORD):
         """create an integer id from the token and token type passed"""
-        tid = self.token_ids.setdefault(token, len(self.token_ids))
+        if self.frozen:
+            tid = self.token_ids.get(token, self.OUT_OF_VOCABULARY)
+        else:
+            tid = self.token_ids.setdefault(token, len(self.token_ids))
         return tid | (token_type << 24)
 
+    def freeze(self):
+        """Stop adding tokens, unknown tokens get the OUT_OF_VOCABULARY
+        reference from now on.
+
+        Frozen dictionaries are not modified, so they can be shared by
+        threads.
+        """
+        self.frozen = True
+
+    def tokens(self):
+        """List of the tokens, sorted by id"""
+        return sorted(self.token_ids, key=self.token_ids.get)
+
+    @property
+    def version(self):
+        """Hash identifying the tokens and their ids
+
+        Arrays of tokens created with a dictionary of the same version can be
+        used with this one. It changes when tokens are added.
+        """
+        # tokens are only added, so their count identifies the contents
+        size = len(self.token_ids)
+        if self._version is None or self._version[0] != size:
+            data = json.dumps(self.tokens()).encode('utf-8')
+            self._version = (size, hashlib.sha1(data).hexdigest())
+        return self._version[1]
+
     @staticmethod
     def token_type(token):
         """extract the token type from the token id passed"""
         return token >> 24
 
+    @classmethod
+    def token_text(cls, tokens):
+        """String with a character for each of the token ids passed, the
+        same one for the same ids, so the string search of Python can find
+        sequences of tokens
+
+        >>> d = TokenDict()
+        >>> tokens = [d.tokenid('p', TokenType.OPEN_TAG),
+        ...           d.tokenid('p', TokenType.CLOSE_TAG)]
+        >>> text = TokenDict.token_text(tokens * 3)
+        >>> len(text), text.find(TokenDict.token_text(tokens[::-1]))
+        (6, 1)
+
+        Raises ValueError for other token references than OUT_OF_VOCABULARY
+        that are not below TEXT_REFERENCES - 1.
+        """
+        if sys.maxunicode < 0x10FFFF:
+            raise ValueError('token text needs a wide unicode build')
+        tokens = np.asarray(tokens, dtype=np.int64)
+        # OUT_OF_VOCABULARY gets reference 0 and the others the next one
+        references = (tokens + 1) & 0xFFFFFF
+        if len(references) and references.max() >= cls.TEXT_REFERENCES:
+            raise ValueError('too many tokens to encode them as text')
+        characters = references << 2 | tokens >> 24
+        # skip the surrogate code points
+        characters[characters >= 0xD800] += 0x800
+        return characters.astype('<u4').tobytes().decode('utf-32-le')
+
     def find_token(self, tid):
         """Search for a tag with the given ID
 
-        This is O(N) and is only intended for debugging
+        This is O(N) and is only intended for debugging. Returns None for
+        unknown tokens of frozen dictionaries.
         """
         tid &= 0xFFFFFF
+        if tid == self.OUT_OF_VOCABULARY and self.frozen:
+            return None
         if tid >= len(self.token_ids) or tid < 0:
             raise ValueError("tag id %s out of range" % tid)
 
@@ -106,15 +204,22 @@ class Page(object):
     dictionary of tokens and an array of raw token ids
     """
 
-    __slots__ = ('token_dict', 'page_tokens', 'htmlpage')
+    __slots__ = ('token_dict', 'page_tokens', 'htmlpage', 'token_context')
 
     def __init__(self, htmlpage, token_dict, page_tokens):
         self.htmlpage = htmlpage
         self.token_dict = token_dict
         # use a numpy array because we can index/slice easily and efficiently
-        if not isinstance(page_tokens, ndarray):
-            page_tokens = array(page_tokens)
-        self.page_tokens = page_tokens
+        self.page_tokens = np.asarray(page_tokens, dtype=token_dict.dtype)
+        self.token_context = None
+
+    def context(self):
+        """The TokenContext of the page tokens, built when first needed and
+        used to find the regions similar to the template ones
+        """
+        if self.token_context is None:
+            self.token_context = TokenContext(self.page_tokens)
+        return self.token_context
 
 
 class TemplatePage(Page):
@@ -144,7 +249,7 @@ class ExtractionPage(Page):
     """Parsed data belonging to a web page upon which we wish to perform
     extraction.
     """
-    __slots__ = ('token_page_indexes', )
+    __slots__ = ('token_page_indexes', 'token_index', 'token_text')
 
     def __init__(self, htmlpage, token_dict, page_tokens, token_page_indexes):
         """Construct a new ExtractionPage
@@ -157,6 +262,38 @@ class ExtractionPage(Page):
         """
         Page.__init__(self, htmlpage, token_dict, page_tokens)
         self.token_page_indexes = token_page_indexes
+        self.token_index = None
+        self.token_text = None
+
+    def index_tokens(self):
+        """Build the TokenIndex of the page tokens, used to find the regions
+        similar to the template ones. It pays off for large pages extracted
+        with many annotations.
+        """
+        if self.token_index is None:
+            self.token_index = TokenIndex(self.page_tokens)
+        return self.token_index
+
+    def encode_tokens(self):
+        """Build the TokenText of the page tokens, whose exact matches are
+        found with the string search of Python. See TokenDict.token_text.
+        """
+        if self.token_text is None:
+            self.token_text = TokenText(self.page_tokens,
+                                        self.token_dict.token_text)
+        return self.token_text
+
+    def context(self):
+        """The TokenContext used to find the regions similar to the template
+        ones, shared by the extraction trees of all the templates tried on the
+        page. It is the TokenIndex or the TokenText of the page if they were
+        built, otherwise a TokenContext built when first needed.
+        """
+        if self.token_index is not None:
+            return self.token_index
+        if self.token_text is not None:
+            return self.token_text
+        return Page.context(self)
 
     def htmlpage_region(self, start_token_index, end_token_index):
         """The region in the HtmlPage corresponding to the area defined by
@@ -5,9 +5,8 @@ Parsing of web pages for extraction task.
 """
 import json
 from collections import defaultdict
-from numpy import array
 
-from scrapely.htmlpage import HtmlTagType, HtmlTag, HtmlPage
+from scrapely.htmlpage import HtmlTagType, HtmlTag, HtmlPage, HtmlParsedBody
 from scrapely.extraction.pageobjects import (AnnotationTag,
     TemplatePage, ExtractionPage, AnnotationText, TokenDict)
 
@@ -31,9 +30,13 @@ def parse_template(token_dict, template_html):
     return parser.to_template()
 
 
-def parse_extraction_page(token_dict, page_html):
-    """Create an ExtractionPage object by parsing the html"""
-    parser = ExtractionPageParser(token_dict)
+def parse_extraction_page(token_dict, page_html, parse_cache=None):
+    """Create an ExtractionPage object by parsing the html
+
+    If a scrapely.parsecache.ParseCache is given the page tokens are loaded
+    from it when possible.
+    """
+    parser = ExtractionPageParser(token_dict, parse_cache)
     parser.feed(page_html)
     return parser.to_extraction_page()
 
@@ -170,7 +173,7 @@ class TemplatePageParser(InstanceLearningParser):
         if self._read_bool_template_attribute(html_tag, "ignore-beneath"):
             self.ignored_regions.append((self.next_tag_index, None))
 
-        replacement = html_tag.attributes.pop("data-scrapy-replacement", None)
+        replacement = html_tag.attributes.get("data-scrapy-replacement")
         if replacement:
             self.token_list.pop()
             self._add_token(replacement, html_tag.tag_type, html_tag.start, html_tag.end)
@@ -333,13 +336,29 @@ class ExtractionPageParser(InstanceLearningParser):
     it needs to also maintain a mapping from token index to the original content
     so that once regions are identified, the original content can be extracted.
     """
-    def __init__(self, token_dict):
+    def __init__(self, token_dict, parse_cache=None):
         InstanceLearningParser.__init__(self, token_dict)
+        self.parse_cache = parse_cache
         self._page_token_indexes = []
 
+    def feed(self, html_page):
+        parsed_body = html_page.parsed_body
+        if not isinstance(parsed_body, HtmlParsedBody):
+            return InstanceLearningParser.feed(self, html_page)
+        # tokenize straight from the parsed columns, so no HtmlTag objects
+        # are created for the extraction page
+        self.html_page = html_page
+        if self.parse_cache is None:
+            tokens = parsed_body.tag_tokens(self.token_dict.tokenid)
+        else:
+            body, encoding = html_page._parse_source()
+            tokens = self.parse_cache.tag_tokens(body, self.token_dict,
+                                                 encoding, parsed_body)
+        self.token_list, self._page_token_indexes = tokens
+
     def handle_tag(self, html_tag, index):
         self._page_token_indexes.append(index)
 
     def to_extraction_page(self):
-        return ExtractionPage(self.html_page, self.token_dict, array(self.token_list),
+        return ExtractionPage(self.html_page, self.token_dict, self.token_list,
                 self._page_token_indexes)
@@ -11,16 +11,17 @@ import six
 
 from itertools import groupby, starmap
 
-from numpy import array
+from numpy import array, maximum, minimum
 
-from six.moves import zip as izip, xrange, StringIO
+from six.moves import zip as izip, StringIO
 
 from scrapely.descriptor import FieldDescriptor
 from scrapely.htmlpage import HtmlPageRegion
 from scrapely.extraction.similarity import (
-    similar_region, longest_unique_subsequence, common_prefix)
+    similar_region, longest_unique_subsequence, first_longest_subsequence,
+    common_prefix, fingerprint)
 from scrapely.extraction.pageobjects import (
-    AnnotationTag, PageRegion, FragmentedHtmlPageRegion)
+    AnnotationTag, PageRegion, FragmentedHtmlPageRegion, TokenDict)
 
 _EXTRACT_HTML = lambda x: x
 _DEFAULT_DESCRIPTOR = FieldDescriptor('none', None)
@@ -201,8 +202,10 @@ class RepeatedDataExtractor(object):
     """Data extractor for handling repeated data"""
 
     def __init__(self, prefix, suffix, extractors):
-        self.prefix = array(prefix)
-        self.suffix = array(suffix)
+        self.prefix = array(prefix, dtype=TokenDict.dtype)
+        self.suffix = array(suffix, dtype=TokenDict.dtype)
+        self.fingerprints = (fingerprint(self.prefix),
+                             fingerprint(self.suffix))
         self.extractor = copy.copy(extractors[0])
         self.annotation = copy.copy(self.extractor.annotation)
         self.annotation.end_index = extractors[-1].annotation.end_index
@@ -216,21 +219,33 @@ class RepeatedDataExtractor(object):
         index = max(0, start_index - prefixlen)
         max_index = min(len(page.page_tokens) - suffixlen, end_index + len(self.suffix))
         max_start_index = max_index - prefixlen
+        # all the matches of the prefix and suffix, found by comparing the
+        # fingerprints of the page windows with the precomputed ones (or
+        # with the string search in token text)
+        context = page.context()
+        prefix_fingerprint, suffix_fingerprint = self.fingerprints
+        prefixes = context.matches(self.prefix, index, max_start_index + 1,
+                                   prefix_fingerprint)
+        suffixes = context.matches(self.suffix, index + prefixlen,
+                                   max_index + 1, suffix_fingerprint)
+        if not len(prefixes) or not len(suffixes):
+            return []
+        # the first suffix after each prefix, then the prefix where the
+        # search goes on after that region
+        found = suffixes.searchsorted(prefixes + prefixlen)
+        peeks = suffixes[minimum(found, len(suffixes) - 1)]
+        following = prefixes.searchsorted(maximum(peeks, prefixes + 1))
+        found, peeks, following = \
+            found.tolist(), peeks.tolist(), following.tolist()
+        prefixes = prefixes.tolist()
         extracted = []
-        while index <= max_start_index:
-            prefix_end = index + prefixlen
-            if (page.page_tokens[index:prefix_end] == self.prefix).all():
-                for peek in xrange(prefix_end, max_index + 1):
-                    if (page.page_tokens[peek:peek + suffixlen] \
-                            == self.suffix).all():
-                        extracted += self.extractor.extract(page,
-                                prefix_end - 1, peek, ignored_regions, suffix_max_length=suffixlen)
-                        index = max(peek, index + 1)
-                        break
-                else:
-                    break
-            else:
-                index += 1
+        kwargs['suffix_max_length'] = suffixlen
+        current = 0
+        while current < len(prefixes) and found[current] < len(suffixes):
+            extracted += self.extractor.extract(page,
+                    prefixes[current] + prefixlen - 1, peeks[current],
+                    ignored_regions, **kwargs)
+            current = following[current]
         return extracted
 
     @staticmethod
@@ -391,16 +406,22 @@ class RecordExtractor(object):
         # end_index is inclusive, but similar_region treats it as exclusive
         end_index_exclusive = None if end_index is None else end_index + 1
         labelled = labelled_element(current_extractor)
+        token_index = None
+        if self.best_match in (longest_unique_subsequence,
+                               first_longest_subsequence):
+            token_index = page.context()
         score, pindex, sindex = \
             similar_region(page.page_tokens, self.template_tokens,
-                labelled, start_index, end_index_exclusive, self.best_match, **kwargs)
+                labelled, start_index, end_index_exclusive, self.best_match,
+                token_index=token_index, **kwargs)
         if score > 0:
             if isinstance(labelled, AnnotationTag):
                 similar_ignored_regions = []
                 start = pindex
                 for i in ignored_regions:
                     s, p, e = similar_region(page.page_tokens, self.template_tokens,
-                              i, start, sindex, self.best_match, **kwargs)
+                              i, start, sindex, self.best_match,
+                              token_index=token_index, **kwargs)
                     if s > 0:
                         similar_ignored_regions.append(PageRegion(p, e))
                         start = e or start
@@ -506,9 +527,9 @@ class TraceExtractor(object):
         text_start = page.htmlpage.parsed_body[page.token_page_indexes[start]].start
         text_end = page.htmlpage.parsed_body[page.token_page_indexes[end or -1]].end
         page_snippet = "(...%s)%s(%s...)" % (
-                page.htmlpage.body[text_start-50:text_start].replace('\n', ' '),
-                page.htmlpage.body[text_start:text_end],
-                page.htmlpage.body[text_end:text_end+50].replace('\n', ' '))
+                page.htmlpage.body_slice(text_start-50, text_start).replace('\n', ' '),
+                page.htmlpage.body_slice(text_start, text_end),
+                page.htmlpage.body_slice(text_end, text_end+50).replace('\n', ' '))
         pre_summary = "\nstart %s page[%s:%s]\n" % (self.traced.__class__.__name__, start, end)
         post_summary = """
 %s page[%s:%s]
@@ -563,16 +584,28 @@ extracted
 
 
 class TemplatePageExtractor(object):
-    """Top level extractor for a template page"""
+    """Top level extractor for a template page
+
+    max_context_length limits the number of template tokens before and after
+    each annotation that are first matched against the page, see
+    similarity.similar_region. It is unlimited by default, otherwise it must
+    be positive.
+    """
 
-    def __init__(self, template, extractors):
+    def __init__(self, template, extractors, max_context_length=None):
+        if max_context_length is not None and max_context_length < 1:
+            raise ValueError('max_context_length must be positive, got %r'
+                             % (max_context_length,))
         self.extractors = extractors
         self.template = template
+        self.max_context_length = max_context_length
 
     def extract(self, page, start_index=0, end_index=None):
         items = []
         for extractor in self.extractors:
-            items.extend(extractor.extract(page, start_index, end_index, self.template.ignored_regions))
+            items.extend(extractor.extract(page, start_index, end_index,
+                self.template.ignored_regions,
+                max_context_length=self.max_context_length))
         return [self._merge_list_dicts(items)]
 
     def _merge_list_dicts(self, dicts):
@@ -2,20 +2,29 @@
 Similarity calculation for Instance based extraction algorithm.
 """
 from itertools import count
-from six.moves import zip as izip, xrange
-from operator import itemgetter
-from heapq import nlargest
+from functools import partial
+from six.moves import zip as izip
+
+import six
+import numpy as np
 
 try:
-    # For typical use cases (small sequences and patterns) the naive approach
-    # actually runs faster than KMP algorithm
-    from . _similarity import naive_match_length
+    from . _similarity import (naive_match_length, match_lengths,
+                               unique_longest_match, unique_longest_match_at,
+                               first_longest_match, first_longest_match_at,
+                               suffix_array_match)
+    _native_matching = True
 except ImportError:
-    def naive_match_length(to_search, subsequence, range_start, range_end):
-        startval = subsequence[0]
-        return ((i, common_prefix_length(to_search[i:], subsequence))
-                for i in xrange(range_start, range_end)
-                if startval == to_search[i])
+    _native_matching = False
+    from ._pysimilarity import (naive_match_length, match_lengths,
+                                unique_longest_match, unique_longest_match_at,
+                                first_longest_match, first_longest_match_at,
+                                suffix_array_match)
+
+
+# dtypes of the token arrays matched without a copy, narrower ones take less
+# memory and are scanned faster
+_TOKEN_DTYPES = (np.dtype(np.uint16), np.dtype(np.int32), np.dtype(np.int64))
 
 
 def common_prefix_length(a, b):
@@ -53,6 +62,100 @@ def common_prefix(*sequences):
     return prefix
 
 
+class MatchPolicy(object):
+    """Choice of the algorithm finding the best match of a pattern starting
+    in a range of a sequence
+
+    * 'naive' extends a match at each index of the range holding the first
+      item of the pattern. It is the fastest when these are rare or their
+      matches are short, but takes up to len(range) * len(pattern) steps
+      when many of them match long parts of the pattern, as with periodic
+      patterns like the tags of repeated table rows.
+    * 'kmp' uses the Knuth-Morris-Pratt search, which takes at most
+      2 * len(range) + len(pattern) steps whatever the pattern.
+    * 'index' uses the TokenContext of the sequence, when there is one, to
+      only visit the indexes holding the first item of the pattern or, with
+      a TokenIndex, to find the match in its suffix array. This avoids
+      scanning long ranges.
+
+    'kmp' is chosen for patterns of at least kmp_pattern_length items whose
+    first item is at least 1 / kmp_spacing of the range, 'index' for ranges
+    of at least index_range_length items with a context and 'naive'
+    otherwise. With the tokens of real pages, where most candidate matches
+    are short, the KMP search is about 2.5 times slower than the naive one
+    and the index only pays off for ranges of several thousand tokens. The
+    naive search becomes slower than KMP with patterns of 16 or more tokens
+    repeated every 4 or fewer tokens.
+
+    text_search tells whether a TokenText finds the best matches in its
+    string instead of its tokens. By default it does when the compiled
+    matching functions are not available, as they are faster otherwise.
+
+    >>> policy = MatchPolicy()
+    >>> tokens = np.array([1, 2] * 5000)
+    >>> policy.choose(tokens, np.array([3, 1, 2]), 0, len(tokens))
+    'naive'
+    >>> policy.choose(tokens, np.array([1, 2] * 20), 0, len(tokens))
+    'kmp'
+    >>> policy.choose(tokens, np.array([1, 2, 3]), 0, len(tokens),
+    ...               TokenContext(tokens))
+    'index'
+    """
+
+    def __init__(self, kmp_pattern_length=16, kmp_spacing=4,
+                 index_range_length=8192, text_search=None):
+        self.kmp_pattern_length = kmp_pattern_length
+        self.kmp_spacing = kmp_spacing
+        self.index_range_length = index_range_length
+        if text_search is None:
+            text_search = not _native_matching
+        self.text_search = text_search
+
+    def choose(self, sequence, pattern, range_start, range_end,
+               token_index=None):
+        """'naive', 'kmp' or 'index', the algorithm to find the matches of
+        pattern starting in [range_start, range_end) of sequence, whose
+        TokenContext is token_index if given
+        """
+        range_start = max(range_start, 0)
+        range_length = min(range_end, len(sequence)) - range_start
+        # the positions in token_index are only faster to count in the
+        # ranges where they are faster to search
+        indexed = (token_index is not None and
+                   range_length >= self.index_range_length)
+        if (len(pattern) >= self.kmp_pattern_length and
+                _count_first(sequence, pattern, range_start, range_end,
+                             token_index if indexed else None) *
+                self.kmp_spacing >= range_length):
+            return 'kmp'
+        if indexed:
+            return 'index'
+        return 'naive'
+
+
+def _count_first(sequence, pattern, range_start, range_end, token_index=None):
+    """Number of indexes in the range where sequence has the first item of
+    pattern
+    """
+    if token_index is not None:
+        return len(token_index.occurrences(pattern[0], range_start, range_end))
+    if isinstance(sequence, (six.text_type, bytes)):
+        return sequence.count(pattern[0], range_start, range_end)
+    return np.count_nonzero(
+        np.asarray(sequence[range_start:range_end]) == pattern[0])
+
+
+_match_policy = MatchPolicy()
+
+
+def set_match_policy(policy):
+    """Choose the algorithms of longest_unique_subsequence,
+    first_longest_subsequence and TokenContext with `policy`, a MatchPolicy
+    """
+    global _match_policy
+    _match_policy = policy
+
+
 def longest_unique_subsequence(to_search, subsequence, range_start=0,
                                range_end=None):
     """Find the longest unique subsequence of items in an array or string.  This
@@ -79,15 +182,19 @@ def longest_unique_subsequence(to_search, subsequence, range_start=0,
     (4, 2)
     >>> longest_unique_subsequence(to_search, np.array([3, 2]), 0, 2)
     (1, 2)
+
+    Arrays of narrower integers, like the int32 tokens of pages, are searched
+    without converting them
+    >>> longest_unique_subsequence(to_search.astype(np.int32),
+    ...                            np.array([2, 4, 3], dtype=np.uint16))
+    (2, 3)
     """
     if range_end is None:
         range_end = len(to_search)
-    matches = naive_match_length(to_search, subsequence, range_start, range_end)
-    best2 = nlargest(2, matches, key=itemgetter(1))
-    # if there is a single unique best match, return that
-    if len(best2) == 1 or len(best2) == 2 and best2[0][1] != best2[1][1]:
-        return best2[0][0], best2[0][1]
-    return None, None
+    kmp = _match_policy.choose(
+        to_search, subsequence, range_start, range_end) == 'kmp'
+    return unique_longest_match(to_search, subsequence, range_start,
+                                range_end, kmp)
 
 
 def first_longest_subsequence(to_search, subsequence, range_start=0, range_end=None):
@@ -107,23 +214,413 @@ def first_longest_subsequence(to_search, subsequence, range_start=0, range_end=N
     >>> first_longest_subsequence([], [3, 2])
     (None, None)
     """
-    startval = subsequence[0]
     if range_end is None:
         range_end = len(to_search)
+    kmp = _match_policy.choose(
+        to_search, subsequence, range_start, range_end) == 'kmp'
+    return first_longest_match(to_search, subsequence, range_start,
+                               range_end, kmp)
+
+
+def _suffix_array(sequence):
+    """Positions of the suffixes of sequence, in sorted order
+
+    Shorter suffixes sort before the longer ones they are a prefix of.
+    """
+    size = len(sequence)
+    # rank of each suffix by its first 1, 2, 4... tokens
+    rank = np.unique(sequence, return_inverse=True)[1].ravel()
+    order = np.argsort(rank, kind='stable')
+    width = 1
+    while size and width < size:
+        # sort by the pair of ranks, the one of suffixes ending sooner is 0
+        keys = rank.astype(np.int64) * (size + 1)
+        keys[:size - width] += rank[width:] + 1
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        rank = np.empty(size, dtype=np.intp)
+        rank[order[0]] = 0
+        rank[order[1:]] = np.cumsum(keys[1:] != keys[:-1])
+        if rank[order[-1]] == size - 1:
+            break
+        width *= 2
+    return order.astype(np.int32)
+
+
+# odd base of the rolling hashes, with its inverse modulo 2 ** 64
+_HASH_BASE = 0x100000001b3
+_HASH_INVERSE = _HASH_BASE
+for _ in range(6):
+    _HASH_INVERSE = _HASH_INVERSE * (2 - _HASH_BASE * _HASH_INVERSE) % 2 ** 64
+
+
+def _hash_powers(base, size):
+    """Array of base ** i modulo 2 ** 64 for i in [0, size)"""
+    powers = np.full(size, base, dtype=np.uint64)
+    if size:
+        powers[0] = 1
+    return np.cumprod(powers, dtype=np.uint64)
+
+
+def fingerprint(sequence):
+    """Rolling hash of a sequence of tokens, modulo 2 ** 64
+
+    It is the fingerprint of the windows of TokenContext with the same
+    tokens, so it is computed once for a pattern searched in many pages.
+
+    >>> fingerprint(np.array([3, 2])) == fingerprint(np.array([3, 2], np.int32))
+    True
+    >>> fingerprint(np.array([3, 2])) == fingerprint(np.array([2, 3]))
+    False
+    >>> fingerprint([])
+    0
+    """
+    sequence = np.asarray(sequence).astype(np.uint64)
+    powers = _hash_powers(_HASH_BASE, len(sequence))
+    return int((sequence * powers).sum(dtype=np.uint64))
+
+
+class TokenContext(object):
+    """Structures derived from a sequence of tokens, built when first needed
+    and shared by all the searches in it, like those of the extraction trees
+    tried on a page
+
+    Its longest_unique_subsequence and first_longest_subsequence methods give
+    the same results as the functions on the sequence. The positions of each
+    token count the candidate matches for the MatchPolicy without scanning
+    the range and, for long enough ranges, are the only ones checked. The
+    reversed sequence is kept as a contiguous array.
+
+    >>> context = TokenContext(np.array([6, 3, 2, 4, 3, 2, 5]))
+    >>> context.longest_unique_subsequence(np.array([2, 4, 3]))
+    (2, 3)
+    >>> context.first_longest_subsequence(np.array([3, 2]))
+    (1, 2)
+    >>> context.occurrences(3).tolist()
+    [1, 4]
+    >>> context.reverse.longest_unique_subsequence(np.array([4, 2]))
+    (3, 2)
+
+    The rolling hashes of its windows find all the exact matches of a
+    subsequence with one comparison per window:
+
+    >>> context.matches(np.array([3, 2])).tolist()
+    [1, 4]
+    >>> context.matches(np.array([3, 2]), 2).tolist()
+    [4]
+    """
+
+    def __init__(self, sequence):
+        self.sequence = np.ascontiguousarray(sequence)
+        if self.sequence.dtype not in _TOKEN_DTYPES:
+            self.sequence = self.sequence.astype(np.int64)
+        self._occurrences = None
+        self._hashes = None
+        self._reverse = None
+
+    @property
+    def reverse(self):
+        """The same for the reversed sequence"""
+        if self._reverse is None:
+            reverse = self._reversed()
+            reverse._reverse = self
+            self._reverse = reverse
+        return self._reverse
+
+    def _reversed(self):
+        return TokenContext(self.sequence[::-1])
+
+    def occurrences(self, token, range_start=0, range_end=None):
+        """Sorted array of the positions of token in [range_start, range_end)
+        """
+        if self._occurrences is None:
+            # positions sorted by token, then by position
+            positions = np.argsort(self.sequence, kind='stable')
+            self._occurrences = (positions, self.sequence[positions])
+        positions, tokens = self._occurrences
+        positions = positions[tokens.searchsorted(token, 'left'):
+                              tokens.searchsorted(token, 'right')]
+        if range_end is not None:
+            positions = positions[:positions.searchsorted(range_end)]
+        if range_start > 0:
+            positions = positions[positions.searchsorted(range_start):]
+        return positions
+
+    def fingerprints(self, length, range_start=0, range_end=None):
+        """Array of the fingerprints of the windows of length tokens starting
+        at each index in [range_start, range_end) where they fit
+
+        Only the hashes of the prefixes of the sequence are kept, so each
+        call takes time linear in the size of the range.
+        """
+        if self._hashes is None:
+            # hashes of the prefixes, with the token at i weighted by
+            # base ** i, and base ** -i to shift the windows back to 0
+            size = len(self.sequence)
+            powers = _hash_powers(_HASH_BASE, size)
+            sums = np.zeros(size + 1, dtype=np.uint64)
+            np.cumsum(self.sequence.astype(np.uint64) * powers,
+                      dtype=np.uint64, out=sums[1:])
+            self._hashes = (sums, _hash_powers(_HASH_INVERSE, size + 1))
+        sums, inverse_powers = self._hashes
+        windows = len(self.sequence) - length + 1
+        if range_end is None or range_end > windows:
+            range_end = windows
+        range_start = max(range_start, 0)
+        range_end = max(range_end, range_start)
+        return ((sums[range_start + length:range_end + length] -
+                 sums[range_start:range_end]) *
+                inverse_powers[range_start:range_end])
+
+    def matches(self, subsequence, range_start=0, range_end=None,
+                subsequence_fingerprint=None):
+        """Sorted array of the indexes in [range_start, range_end) where
+        subsequence starts
+
+        The windows are compared by their fingerprints, those with the one
+        of subsequence (computed if not given) are then checked token by
+        token.
+        """
+        subsequence = np.asarray(subsequence)
+        length = len(subsequence)
+        if subsequence_fingerprint is None:
+            subsequence_fingerprint = fingerprint(subsequence)
+        range_start = max(range_start, 0)
+        starts = np.flatnonzero(
+            self.fingerprints(length, range_start, range_end) ==
+            np.uint64(subsequence_fingerprint)) + range_start
+        if len(starts) and length:
+            windows = self.sequence[starts[:, None] + np.arange(length)]
+            starts = starts[(windows == subsequence).all(axis=1)]
+        return starts
+
+    def longest_unique_subsequence(self, subsequence, range_start=0,
+                                   range_end=None):
+        """Same as longest_unique_subsequence(sequence, subsequence,
+        range_start, range_end)
+        """
+        return self._best_match(subsequence, range_start, range_end, False)
+
+    def first_longest_subsequence(self, subsequence, range_start=0,
+                                  range_end=None):
+        """Same as first_longest_subsequence(sequence, subsequence,
+        range_start, range_end)
+        """
+        return self._best_match(subsequence, range_start, range_end, True)
+
+    def _best_match(self, subsequence, range_start, range_end, first):
+        range_end = self._range_end(range_end)
+        if range_start < 0:
+            match = (first_longest_subsequence if first else
+                     longest_unique_subsequence)
+            return match(self.sequence, subsequence, range_start, range_end)
+        subsequence = np.asarray(subsequence)
+        if not len(subsequence):
+            return None, None
+        algorithm = _match_policy.choose(self.sequence, subsequence,
+                                         range_start, range_end, self)
+        if algorithm != 'index':
+            match = first_longest_match if first else unique_longest_match
+            return match(self.sequence, subsequence, range_start, range_end,
+                         algorithm == 'kmp')
+        starts = self.occurrences(subsequence[0], range_start, range_end)
+        return self._match_at(subsequence, range_start, range_end, starts,
+                              first)
+
+    def _match_at(self, subsequence, range_start, range_end, starts, first):
+        """Best match of subsequence at the starts, the positions of its
+        first token in the range
+        """
+        match = first_longest_match_at if first else unique_longest_match_at
+        return match(self.sequence, subsequence, starts)
+
+    def _range_end(self, range_end):
+        size = len(self.sequence)
+        if range_end is None or range_end > size:
+            return size
+        return range_end
+
+
+class TokenIndex(TokenContext):
+    """TokenContext of a sequence of tokens with its suffix array
+
+    The longest unique match in ranges that are long enough (see
+    MatchPolicy) is found from the suffix array when that is faster than
+    checking the positions where the subsequence starts. This pays off for
+    long sequences searched many times.
+
+    >>> index = TokenIndex(np.array([6, 3, 2, 4, 3, 2, 5]))
+    >>> index.longest_unique_subsequence(np.array([2, 4, 3]))
+    (2, 3)
+    >>> index.longest_unique_subsequence(np.array([3, 2]))
+    (None, None)
+    >>> index.longest_unique_subsequence(np.array([3, 2]), 3)
+    (4, 2)
+    >>> index.first_longest_subsequence(np.array([3, 2]))
+    (1, 2)
 
-    # the comparison to startval ensures only matches of length >= 1 and
-    # reduces the number of calls to the common_length function
-    matches = [(i, common_prefix_length(to_search[i:], subsequence))
-        for i in xrange(range_start, range_end) if startval == to_search[i]]
+    The index of the reversed sequence is used to match in reverse order
+    >>> index.reverse.longest_unique_subsequence(np.array([4, 2]))
+    (3, 2)
+    """
+
+    def __init__(self, sequence):
+        TokenContext.__init__(self, sequence)
+        self.suffixes = _suffix_array(self.sequence)
+
+    def _reversed(self):
+        return TokenIndex(self.sequence[::-1])
+
+    def _match_at(self, subsequence, range_start, range_end, starts, first):
+        if not first:
+            match = suffix_array_match(self.sequence, self.suffixes,
+                                       subsequence, range_start, range_end,
+                                       len(starts))
+            if match is not None:
+                return match
+        return TokenContext._match_at(self, subsequence, range_start,
+                                      range_end, starts, first)
+
+
+def _text_best_match(text, pattern, start, end, first):
+    """(index, length) of the longest match of the string pattern starting in
+    [start, end) of text, the first one if `first` or the unique one. The
+    length is the longest prefix of pattern found in the range, searched for
+    with str.find.
+    """
+    start = max(start, 0)
+    end = min(end, len(text))
+    size = len(pattern)
 
-    if not matches:
+    def find(length, start=start):
+        return text.find(pattern[:length], start, end - 1 + length)
+    if not size or start >= end or find(1) < 0:
         return None, None
-    # secondary sort on position and prefer the smaller one (near)
-    return max(matches, key=lambda x: (x[1], -x[0]))
+    # double the length while found, then bisect
+    found, missing = 1, 2
+    while missing <= size and find(missing) >= 0:
+        found, missing = missing, missing * 2
+    missing = min(missing, size + 1)
+    while missing - found > 1:
+        middle = (found + missing) // 2
+        if find(middle) >= 0:
+            found = middle
+        else:
+            missing = middle
+    index = find(found)
+    if not first and find(found, index + 1) >= 0:
+        return None, None
+    return index, found
+
+
+class TokenText(TokenContext):
+    """TokenContext of a sequence of tokens with a string holding a
+    character for each of them, so exact matches are found with the string
+    search of Python
+
+    `encode` is the function giving the string of an array of tokens, the
+    same character for the same tokens. Exact matches are found with find(),
+    tens to hundreds of times faster than comparing the arrays at each
+    index.
+
+    When the compiled matching functions are not available the
+    longest_unique_subsequence and first_longest_subsequence methods search
+    the string, narrowing the matches to the occurrences of ever longer
+    prefixes of the subsequence, which is an order of magnitude faster than
+    the pure Python functions. Otherwise they search the tokens, as the
+    compiled functions are faster still. MatchPolicy.text_search overrides
+    this choice.
+
+    >>> encode = lambda tokens: u''.join(map(six.unichr, tokens))
+    >>> text = TokenText(np.array([66, 67, 68, 67, 68, 69]), encode)
+    >>> text.find(np.array([67, 68]), 2)
+    3
+    >>> text.matches(np.array([67, 68])).tolist()
+    [1, 3]
+    >>> text.longest_unique_subsequence(np.array([68, 67, 68]))
+    (2, 3)
+    >>> text.longest_unique_subsequence(np.array([67, 68]))
+    (None, None)
+    >>> text.first_longest_subsequence(np.array([67, 68]))
+    (1, 2)
+    >>> text.reverse.longest_unique_subsequence(np.array([69, 68]))
+    (0, 2)
+    """
+
+    def __init__(self, sequence, encode, text=None):
+        TokenContext.__init__(self, sequence)
+        self.encode = encode
+        self.text = encode(self.sequence) if text is None else text
+
+    def _reversed(self):
+        return TokenText(self.sequence[::-1], self.encode, self.text[::-1])
+
+    def find(self, subsequence, range_start=0, range_end=None):
+        """Lowest index in [range_start, range_end) where subsequence starts,
+        -1 if there is none
+        """
+        if range_end is None:
+            range_end = len(self.text)
+        return self.text.find(self.encode(subsequence), range_start,
+                              range_end - 1 + len(subsequence))
+
+    def matches(self, subsequence, range_start=0, range_end=None,
+                subsequence_fingerprint=None):
+        """Same as TokenContext.matches, found with find() instead of the
+        fingerprints
+        """
+        text = self.encode(subsequence)
+        windows = len(self.text) - len(text) + 1
+        if range_end is None or range_end > windows:
+            range_end = windows
+        range_start = max(range_start, 0)
+        # the end of the last window starting in the range
+        end = range_end - 1 + len(text)
+        starts = []
+        start = self.text.find(text, range_start, end) \
+            if range_start < range_end else -1
+        while start >= 0:
+            starts.append(start)
+            start = self.text.find(text, start + 1, end)
+        return np.array(starts, dtype=np.intp)
+
+    def _best_match(self, subsequence, range_start, range_end, first):
+        if not _match_policy.text_search:
+            return TokenContext._best_match(self, subsequence, range_start,
+                                            range_end, first)
+        return _text_best_match(self.text, self.encode(subsequence),
+                                range_start, self._range_end(range_end),
+                                first)
+
+
+def _limited_match(best_match, first_match, first, length, subsequence,
+                   range_start, range_end):
+    """best_match of subsequence comparing its first `length` items, and
+    twice as many while several matches have all the items compared
+
+    The first match of these could be shorter than another one with more
+    items, and with all the items there could be a longest unique match.
+    first_match finds the first longest match, to tell when the unique one
+    is missing because of matches of all the items.
+    """
+    while length < len(subsequence):
+        limited = subsequence[:length]
+        index, score = best_match(limited, range_start, range_end)
+        if first:
+            tied = score == length
+        elif index is None:
+            tied = first_match(limited, range_start, range_end)[1] == length
+        else:
+            tied = False
+        if not tied:
+            return index, score
+        length *= 2
+    return best_match(subsequence, range_start, range_end)
 
 
 def similar_region(extracted_tokens, template_tokens, labelled_region,
-        range_start=0, range_end=None, best_match=longest_unique_subsequence, **kwargs):
+        range_start=0, range_end=None, best_match=longest_unique_subsequence,
+        token_index=None, max_context_length=None, **kwargs):
     """Given a labelled section in a template, identify a similar region
     in the extracted tokens.
 
@@ -136,15 +633,50 @@ def similar_region(extracted_tokens, template_tokens, labelled_region,
     suffix. If there is no unique match, (0, None, None) will be returned.
 
     start_index and end_index specify a range in which the match must begin
+
+    token_index is a TokenContext of extracted_tokens, like its TokenIndex
+    or TokenText, used to find the matches instead of best_match when given.
+    best_match must then be longest_unique_subsequence or
+    first_longest_subsequence.
+
+    max_context_length limits the number of prefix and suffix tokens
+    compared at first. The comparison stops there once the best match is
+    unique, longer than the runner-up, so it is the one found without the
+    limit and each match is found in time linear in the range size. Only
+    while several candidates match the whole compared prefix or suffix is
+    the limit doubled and the comparison repeated, so the region found is
+    always the one found without the limit. Scores count the tokens
+    compared.
     """
     data_length = len(extracted_tokens)
     if range_end is None:
         range_end = data_length
+    first = best_match is first_longest_subsequence
+    if token_index is None:
+        first_match = partial(first_longest_subsequence, extracted_tokens)
+        first_reverse_match = partial(first_longest_subsequence,
+                                      extracted_tokens[::-1])
+        best_reverse_match = partial(best_match, extracted_tokens[::-1])
+        best_match = partial(best_match, extracted_tokens)
+    else:
+        first_match = token_index.first_longest_subsequence
+        first_reverse_match = token_index.reverse.first_longest_subsequence
+        if first:
+            best_match = first_match
+            best_reverse_match = first_reverse_match
+        else:
+            best_match = token_index.longest_unique_subsequence
+            best_reverse_match = token_index.reverse.longest_unique_subsequence
+    if max_context_length is not None:
+        best_match = partial(_limited_match, best_match, first_match, first,
+                             max_context_length)
+        best_reverse_match = partial(_limited_match, best_reverse_match,
+                                     first_reverse_match, first,
+                                     max_context_length)
     # calculate the prefix score by finding a longest subsequence in
     # reverse order
     reverse_prefix = template_tokens[labelled_region.start_index::-1]
-    reverse_tokens = extracted_tokens[::-1]
-    (rpi, pscore) = best_match(reverse_tokens, reverse_prefix,
+    (rpi, pscore) = best_reverse_match(reverse_prefix,
             data_length - range_end, data_length - range_start)
 
     # None means nothing extracted. Index 0 means there cannot be a suffix.
@@ -163,8 +695,7 @@ def similar_region(extracted_tokens, template_tokens, labelled_region,
 
     # if it's not a paired tag, use the best match between prefix & suffix
     if labelled_region.start_index == labelled_region.end_index:
-        (match_index, sscore) = best_match(extracted_tokens,
-            suffix, prefix_index, range_end)
+        (match_index, sscore) = best_match(suffix, prefix_index, range_end)
         if match_index == prefix_index:
             return (pscore + sscore, prefix_index, match_index)
         elif pscore > sscore:
@@ -175,8 +706,7 @@ def similar_region(extracted_tokens, template_tokens, labelled_region,
 
     # calculate the suffix match on the tokens following the prefix. We could
     # consider the whole page and require a good match.
-    (match_index, sscore) = best_match(extracted_tokens,
-            suffix, prefix_index + 1, range_end)
+    (match_index, sscore) = best_match(suffix, prefix_index + 1, range_end)
     if match_index is None:
         return 0, None, None
     return (pscore + sscore, prefix_index, match_index)
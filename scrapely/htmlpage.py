@@ -5,27 +5,53 @@ Container objects for representing html pages and their parts in the IBL
 system. This encapsulates page related information and prevents parsing
 multiple times.
 """
+import codecs
 import hashlib
 import six
+import numpy as np
 
+from six.moves import xrange
 from six.moves.urllib.request import urlopen
 from copy import deepcopy
 from w3lib.encoding import html_to_unicode
 try:
     from . import _htmlpage
-    parse_html = _htmlpage.parse_html
+    _parse_html_columns = _htmlpage.parse_html_columns
+    _pair_tags = _htmlpage.pair_tags
+    _tag_tokens = _htmlpage.tag_tokens
+    HtmlParser = _htmlpage.HtmlParser
     HtmlDataFragment = _htmlpage.HtmlDataFragment
     HtmlTag = _htmlpage.HtmlTag
     HtmlTagType = _htmlpage.HtmlTagType
+    HtmlFragmentKind = _htmlpage.HtmlFragmentKind
+    FrozenAttributes = _htmlpage.FrozenAttributes
+    parse_attributes = _htmlpage.parse_attributes
+    set_attributes_cache = _htmlpage.set_attributes_cache
+    # identifies the parser output for scrapely.parsecache, change it
+    # whenever the output changes
+    PARSER_VERSION = 'cython-1'
+    # pages created from bytes are parsed without decoding them
+    _PARSE_BYTES = True
 except ImportError:
     import re
     from collections import OrderedDict
 
+    PARSER_VERSION = 'python-1'
+    # the regular expressions may take bytes outside ASCII as part of tag
+    # names where the characters they encode are not, so pages created from
+    # bytes are decoded
+    _PARSE_BYTES = False
+
     class HtmlTagType(object):
         OPEN_TAG = 1
         CLOSE_TAG = 2
         UNPAIRED_TAG = 3
 
+    class HtmlFragmentKind(object):
+        DATA = 0
+        TEXT = 1
+        TAG = 2
+
     class HtmlDataFragment(object):
         __slots__ = ('start', 'end', 'is_text_content')
 
@@ -58,13 +84,7 @@ except ImportError:
         @property
         def attributes(self):
             if not self._attributes and self._attr_text:
-                for attr_match in _ATTR_REGEXP.findall(self._attr_text):
-                    name = attr_match[0].lower()
-                    values = [v for v in attr_match[1:] if v]
-                    # According to HTML spec if attribute name is repeated only
-                    # the first one is taken into account
-                    if name not in self._attributes:
-                        self._attributes[name] = values[0] if values else None
+                self._attributes = _tag_attributes(self._attr_text)
             return self._attributes
 
         def __str__(self):
@@ -77,6 +97,67 @@ except ImportError:
         def __repr__(self):
             return str(self)
 
+    class FrozenAttributes(dict):
+        """Read only attributes shared by the tags with the same attribute
+        text
+        """
+
+        def _readonly(self, *args, **kwargs):
+            raise TypeError("shared tag attributes can't be modified")
+
+        __setitem__ = __delitem__ = _readonly
+        clear = pop = popitem = setdefault = update = _readonly
+
+        def __reduce__(self):
+            return (FrozenAttributes, (dict(self),))
+
+        def __copy__(self):
+            return self
+
+        def __deepcopy__(self, memo):
+            return self
+
+    _attributes_cache = {}
+    _attributes_cache_size = 0
+
+    def set_attributes_cache(maxsize):
+        """Share the attributes of tags with identical attribute text
+
+        The attributes of up to `maxsize` distinct attribute texts are kept,
+        the cache is emptied when it is full. Tags then return the same read
+        only FrozenAttributes mapping. A `maxsize` of 0, the default, disables
+        it.
+        """
+        global _attributes_cache_size
+        _attributes_cache.clear()
+        _attributes_cache_size = maxsize
+
+    def _tag_attributes(attr_text):
+        if _attributes_cache_size <= 0:
+            return parse_attributes(attr_text)
+        attributes = _attributes_cache.get(attr_text)
+        if attributes is None:
+            if len(_attributes_cache) >= _attributes_cache_size:
+                _attributes_cache.clear()
+            attributes = FrozenAttributes(parse_attributes(attr_text))
+            _attributes_cache[attr_text] = attributes
+        return attributes
+
+    def parse_attributes(attr_text):
+        """Parse the attribute text of a tag into a dict
+
+        Names are lowercased and, according to the HTML spec, only the first
+        of repeated attributes is taken into account. Attributes without a
+        value, or with an empty one, are None.
+        """
+        attributes = OrderedDict()
+        for attr_match in _ATTR_REGEXP.findall(attr_text):
+            name = attr_match[0].lower()
+            values = [v for v in attr_match[1:] if v]
+            if name not in attributes:
+                attributes[name] = values[0] if values else None
+        return attributes
+
     _ATTR = ("((?:[^=/<>\s]|/(?!>))+)(?:\s*=(?:\s*\"(.*?)\"|\s*'(.*?)'|"
              "([^>\s]+))?)?")
     _TAG = "<(\/?)(\w+(?::\w+)?)((?:\s*" + _ATTR + ")+\s*|\s*)(\/?)>?"
@@ -90,63 +171,324 @@ except ImportError:
     _DOCTYPE_REGEXP = re.compile("(?:%s)" % _DOCTYPE)
     _COMMENT_REGEXP = re.compile(_COMMENT, re.DOTALL)
 
-    def parse_html(text):
-        """Higher level html parser. Calls lower level parsers and joins successive
-        HtmlDataFragment elements in a single one.
+    _COMMENT_CLOSE_REGEXP = re.compile("--!?>")
+
+    _ASCII = getattr(re, 'ASCII', 0)
+    _NON_ASCII_REGEXP = re.compile(u'[^\x00-\x7f]')
+    _SPACE_CHARS = None
+
+    def _raw_spaces(encoding, _cache={}):
+        """The byte sequences of `encoding` standing for whitespace outside
+        ASCII, as text holding their bytes one per character
         """
-        # If have doctype remove it.
-        start_pos = 0
-        match = _DOCTYPE_REGEXP.match(text)
-        if match:
-            start_pos = match.end()
-        prev_end = start_pos
-        for match in _HTML_REGEXP.finditer(text, start_pos):
-            start = match.start()
-            end = match.end()
+        global _SPACE_CHARS
+        try:
+            return _cache[encoding]
+        except KeyError:
+            pass
+        if _SPACE_CHARS is None:
+            # all the whitespace characters are in the BMP
+            _SPACE_CHARS = [c for c in map(six.unichr, xrange(128, 0x10000))
+                            if c.isspace()]
+        sequences = set()
+        # encoded after another character, so that no byte order mark is added
+        prefix = u'a'.encode(encoding)
+        for char in _SPACE_CHARS:
+            try:
+                data = (u'a' + char).encode(encoding)
+            except UnicodeError:
+                continue
+            if data.startswith(prefix):
+                sequences.add(data[len(prefix):])
+        for x in xrange(128, 256):
+            data = six.int2byte(x)
+            if data.decode(encoding, 'replace').isspace():
+                sequences.add(data)
+        spaces = _cache[encoding] = sorted(
+            (codecs.latin_1_decode(data)[0] for data in sequences if data),
+            key=len, reverse=True)
+        return spaces
+
+    def _raw_html_regexp(encoding, _cache={}):
+        """_HTML_REGEXP for text holding the raw bytes of `encoding` one per
+        character
+
+        The bytes of whitespace characters separate the markup as the
+        characters do, any other byte outside ASCII may be part of a tag
+        name.
+        """
+        try:
+            return _cache[encoding]
+        except KeyError:
+            pass
+        spaces = u'|'.join(re.escape(space) for space in _raw_spaces(encoding))
+        not_space = u'(?!%s)' % spaces if spaces else u''
+        # \s of text also matches \x1c-\x1f, unlike \s with the ASCII flag
+        space = u'[\\s\\x1c-\\x1f]'
+        replacements = {
+            u'\\s': u'(?:%s|%s)' % (space, spaces) if spaces else space,
+            u'\\w': u'(?:\\w|%s[\\x80-\\xff])' % not_space,
+            u'[^=/<>\\s]': u'(?:%s[^=/<>\\s\\x1c-\\x1f])' % not_space,
+            u'[^>\\s]': u'(?:%s[^>\\s\\x1c-\\x1f])' % not_space,
+        }
+        tag = re.sub(u'|'.join(map(re.escape, replacements)),
+                     lambda match: replacements[match.group()], _TAG)
+        regexp = _cache[encoding] = re.compile(
+            u"%s|%s|%s" % (_COMMENT, _SCRIPT, tag), re.I | re.DOTALL | _ASCII)
+        return regexp
+
+    class _FragmentColumns(object):
+        """Growable columns for the fragments found by the parser"""
+
+        def __init__(self):
+            self.starts, self.ends, self.kinds = [], [], []
+            self.tag_types, self.tag_ids = [], []
+            self.tag_name_ids, self.tag_names, self.attr_texts = {}, [], []
+
+        def __len__(self):
+            return len(self.starts)
+
+        def add(self, kind, start, end, tag_type=0, tag=None, attr_text=None):
+            if kind == HtmlFragmentKind.TAG:
+                tag_id = self.tag_name_ids.get(tag)
+                if tag_id is None:
+                    tag_id = self.tag_name_ids[tag] = len(self.tag_names)
+                    self.tag_names.append(tag)
+            else:
+                tag_id = -1
+            self.starts.append(start)
+            self.ends.append(end)
+            self.kinds.append(kind)
+            self.tag_types.append(tag_type)
+            self.tag_ids.append(tag_id)
+            self.attr_texts.append(attr_text)
+
+        def columns(self):
+            return (np.array(self.starts, dtype=np.int32),
+                    np.array(self.ends, dtype=np.int32),
+                    np.array(self.kinds, dtype=np.uint8),
+                    np.array(self.tag_types, dtype=np.int8),
+                    np.array(self.tag_ids, dtype=np.int32),
+                    list(self.tag_names), list(self.attr_texts))
+
+    class HtmlParser(object):
+        """Incremental html parser
+
+        Text is passed in chunks to feed(). A match of the html regular
+        expression is only accepted once the text received guarantees that
+        more text cannot change it, so close() returns the same columns as
+        parsing the whole text at once.
+
+        If `encoding` is given, feed() takes bytes in that encoding instead,
+        which must be ASCII compatible. The markup is parsed on the bytes,
+        fragment offsets are byte offsets and only tag names and attributes
+        are decoded. The byte sequences of whitespace characters separate
+        the markup like the characters do, but other bytes outside ASCII may
+        be taken as part of tag names, even when they encode symbols.
+        """
+
+        def __init__(self, encoding=None):
+            self.encoding = encoding
+            self._regexp = _HTML_REGEXP if encoding is None \
+                else _raw_html_regexp(encoding)
+            self.parsed = _FragmentColumns()
+            self._buffer = u''
+            self._offset = 0  # position of the buffer in the document
+            self._doctype_checked = False
+
+        def __len__(self):
+            """Number of fragments completed so far"""
+            return len(self.parsed)
+
+        def columns(self):
+            """Columns of the fragments completed so far"""
+            return self.parsed.columns()
+
+        def feed(self, text):
+            """Parse the next chunk of text (or bytes if the parser has an
+            encoding), returning the number of fragments completed so far
+            """
+            if self.encoding is not None:
+                # one character per byte, so offsets are byte offsets
+                text = codecs.latin_1_decode(text)[0]
+            self._buffer += text
+            self._parse(final=False)
+            return len(self.parsed)
 
+        def close(self):
+            """Finish parsing, returning the columns of all the fragments"""
+            self._parse(final=True)
+            return self.parsed.columns()
+
+        def _parse(self, final):
+            text = self._buffer
+            prev_end = 0
+            if not self._doctype_checked:
+                # If have doctype remove it.
+                match = _DOCTYPE_REGEXP.match(text)
+                if match:
+                    prev_end = match.end()
+                elif not final and _may_start_doctype(text):
+                    return
+                self._doctype_checked = True
+            # accepting a match is only safe when every scan for a closing
+            # quote, '>' or comment end made while matching stops inside
+            # the text received
+            last_gt = text.rfind('>')
+            last_dquote = text.rfind('"')
+            last_squote = text.rfind("'")
+            comment_close = None
+            for match in self._regexp.finditer(text, prev_end):
+                start, end = match.span()
+                if not final:
+                    if end >= len(text) or end > last_gt:
+                        break
+                    if match.groups()[0] is None and match.groups()[1] is None:
+                        # a tag can only be an unclosed <script> while its
+                        # closing tag has not been received
+                        if text[start:start + 7].lower() == '<script':
+                            break
+                        tag_text = text[start:end]
+                        if ('"' in tag_text and last_dquote < end or
+                                "'" in tag_text and last_squote < end):
+                            break
+                    if '<!--' in text[prev_end:start]:
+                        if comment_close is None or comment_close < end:
+                            comment_close = _last_match_start(
+                                _COMMENT_CLOSE_REGEXP, text)
+                        if comment_close < end:
+                            break
+                self._add_match(text, prev_end, match)
+                prev_end = end
+            else:
+                if final and prev_end < len(text):
+                    self._add_data(prev_end, len(text), True)
+                    prev_end = len(text)
+            self._buffer = text[prev_end:]
+            self._offset += prev_end
+
+        def _add_data(self, start, end, is_text_content=False):
+            kind = HtmlFragmentKind.TEXT if is_text_content \
+                else HtmlFragmentKind.DATA
+            self.parsed.add(kind, self._offset + start, self._offset + end)
+
+        def _add_match(self, text, prev_end, match):
+            start = match.start()
             if start > prev_end:
-                yield HtmlDataFragment(prev_end, start, True)
+                self._add_data(prev_end, start, True)
 
             if match.groups()[0] is not None:  # comment
-                yield HtmlDataFragment(start, end)
+                self._add_data(start, match.end())
             elif match.groups()[1] is not None:  # <script>...</script>
-                for e in _parse_script(match):
-                    yield e
+                for e in _parse_script(match, self._offset, self.encoding):
+                    self.parsed.add(*e)
             else:  # tag
-                yield _parse_tag(match)
-            prev_end = end
-        textlen = len(text)
-        if prev_end < textlen:
-            yield HtmlDataFragment(prev_end, textlen, True)
+                self.parsed.add(*_parse_tag(match, self._offset,
+                                            self.encoding))
+
+    def _may_start_doctype(text):
+        """True if more text could make `text` start with a doctype"""
+        if len(text) < 9:
+            return '<!DOCTYPE'.startswith(text)
+        return text.startswith('<!DOCTYPE') and '\n' not in text
+
+    def _last_match_start(regexp, text):
+        last = -1
+        for m in regexp.finditer(text):
+            last = m.start()
+        return last
+
+    def _parse_html_columns(text, encoding=None):
+        """Parse the html in `text` returning its fragments as parallel
+        columns. See HtmlParsedBody.
+        """
+        parser = HtmlParser(encoding)
+        parser.feed(text)
+        return parser.close()
+
+    def _pair_tags(tag_types, tag_ids, name_count):
+        """Match the open and close tags of a parsed body, returning the
+        arrays (matches, depths). See HtmlParsedBody.
+        """
+        size = len(tag_types)
+        matches = [-1] * size
+        depths = [0] * size
+        last_open = [-1] * name_count
+        previous = [-1] * size
+        for i, (tag_type, tag_id) in enumerate(zip(tag_types.tolist(),
+                                                   tag_ids.tolist())):
+            if tag_type == HtmlTagType.OPEN_TAG:
+                previous[i] = last_open[tag_id]
+                last_open[tag_id] = i
+            elif tag_type == HtmlTagType.CLOSE_TAG:
+                j = last_open[tag_id]
+                if j >= 0:
+                    matches[i] = j
+                    matches[j] = i
+                    last_open[tag_id] = previous[j]
+        depth = 0
+        for i, j in enumerate(matches):
+            if j > i:
+                depths[i] = depth
+                depth += 1
+            elif j >= 0:
+                depth -= 1
+                depths[i] = depth
+            else:
+                depths[i] = depth
+        return (np.array(matches, dtype=np.int32),
+                np.array(depths, dtype=np.int32))
+
+    def _tag_tokens(kinds, tag_types, tag_ids, tag_names, tokenid):
+        """Tokens of the tags of a parsed body and their positions. See
+        HtmlParsedBody.tag_tokens.
+        """
+        indexes = np.flatnonzero(kinds == HtmlFragmentKind.TAG)
+        keys = tag_ids[indexes].astype(np.int64) * 4 + tag_types[indexes]
+        keys, first, inverse = np.unique(keys, return_index=True,
+                                         return_inverse=True)
+        tokens = np.empty(len(keys), dtype=np.int32)
+        for i in np.argsort(first).tolist():
+            tag_id, tag_type = divmod(int(keys[i]), 4)
+            tokens[i] = tokenid(tag_names[tag_id], tag_type)
+        return tokens[inverse.ravel()], indexes.astype(np.int32)
+
+    def _data_fragment(start, end, is_text_content=False):
+        kind = HtmlFragmentKind.TEXT if is_text_content else HtmlFragmentKind.DATA
+        return kind, start, end
 
-    def _parse_script(match):
+    def _decode_raw(text, encoding):
+        """Decode text holding the raw bytes of `encoding` one per character"""
+        if encoding is None or not _NON_ASCII_REGEXP.search(text):
+            return text
+        return text.encode('latin-1').decode(encoding, 'replace')
+
+    def _parse_script(match, offset=0, encoding=None):
         """parse a <script>...</script> region matched by _HTML_REGEXP"""
         open_text, content, close_text = match.groups()[1:4]
 
-        open_tag = _parse_tag(_HTML_REGEXP.match(open_text))
-        open_tag.start = match.start()
-        open_tag.end = match.start() + len(open_text)
+        open_start = offset + match.start()
+        open_end = open_start + len(open_text)
+        open_tag = _parse_tag(match.re.match(open_text), open_start, encoding)
 
-        close_tag = _parse_tag(_HTML_REGEXP.match(close_text))
-        close_tag.start = match.end() - len(close_text)
-        close_tag.end = match.end()
+        close_start = offset + match.end() - len(close_text)
+        close_tag = _parse_tag(match.re.match(close_text), close_start,
+                               encoding)
 
         yield open_tag
-        if open_tag.end < close_tag.start:
+        if open_end < close_start:
             start_pos = 0
             for m in _COMMENT_REGEXP.finditer(content):
                 if m.start() > start_pos:
-                    yield HtmlDataFragment(
-                        open_tag.end + start_pos, open_tag.end + m.start())
-                yield HtmlDataFragment(
-                    open_tag.end + m.start(), open_tag.end + m.end())
+                    yield _data_fragment(
+                        open_end + start_pos, open_end + m.start())
+                yield _data_fragment(open_end + m.start(), open_end + m.end())
                 start_pos = m.end()
-            if open_tag.end + start_pos < close_tag.start:
-                yield HtmlDataFragment(
-                    open_tag.end + start_pos, close_tag.start)
+            if open_end + start_pos < close_start:
+                yield _data_fragment(open_end + start_pos, close_start)
         yield close_tag
 
-    def _parse_tag(match):
+    def _parse_tag(match, offset=0, encoding=None):
         """
         parse a tag matched by _HTML_REGEXP
         """
@@ -161,8 +503,175 @@ except ImportError:
                 tag_type = HtmlTagType.UNPAIRED_TAG
             else:
                 tag_type = HtmlTagType.OPEN_TAG
-            return HtmlTag(tag_type, tag.lower(), attr_text, match.start(),
-                           match.end())
+            return (HtmlFragmentKind.TAG, offset + match.start(),
+                    offset + match.end(), tag_type,
+                    _decode_raw(tag, encoding).lower(),
+                    _decode_raw(attr_text, encoding))
+
+
+_parse_cache = None
+
+
+def set_parse_cache(cache):
+    """Parse the bodies of HtmlPage objects through `cache`, a
+    scrapely.parsecache.ParseCache, or without a cache if it is None
+    """
+    global _parse_cache
+    _parse_cache = cache
+
+
+def parse_html(text, encoding=None):
+    """Parse the html in `text` into an HtmlParsedBody
+
+    If `encoding` is given `text` are bytes in that encoding, which must be
+    ASCII compatible, and the fragment offsets are byte offsets.
+    """
+    return HtmlParsedBody(*_parse_html_columns(text, encoding))
+
+
+class HtmlParsedBody(object):
+    """The fragments of a parsed html document, stored by columns
+
+    Each fragment is described by the entries at the same position of these
+    arrays:
+        starts, ends - offsets of the fragment in the document
+        kinds - HtmlFragmentKind of the fragment
+        tag_types - HtmlTagType of tags, 0 for data fragments
+        tag_ids - index of the tag name in tag_names, -1 for data fragments
+        attr_texts - raw attribute text of tags, None for data fragments
+
+    The matches and depths arrays are computed on first access. matches holds
+    the position of the tag paired with each tag, -1 for unpaired tags and
+    data fragments. A close tag is paired with the last unpaired open tag of
+    the same name, so malformed html gives pairs that may overlap. depths
+    holds the number of pairs enclosing each fragment.
+
+    It is also a read only sequence of HtmlDataFragment and HtmlTag objects.
+    These are created on first access and reused afterwards, so pages whose
+    fragments are never requested do not allocate them.
+
+    The columns are never modified, deep copies share them and only create
+    their own fragment objects.
+    """
+
+    def __init__(self, starts, ends, kinds, tag_types, tag_ids, tag_names,
+                 attr_texts):
+        self.starts = _readonly(starts)
+        self.ends = _readonly(ends)
+        self.kinds = _readonly(kinds)
+        self.tag_types = _readonly(tag_types)
+        self.tag_ids = _readonly(tag_ids)
+        self.tag_names = tag_names
+        self.attr_texts = attr_texts
+        self._fragments = {}
+        self._pairs = None
+
+    def __deepcopy__(self, memo):
+        parsed = HtmlParsedBody(self.starts, self.ends, self.kinds,
+                                self.tag_types, self.tag_ids, self.tag_names,
+                                self.attr_texts)
+        parsed._pairs = self._pairs
+        return parsed
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        fragment = self._fragments.get(index)
+        if fragment is None:
+            if not 0 <= index < len(self):
+                raise IndexError("parsed body index out of range")
+            fragment = self._fragments[index] = self._create_fragment(index)
+        return fragment
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _create_fragment(self, index):
+        start = int(self.starts[index])
+        end = int(self.ends[index])
+        kind = self.kinds[index]
+        if kind == HtmlFragmentKind.TAG:
+            return HtmlTag(int(self.tag_types[index]),
+                           self.tag_names[self.tag_ids[index]],
+                           self.attr_texts[index], start, end)
+        return HtmlDataFragment(start, end,
+                                bool(kind == HtmlFragmentKind.TEXT))
+
+    def index(self, fragment):
+        """Position of the given fragment. Fragments are sorted by their start
+        offset, so this does not need to scan the document.
+        """
+        i = int(np.searchsorted(self.starts, fragment.start))
+        if i < len(self) and self[i] is fragment:
+            return i
+        raise ValueError("%r is not in parsed body" % (fragment,))
+
+    def _get_pairs(self):
+        if self._pairs is None:
+            self._pairs = tuple(_readonly(a) for a in _pair_tags(
+                self.tag_types, self.tag_ids, len(self.tag_names)))
+        return self._pairs
+
+    matches = property(lambda x: x._get_pairs()[0])
+    depths = property(lambda x: x._get_pairs()[1])
+
+    def tag_indexes(self):
+        """Array with the positions of all the tags"""
+        return np.flatnonzero(self.kinds == HtmlFragmentKind.TAG)
+
+    def tag_tokens(self, tokenid):
+        """int32 arrays (tokens, indexes) with the token of each tag, given by
+        tokenid(tag_name, tag_type), and its position. tokenid is only called
+        once for each distinct tag name and type, in the order they first
+        appear.
+        """
+        return _tag_tokens(self.kinds, self.tag_types, self.tag_ids,
+                           self.tag_names, tokenid)
+
+    def replace(self, index, parsed, length):
+        """Parsed body of the document where the fragment at `index` has been
+        replaced by `length` characters of new text, whose fragments are
+        `parsed`. Later fragments are shifted by the change in length.
+        """
+        start = int(self.starts[index])
+        shift = length - (int(self.ends[index]) - start)
+        tag_names = list(self.tag_names)
+        tag_name_ids = dict((name, i) for i, name in enumerate(tag_names))
+        name_ids = []
+        for name in parsed.tag_names:
+            if name not in tag_name_ids:
+                tag_name_ids[name] = len(tag_names)
+                tag_names.append(name)
+            name_ids.append(tag_name_ids[name])
+        tag_ids = np.array(parsed.tag_ids, dtype=self.tag_ids.dtype)
+        is_tag = tag_ids >= 0
+        tag_ids[is_tag] = np.array(name_ids, dtype=tag_ids.dtype)[tag_ids[is_tag]]
+
+        def splice(column, new):
+            return np.concatenate((column[:index], new, column[index + 1:]))
+
+        starts = splice(self.starts, parsed.starts + start)
+        ends = splice(self.ends, parsed.ends + start)
+        starts[index + len(parsed):] += shift
+        ends[index + len(parsed):] += shift
+        attr_texts = list(self.attr_texts)
+        attr_texts[index:index + 1] = list(parsed.attr_texts)
+        return HtmlParsedBody(
+            starts, ends, splice(self.kinds, parsed.kinds),
+            splice(self.tag_types, parsed.tag_types),
+            splice(self.tag_ids, tag_ids), tag_names, attr_texts)
+
+
+def _readonly(array):
+    array = array.view()
+    array.flags.writeable = False
+    return array
 
 
 def url_to_page(url, encoding=None, default_encoding='utf-8'):
@@ -182,22 +691,135 @@ def url_to_page(url, encoding=None, default_encoding='utf-8'):
     """
     fh = urlopen(url)
     info = fh.info()
+    if encoding is not None:
+        # parse the page while it is being read
+        return HtmlPage.from_chunks(_iter_decoded(fh, encoding), fh.geturl(),
+                headers=dict(info.items()), encoding=encoding)
     body_str = fh.read()
     # guess content encoding if not specified
-    if encoding is None:
-        try:
-            # Python 3.x
-            content_type_header = fh.headers.get("content-type")
-        except AttributeError:
-            # Python 2.x
-            content_type_header = info.getheader("content-type")
-        encoding, body = html_to_unicode(content_type_header, body_str,
-                default_encoding=default_encoding)
-    else:
-        body = body_str.decode(encoding)
+    try:
+        # Python 3.x
+        content_type_header = fh.headers.get("content-type")
+    except AttributeError:
+        # Python 2.x
+        content_type_header = info.getheader("content-type")
+    encoding, body = html_to_unicode(content_type_header, body_str,
+            default_encoding=default_encoding)
     return HtmlPage(fh.geturl(), headers=dict(info.items()), body=body, encoding=encoding)
 
 
+def _iter_decoded(fh, encoding, chunk_size=64 * 1024):
+    """Read and decode the file-like object `fh` in chunks"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for data in iter(lambda: fh.read(chunk_size), b''):
+        yield decoder.decode(data)
+    yield decoder.decode(b'', True)
+
+
+_ASCII_SAMPLE = bytes(bytearray(range(128))) + \
+    b'\x1b$B<a>\x1b(B~{<a>~}\x0e<a>\x0f'
+
+
+def _is_ascii_compatible(encoding, _cache={}):
+    """True if the markup of pages in `encoding` can be parsed on the bytes
+
+    Every ASCII byte must stand for its ASCII character wherever it appears,
+    which excludes multibyte encodings whose sequences may contain ASCII bytes
+    and stateful ones switched by escape sequences.
+    """
+    try:
+        return _cache[encoding]
+    except KeyError:
+        pass
+    try:
+        codec = codecs.lookup(encoding)
+        compatible = (
+            codec.decode(_ASCII_SAMPLE, 'replace')[0] ==
+            _ASCII_SAMPLE.decode('ascii') and
+            len(codec.decode(bytes(bytearray(range(256))), 'replace')[0]) == 256)
+    except (LookupError, UnicodeError):
+        compatible = False
+    _cache[encoding] = compatible
+    return compatible
+
+
+def _is_utf8(encoding):
+    """True for utf-8 and utf-8-sig, the only ASCII compatible encodings
+    whose characters may take several bytes
+    """
+    try:
+        return codecs.lookup(encoding).name in ('utf-8', 'utf-8-sig')
+    except LookupError:
+        return False
+
+
+def _is_ascii(data):
+    try:
+        return data.isascii()
+    except AttributeError:  # python < 3.7
+        return not (np.frombuffer(data, dtype=np.uint8) >= 128).any()
+
+
+def _utf8_char_starts(units):
+    """Boolean array of the bytes of units, a uint8 array, that start a
+    character. None if they aren't valid utf-8, as decoding them then
+    replaces sequences of several bytes by one character.
+    """
+    size = len(units)
+    continuation = (units & 0xC0) == 0x80
+    lead2 = (units >= 0xC2) & (units <= 0xDF)
+    lead3 = (units & 0xF0) == 0xE0
+    lead4 = (units >= 0xF0) & (units <= 0xF4)
+    # the bytes that must be continuation bytes, beyond the end if missing
+    expected = np.zeros(size + 3, dtype=bool)
+    expected[1:size + 1] |= lead2 | lead3 | lead4
+    expected[2:size + 2] |= lead3 | lead4
+    expected[3:] |= lead4
+    starts = ~continuation
+    if (expected[size:].any() or
+            not np.array_equal(expected[:size], continuation) or
+            (starts & (units >= 0x80) & ~(lead2 | lead3 | lead4)).any()):
+        return None
+    # overlong forms, surrogates and characters beyond U+10FFFF
+    first, second = units[:-1], units[1:]
+    if (((first == 0xE0) & (second < 0xA0)) |
+            ((first == 0xED) & (second > 0x9F)) |
+            ((first == 0xF0) & (second < 0x90)) |
+            ((first == 0xF4) & (second > 0x8F))).any():
+        return None
+    return starts
+
+
+def _char_offsets(raw_body, encoding, parsed_body):
+    """parsed_body, the fragments of raw_body at byte offsets, with character
+    offsets instead, and the arrays (chars, positions) of the character and
+    byte offsets of the boundaries of the fragments
+    """
+    units = np.frombuffer(raw_body, dtype=np.uint8)
+    positions = np.unique(np.concatenate(
+        (parsed_body.starts, parsed_body.ends, [0, len(units)])))
+    starts = _utf8_char_starts(units)
+    if starts is not None:
+        counts = np.add.reduceat(starts, positions[:-1], dtype=np.intp)
+    else:
+        # the bytes replaced when decoding never include the ASCII characters
+        # around the boundaries, so the parts are decoded on their own
+        counts = [len(codecs.decode(raw_body[start:end], encoding, 'replace'))
+                  for start, end in zip(positions[:-1].tolist(),
+                                        positions[1:].tolist())]
+    chars = np.zeros(len(positions), dtype=np.intp)
+    np.cumsum(counts, out=chars[1:])
+
+    def char_offsets(offsets):
+        return chars[positions.searchsorted(offsets)].astype(np.int32)
+
+    parsed_body = HtmlParsedBody(
+        char_offsets(parsed_body.starts), char_offsets(parsed_body.ends),
+        parsed_body.kinds, parsed_body.tag_types, parsed_body.tag_ids,
+        parsed_body.tag_names, parsed_body.attr_texts)
+    return parsed_body, (chars, positions)
+
+
 def dict_to_page(jsonpage, body_key='body'):
     """Create an HtmlPage object from a dict object.
 
@@ -234,11 +856,20 @@ class HtmlPage(object):
     This is a parsed HTML page. It contains the page headers, url, raw body and parsed
     body.
 
-    The parsed body is a list of HtmlDataFragment objects.
+    The parsed body is a sequence of HtmlDataFragment objects, see
+    HtmlParsedBody. The body is only parsed the first time parsed_body is
+    accessed, so pages that are just stored or filtered are never parsed.
 
     The encoding argument is the original page encoding. This isn't used by the
     core extraction code, but it may be used by some extractors to translate
     entities or encoding urls.
+
+    Pages created with from_bytes may keep the undecoded body instead, see
+    body_slice. The offsets of the parsed body are character offsets in the
+    body for all pages.
+
+    Copies of a page share its body and parsed body, which is parsed once for
+    all of them, until a new body is set on one of them.
     """
     def __init__(self, url=None, headers=None, body=None, page_id=None, encoding='utf-8'):
         assert isinstance(body, six.text_type), "unicode expected, got: %s" % type(body).__name__
@@ -251,11 +882,137 @@ class HtmlPage(object):
         else:
             self.page_id = page_id
 
-    def _set_body(self, body):
-        self._body = body
-        self.parsed_body = list(parse_html(body))
+    @classmethod
+    def from_chunks(cls, chunks, url=None, headers=None, page_id=None,
+                    encoding='utf-8'):
+        """Create an HtmlPage from an iterable of unicode chunks of its body.
 
-    body = property(lambda x: x._body, _set_body, doc="raw html for the page")
+        Each chunk is parsed as soon as it is produced, so parsing overlaps
+        with reading the page.
+        """
+        parser = HtmlParser()
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            parser.feed(chunk)
+        page = cls(url, headers, u'', page_id, encoding)
+        page._set_body(u''.join(body), HtmlParsedBody(*parser.close()))
+        return page
+
+    @classmethod
+    def from_bytes(cls, body, encoding='utf-8', url=None, headers=None,
+                   page_id=None):
+        """Create an HtmlPage from the undecoded body, in `encoding`.
+
+        For ASCII compatible encodings, like utf-8 or the single byte ones,
+        the body is kept as bytes (bytes objects are not copied) and parsed
+        directly. Only the regions that are read, through body_slice,
+        fragment_data and the page regions, are decoded, until the whole body
+        is read. Other encodings, and utf-8 bodies starting with a byte order
+        mark, are decoded up front, as are all bodies when the compiled
+        parser is not available.
+
+        Fragment offsets are character offsets in the decoded body, as for
+        pages created from text: the byte offsets found by the parser are
+        converted after parsing, for the multibyte utf-8 encoding only.
+        """
+        page = cls(url, headers, u'', page_id, encoding)
+        body = body if isinstance(body, bytes) else bytes(body)
+        if (_PARSE_BYTES and _is_ascii_compatible(encoding) and not (
+                codecs.lookup(encoding).name == 'utf-8-sig' and
+                body.startswith(codecs.BOM_UTF8))):
+            page._set_raw_body(body)
+        else:
+            page._set_body(codecs.decode(body, encoding, 'replace'))
+        return page
+
+    def _set_body(self, body, parsed_body=None):
+        self._content = _PageContent(body, None, parsed_body)
+
+    def _set_raw_body(self, raw_body):
+        # byte offsets are character offsets unless characters take several
+        # bytes
+        offsets = None
+        if not _is_utf8(self.encoding) or _is_ascii(raw_body):
+            offsets = ()
+        self._content = _PageContent(None, raw_body, None, offsets)
+
+    _body = property(lambda x: x._content.body)
+    _raw_body = property(lambda x: x._content.raw_body)
+    _parsed_body = property(lambda x: x._content.parsed_body)
+
+    def _get_body(self):
+        content = self._content
+        if content.body is None:
+            content.body = self._decode(content.raw_body)
+        return content.body
+
+    body = property(_get_body, _set_body, doc="""raw html for the page
+
+        Pages keeping undecoded bytes decode the whole body the first time it
+        is accessed, use body_slice to read parts of it. The offsets of the
+        parsed body index this text.""")
+
+    def _decode(self, data):
+        return codecs.decode(data, self.encoding, 'replace')
+
+    def body_slice(self, start=0, end=None):
+        """Text of the body between the offsets used by the parsed body,
+        body[start:end], decoding only that part of undecoded bodies
+        """
+        content = self._content
+        if (content.body is not None or start < 0 or
+                end is not None and end < 0):
+            return self.body[start:end]
+        if content.offsets == ():
+            return self._decode(content.raw_body[start:end])
+        if content.offsets is None:
+            # the byte offsets are only known after parsing
+            return self.body[start:end]
+        chars, positions = content.offsets
+        # decode from the boundary at or before start to the one at or after
+        # end
+        first = max(chars.searchsorted(start, 'right') - 1, 0)
+        last = chars.searchsorted(end, 'left') if end is not None else \
+            len(chars)
+        byte_end = positions[last] if last < len(chars) else None
+        text = self._decode(content.raw_body[positions[first]:byte_end])
+        offset = chars[first]
+        return text[start - offset:end - offset if end is not None else None]
+
+    def _get_parsed_body(self):
+        content = self._content
+        if content.parsed_body is None:
+            content.parsed_body = self._parse_body()
+        return content.parsed_body
+
+    def _set_parsed_body(self, parsed_body):
+        content = self._content
+        # the offsets map characters of the body to bytes at any boundary, so
+        # they still apply to the new fragments
+        self._content = _PageContent(content.body, content.raw_body,
+                                     parsed_body, content.offsets)
+
+    parsed_body = property(_get_parsed_body, _set_parsed_body,
+        doc="""parsed fragments of the body, parsed when first accessed
+
+        Fragment offsets are character offsets in body, also for pages
+        created with from_bytes.""")
+
+    def _parse_body(self):
+        parse = parse_html if _parse_cache is None else _parse_cache.parse
+        parsed_body = parse(*self._parse_source())
+        content = self._content
+        if content.raw_body is not None and content.offsets != ():
+            parsed_body, content.offsets = _char_offsets(
+                content.raw_body, self.encoding, parsed_body)
+        return parsed_body
+
+    def _parse_source(self):
+        """The (text, encoding) arguments of parse_html for the body"""
+        if self._raw_body is not None:
+            return self._raw_body, self.encoding
+        return self._body, None
 
     def subregion(self, start=0, end=None):
         """HtmlPageRegion constructed from the start and end index (inclusive)
@@ -265,17 +1022,88 @@ class HtmlPage(object):
 
     def fragment_data(self, data_fragment):
         """portion of the body corresponding to the HtmlDataFragment"""
-        return self.body[data_fragment.start:data_fragment.end]
+        return self.body_slice(data_fragment.start, data_fragment.end)
+
+    def insert_attributes(self, index, text):
+        """Insert `text`, attribute markup, before the '>' that closes the tag
+        at `index`.
+
+        The body is not parsed again when the new tag parses the same way on
+        its own and the change can't affect other fragments, the new tag is
+        spliced into the parsed body instead. Close tags and script or style
+        tags, that end or start regions parsed differently, are always parsed
+        again with the whole body.
+        """
+        parsed_body = self.parsed_body
+        tag = parsed_body[index]
+        end = tag.end - 1
+        parsed = None
+        if (self._raw_body is None and
+                isinstance(parsed_body, HtmlParsedBody) and
+                tag.tag_type != HtmlTagType.CLOSE_TAG and
+                tag.tag not in (u'script', u'style') and
+                self._body[end] == u'>' and
+                _is_inert_attribute_text(self._body, text, tag.start)):
+            tag_text = self._body[tag.start:end] + text + u'>'
+            parsed = parse_html(tag_text)
+            if not (len(parsed) == 1 and parsed.ends[0] == len(tag_text) and
+                    isinstance(parsed[0], HtmlTag) and
+                    parsed[0].tag == tag.tag and
+                    parsed[0].tag_type == tag.tag_type):
+                parsed = None
+        body = self.body_slice(0, end) + text + self.body_slice(end)
+        if parsed is None:
+            self.body = body
+        else:
+            self._set_body(body, parsed_body.replace(index, parsed, len(tag_text)))
+
+
+class _PageContent(object):
+    """Body of an HtmlPage, shared with its copies
+
+    Only the body decoded from raw_body and parsed_body, with the offsets,
+    are set after creation, when they are first needed. Pages replace their
+    content instead of modifying it.
+
+    offsets are, for raw bodies, () when byte offsets are character offsets,
+    the arrays (chars, positions) of the character and byte offsets of the
+    fragment boundaries once parsed, and None before.
+    """
+
+    def __init__(self, body, raw_body, parsed_body, offsets=()):
+        self.body = body
+        self.raw_body = raw_body
+        self.parsed_body = parsed_body
+        self.offsets = offsets
+
+    def __deepcopy__(self, memo):
+        return _PageContent(self.body, self.raw_body,
+                            deepcopy(self.parsed_body, memo), self.offsets)
+
+
+def _is_inert_attribute_text(body, text, start):
+    """True if inserting `text` in the tag starting at `start` of `body` can't
+    change how anything else in the body is parsed.
+
+    The text can't hold characters that open or close markup and its quotes
+    must be paired and found later in the body: otherwise a quote left open
+    before the tag, that doesn't match any, could now match.
+    """
+    if u'<' in text or u'>' in text or text.endswith((u'-', u'!')):
+        return False
+    for quote in (u'"', u"'"):
+        count = text.count(quote)
+        if count % 2 or count and body.find(quote, start) < 0:
+            return False
+    return True
 
 
 class TextPage(HtmlPage):
     """An HtmlPage with one unique HtmlDataFragment, needed to have a
     convenient text with same interface as html page but avoiding unnecesary
     reparsing"""
-    def _set_body(self, text):
-        self._body = text
-        self.parsed_body = [HtmlDataFragment(0, len(self._body), True)]
-    body = property(lambda x: x._body, _set_body, doc="raw text for the page")
+    def _parse_body(self):
+        return [HtmlDataFragment(0, len(self._body), True)]
 
 
 class HtmlPageRegion(six.text_type):
@@ -303,11 +1131,13 @@ class HtmlPageParsedRegion(HtmlPageRegion):
     fragments contained within this region
     """
     def __new__(cls, htmlpage, start_index, end_index):
-        text = htmlpage.body
-        if text:
-            text_start = htmlpage.parsed_body[start_index].start
-            text_end = htmlpage.parsed_body[end_index or -1].end
-            text = htmlpage.body[text_start:text_end]
+        text = u''
+        # the body is checked without decoding it, empty bodies aren't parsed
+        if htmlpage._body or htmlpage._raw_body:
+            parsed_body = htmlpage.parsed_body
+            text_start = parsed_body[start_index].start
+            text_end = parsed_body[end_index or -1].end
+            text = htmlpage.body_slice(text_start, text_end)
 
         return HtmlPageRegion.__new__(cls, htmlpage, text)
 
@@ -335,7 +1165,7 @@ class HtmlPageParsedRegion(HtmlPageRegion):
     @property
     def text_content(self):
         """Text content of this parsed region"""
-        text_all = u" ".join(self.htmlpage.body[_element.start:_element.end] \
+        text_all = u" ".join(self.htmlpage.body_slice(_element.start, _element.end) \
                 for _element in self.parsed_fragments if \
                 not isinstance(_element, HtmlTag) and _element.is_text_content)
         return TextPage(self.htmlpage.url, self.htmlpage.headers, \
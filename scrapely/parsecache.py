@@ -0,0 +1,269 @@
+"""
+parsecache
+
+On-disk cache of parsed html bodies. Pages whose body has already been parsed
+are loaded back with mmap instead of being parsed again, which helps when a
+stored corpus is extracted many times with different templates. The tag
+tokens of extraction pages can be stored as well, see ParseCache.tag_tokens.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+
+import six
+import numpy as np
+
+from scrapely.htmlpage import HtmlParsedBody, parse_html, PARSER_VERSION
+
+_MAGIC = b'SPC1'
+# magic, fragment count, tag name count, size of the string data
+_HEADER = struct.Struct('<4siii')
+_TOKENS_MAGIC = b'STK1'
+# magic, token count
+_TOKENS_HEADER = struct.Struct('<4si')
+_ERRORS = 'surrogatepass' if six.PY3 else 'strict'
+# os.rename does not overwrite files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ParseCache(object):
+    """Cache of parsed bodies stored in `directory`
+
+    Entries are keyed by a hash of the body, its encoding when parsing bytes
+    and PARSER_VERSION, so results of other parser versions are never used.
+    Each entry is a file holding the fragment columns of HtmlParsedBody. When
+    the files take more than `max_size` bytes the least recently used ones
+    are removed.
+
+    Use it for every HtmlPage with scrapely.htmlpage.set_parse_cache or call
+    parse() directly.
+    """
+    suffix = '.parsed'
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def key(self, body, encoding=None, vocabulary=None):
+        """Hash identifying the parse of `body`, or its tag tokens when the
+        `vocabulary` version is given
+        """
+        digest = hashlib.sha1(PARSER_VERSION.encode('ascii') + _MAGIC)
+        if vocabulary is not None:
+            digest.update(_TOKENS_MAGIC + vocabulary.encode('ascii'))
+        if encoding is None:
+            digest.update(b'\0')
+            digest.update(body.encode('utf-8', _ERRORS))
+        else:
+            digest.update(b'\1' + encoding.encode('ascii') + b'\0')
+            digest.update(body)
+        return digest.hexdigest()
+
+    def parse(self, body, encoding=None):
+        """Same as parse_html(body, encoding), loading the result from the
+        cache when possible
+        """
+        path = os.path.join(self.directory, self.key(body, encoding) + self.suffix)
+        parsed = self._load(path, _loads)
+        if parsed is None:
+            parsed = parse_html(body, encoding)
+            self._store(path, _dumps(parsed))
+        return parsed
+
+    def tag_tokens(self, body, token_dict, encoding=None, parsed_body=None):
+        """Same as parse(body, encoding).tag_tokens(token_dict.tokenid),
+        loading the arrays from the cache when possible. `parsed_body` is the
+        parse of `body`, if already available.
+
+        Entries are also keyed by token_dict.version, so they are only used
+        with dictionaries giving the same ids to the tags. Dictionaries that
+        are not frozen change their version when they get new tokens.
+        """
+        version = token_dict.version
+        path = os.path.join(self.directory,
+                            self.key(body, encoding, version) + self.suffix)
+        tokens = self._load(path, _loads_tokens)
+        if tokens is None:
+            if parsed_body is None:
+                parsed_body = self.parse(body, encoding)
+            tokens = parsed_body.tag_tokens(token_dict.tokenid)
+            if token_dict.version != version:
+                # store them for the version they were created with
+                path = os.path.join(self.directory, self.key(
+                    body, encoding, token_dict.version) + self.suffix)
+            self._store(path, _dumps_tokens(*tokens))
+        return tokens
+
+    def clear(self):
+        """Remove all the entries"""
+        for _, _, path in self._entries():
+            _remove(path)
+        self._size = 0
+
+    def _load(self, path, loads):
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            result = loads(data)
+            # used entries are the last to be evicted
+            os.utime(path, None)
+        except (EnvironmentError, ValueError, struct.error):
+            return None
+        return result
+
+    def _store(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                replaced = os.path.getsize(path)
+            except EnvironmentError:
+                replaced = 0
+            _replace(tmp_path, path)
+        except EnvironmentError:
+            _remove(tmp_path)
+            return
+        self._size += len(data) - replaced
+        if self._size > self.max_size:
+            self._evict()
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except EnvironmentError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _evict(self):
+        # other processes may share the directory, so it is scanned again
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if _remove(path):
+                size -= entry_size
+        self._size = size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        return False
+    return True
+
+
+def _dumps(parsed):
+    """Serialize an HtmlParsedBody
+
+    After the header come the int32 arrays starts, ends, tag_ids, attr_starts
+    and attr_ends (the position of each attribute text in the string data,
+    -1 for fragments without it) and name_offsets (tag names are
+    data[name_offsets[i]:name_offsets[i + 1]]), then the int8 arrays kinds
+    and tag_types and finally the utf-8 string data.
+    """
+    size = len(parsed)
+    strings = [name.encode('utf-8', _ERRORS) for name in parsed.tag_names]
+    name_offsets = np.zeros(len(strings) + 1, dtype=np.int32)
+    name_offsets[1:] = np.cumsum([len(s) for s in strings])
+    offset = int(name_offsets[-1])
+    attr_starts = np.full(size, -1, dtype=np.int32)
+    attr_ends = np.full(size, -1, dtype=np.int32)
+    for i, attr_text in enumerate(parsed.attr_texts):
+        if attr_text is not None:
+            attr_text = attr_text.encode('utf-8', _ERRORS)
+            attr_starts[i] = offset
+            offset += len(attr_text)
+            attr_ends[i] = offset
+            strings.append(attr_text)
+    chunks = [_HEADER.pack(_MAGIC, size, len(parsed.tag_names), offset)]
+    for array, dtype in [(parsed.starts, np.int32), (parsed.ends, np.int32),
+                         (parsed.tag_ids, np.int32), (attr_starts, np.int32),
+                         (attr_ends, np.int32), (name_offsets, np.int32),
+                         (parsed.kinds, np.uint8), (parsed.tag_types, np.int8)]:
+        chunks.append(np.asarray(array, dtype=dtype).tobytes())
+    chunks.extend(strings)
+    return b''.join(chunks)
+
+
+def _loads(data):
+    """Load an HtmlParsedBody serialized by _dumps, the arrays are views of
+    `data`
+    """
+    magic, size, name_count, strings_size = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('not a parse cache entry')
+    offset = _HEADER.size
+    arrays = []
+    for dtype, count in [(np.int32, size), (np.int32, size),
+                         (np.int32, size), (np.int32, size),
+                         (np.int32, size), (np.int32, name_count + 1),
+                         (np.uint8, size), (np.int8, size)]:
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        arrays.append(array)
+    if offset + strings_size != len(data):
+        raise ValueError('truncated parse cache entry')
+    starts, ends, tag_ids, attr_starts, attr_ends, name_offsets, kinds, \
+        tag_types = arrays
+    name_offsets = (name_offsets + offset).tolist()
+    tag_names = [data[start:end].decode('utf-8', _ERRORS)
+                 for start, end in zip(name_offsets, name_offsets[1:])]
+    attr_texts = _MappedStrings(data, attr_starts, attr_ends, offset)
+    return HtmlParsedBody(starts, ends, kinds, tag_types, tag_ids, tag_names,
+                          attr_texts)
+
+
+def _dumps_tokens(tokens, indexes):
+    """Serialize tag tokens and their positions
+
+    After the header come the int32 arrays tokens and indexes.
+    """
+    return b''.join([_TOKENS_HEADER.pack(_TOKENS_MAGIC, len(tokens)),
+                     np.asarray(tokens, dtype=np.int32).tobytes(),
+                     np.asarray(indexes, dtype=np.int32).tobytes()])
+
+
+def _loads_tokens(data):
+    """Load the (tokens, indexes) arrays serialized by _dumps_tokens"""
+    magic, size = _TOKENS_HEADER.unpack_from(data)
+    if magic != _TOKENS_MAGIC:
+        raise ValueError('not a tag tokens cache entry')
+    offset = _TOKENS_HEADER.size
+    if offset + size * 8 != len(data):
+        raise ValueError('truncated tag tokens cache entry')
+    tokens = np.frombuffer(data, dtype=np.int32, count=size, offset=offset)
+    indexes = np.frombuffer(data, dtype=np.int32, count=size,
+                            offset=offset + size * 4)
+    return tokens, indexes
+
+
+class _MappedStrings(object):
+    """Sequence of the attribute texts of a cache entry, decoded when read"""
+
+    def __init__(self, data, starts, ends, offset):
+        self._data = data
+        self._starts = starts
+        self._ends = ends
+        self._offset = offset
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        start = int(self._starts[index])
+        if start < 0:
+            return None
+        start += self._offset
+        end = int(self._ends[index]) + self._offset
+        return self._data[start:end].decode('utf-8', _ERRORS)
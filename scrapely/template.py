@@ -1,7 +1,9 @@
 import copy
 import json
 
-from scrapely.htmlpage import HtmlTag, HtmlTagType
+from six.moves import xrange
+
+from scrapely.htmlpage import HtmlTag, HtmlTagType, HtmlParsedBody
 
 
 class AnnotationError(Exception):
@@ -60,7 +62,7 @@ class TemplateMaker(object):
         index
         """
         start_tag, end_tag = _enclosing_tags(self.htmlpage, index)
-        return self.htmlpage.body[start_tag.start:end_tag.end]
+        return self.htmlpage.body_slice(start_tag.start, end_tag.end)
 
     def annotations(self):
         """Return all annotations contained in the template as a list of tuples
@@ -76,7 +78,9 @@ class TemplateMaker(object):
         return anlist
 
     def annotate_fragment(self, index, field):
-        for f in self.htmlpage.parsed_body[index::-1]:
+        parsed_body = self.htmlpage.parsed_body
+        for i in xrange(index, -1, -1):
+            f = parsed_body[i]
             if isinstance(f, HtmlTag) and f.tag_type == HtmlTagType.OPEN_TAG:
                 if 'data-scrapy-annotate' in f.attributes:
                     fstr = self.htmlpage.fragment_data(f)
@@ -84,7 +88,7 @@ class TemplateMaker(object):
                 d = {'annotations': {'content': field}}
                 a = ' data-scrapy-annotate="%s"' % json.dumps(d).replace('"', '&quot;')
                 p = self.htmlpage
-                p.body = p.body[:f.end-1] + a + p.body[f.end-1:]
+                p.insert_attributes(i, a)
                 return True
         return False
 
@@ -107,28 +111,51 @@ def best_match(text):
 
 
 def _enclosing_tags(htmlpage, index):
-    f = htmlpage.parsed_body[index]
+    parsed_body = htmlpage.parsed_body
+    f = parsed_body[index]
     if isinstance(f, HtmlTag) and f.tag_type == HtmlTagType.UNPAIRED_TAG:
         return f, f
-    start_tag = end_tag = None
-    for f in htmlpage.parsed_body[index::-1]:
-        if isinstance(f, HtmlTag) and f.tag_type == HtmlTagType.OPEN_TAG:
-            start_tag = f
+    if not isinstance(parsed_body, HtmlParsedBody):
+        return _walk_enclosing_tags(parsed_body, index)
+    tag_types = parsed_body.tag_types
+    start_index = index
+    while start_index >= 0 and tag_types[start_index] != HtmlTagType.OPEN_TAG:
+        start_index -= 1
+    if start_index < 0:
+        raise FragmentNotFound("Unable to find start tag from index %d" % index)
+    end_index = int(parsed_body.matches[start_index])
+    if end_index < index:
+        # end tag not found or tag found is not enclosing, return the last
+        # fragment checked when searching it
+        f = parsed_body[end_index]
+        return f, f
+    return parsed_body[start_index], parsed_body[end_index]
+
+
+def _walk_enclosing_tags(parsed_body, index):
+    """Same as _enclosing_tags for parsed bodies given as lists of fragments,
+    whose tags are paired by walking the fragments
+    """
+    for start_index in xrange(index, -1, -1):
+        start_tag = parsed_body[start_index]
+        if (isinstance(start_tag, HtmlTag) and
+                start_tag.tag_type == HtmlTagType.OPEN_TAG):
             break
-    if not start_tag:
+    else:
         raise FragmentNotFound("Unable to find start tag from index %d" % index)
     tcount = 1
-    start_index = htmlpage.parsed_body.index(start_tag)
-    for f in htmlpage.parsed_body[start_index+1:]:
+    f = start_tag
+    for end_index in xrange(start_index + 1, len(parsed_body)):
+        f = parsed_body[end_index]
         if isinstance(f, HtmlTag) and f.tag == start_tag.tag:
             if f.tag_type == HtmlTagType.OPEN_TAG:
                 tcount += 1
             if f.tag_type == HtmlTagType.CLOSE_TAG:
                 tcount -= 1
                 if not tcount:
-                    end_tag = f
-                    break
-    if not end_tag or htmlpage.parsed_body.index(end_tag) < index:
-        # end tag not found or tag found is not enclosing
-        return f, f
-    return start_tag, end_tag
+                    if end_index < index:
+                        # the tag found is not enclosing
+                        return f, f
+                    return start_tag, f
+    # end tag not found, return the last fragment checked
+    return f, f
@@ -4,13 +4,20 @@ tests for page parsing
 Page parsing effectiveness is measured through the evaluation system. These
 tests should focus on specific bits of functionality work correctly.
 """
+import threading
 from unittest import TestCase
+
+import numpy as np
 from parameterized import parameterized
 
 from scrapely.htmlpage import HtmlPage
 from scrapely.descriptor import FieldDescriptor as A, ItemDescriptor
 from scrapely.extractors import contains_any_numbers, image_url, html, notags
-from scrapely.extraction import InstanceBasedLearningExtractor
+from scrapely.extraction import InstanceBasedLearningExtractor, TokenDict
+from scrapely.extraction.similarity import MatchPolicy, set_match_policy
+from scrapely.extraction.pageobjects import Page, AnnotationTag
+from scrapely.extraction.regionextract import (
+    TemplatePageExtractor, RepeatedDataExtractor)
 
 # simple page with all features
 
@@ -976,6 +983,17 @@ EXTRACT_PAGE32 = u"""
 </ul>
 """
 
+# the tokens just before the annotation are also before other text
+ANNOTATED_CONTEXT = u"""
+<h1>title</h1><div><p>x</p><span data-scrapy-annotate="{&quot;annotations&quot;:
+    {&quot;content&quot;: &quot;name&quot;}}">name</span></div><b>end</b>
+"""
+
+EXTRACT_CONTEXT = u"""
+<div><p>x</p><span>other</span></div><i>x</i>
+<h1>title</h1><div><p>x</p><span>the name</span></div><b>end</b>
+"""
+
 DEFAULT_DESCRIPTOR = ItemDescriptor('test',
         'item test, removes tags from description attribute',
         [A('description', 'description field without tags', notags)])
@@ -1288,6 +1306,24 @@ TEST_DATA = [
 ]
 
 
+# (name, extractor arguments, match policy) of ways to extract the pages of
+# TEST_DATA that must give the same results
+EXTRACTION_VARIANTS = [
+    # unknown tags do not get new tokens
+    ('frozen_token_dict', {'freeze_tokens': True}, None),
+    # use the index for the short test pages
+    ('indexed_pages', {'index_pages': True},
+     MatchPolicy(index_range_length=0)),
+    ('max_context_length', {'max_context_length': 20}, None),
+    ('indexed_max_context_length',
+     {'index_pages': True, 'max_context_length': 20}, None),
+    ('text_pages', {'text_pages': True}, None),
+    # also search the text when the compiled functions are available
+    ('text_search', {'text_pages': True}, MatchPolicy(text_search=True)),
+    ('kmp_matching', {}, MatchPolicy(kmp_pattern_length=0, kmp_spacing=1000)),
+]
+
+
 class TestExtraction(TestCase):
     @parameterized.expand(TEST_DATA)
     def test_extraction(self, name, templates, page, descriptor, expected_output):
@@ -1297,3 +1333,204 @@ class TestExtraction(TestCase):
         actual_output, _ = extractor.extract(HtmlPage(None, {}, page))
 
         self.assertEqual(expected_output, actual_output and actual_output[0])
+
+    @parameterized.expand([
+        (u'%s_%s' % (variant, data[0]), kwargs, policy) + tuple(data[1:])
+        for variant, kwargs, policy in EXTRACTION_VARIANTS
+        for data in TEST_DATA])
+    def test_extraction_variants(self, name, kwargs, policy, templates, page,
+                                 descriptor, expected_output):
+        """extraction is the same with other extractor options and match
+        policies"""
+        template_pages = [HtmlPage(None, {}, t) for t in templates]
+        set_match_policy(policy or MatchPolicy())
+        try:
+            extractor = InstanceBasedLearningExtractor(
+                [(t, descriptor) for t in template_pages], **kwargs)
+            token_ids = dict(extractor.token_dict.token_ids)
+            actual_output, _ = extractor.extract(HtmlPage(None, {}, page))
+        finally:
+            set_match_policy(MatchPolicy())
+        self.assertEqual(expected_output, actual_output and actual_output[0])
+        if kwargs.get('freeze_tokens'):
+            self.assertEqual(extractor.token_dict.token_ids, token_ids)
+
+    def test_shared_extraction_page(self):
+        """pages tokenized once are extracted by extractors sharing tokens"""
+        token_dict = TokenDict()
+        extractors = []
+        for name, templates, page, descriptor, expected_output in TEST_DATA[:4]:
+            template_pages = [HtmlPage(None, {}, t) for t in templates]
+            extractors.append(InstanceBasedLearningExtractor(
+                [(t, descriptor) for t in template_pages],
+                token_dict=token_dict))
+        for extractor, (name, _, page, _, expected_output) in zip(
+                extractors, TEST_DATA):
+            extraction_page = extractors[0].tokenize(HtmlPage(None, {}, page))
+            context = extraction_page.context()
+            actual_output, _ = extractor.extract(extraction_page)
+            self.assertEqual(expected_output,
+                             actual_output and actual_output[0], name)
+            # the structures derived from the tokens are built once
+            self.assertIs(extraction_page.context(), context)
+        other = InstanceBasedLearningExtractor([])
+        self.assertRaises(ValueError, other.extract, extraction_page)
+
+    def test_frozen_shared_token_dict(self):
+        """extractors can't add their template tokens to frozen dictionaries"""
+        name, templates, page, descriptor, expected_output = TEST_DATA[0]
+        template_pages = [(HtmlPage(None, {}, t), descriptor)
+                          for t in templates]
+        extractor = InstanceBasedLearningExtractor(
+            template_pages, freeze_tokens=True)
+        self.assertRaises(ValueError, InstanceBasedLearningExtractor,
+                          template_pages, token_dict=extractor.token_dict)
+
+    def test_text_pages_fallback(self):
+        """pages whose tokens cannot be encoded as text are still extracted"""
+        # the tokens of the templates get references too large to encode
+        token_dict = TokenDict([u'token%d' % i
+                                for i in range(TokenDict.TEXT_REFERENCES)])
+        extractor = InstanceBasedLearningExtractor(
+            [(HtmlPage(None, {}, ANNOTATED_PAGE4), DEFAULT_DESCRIPTOR)],
+            token_dict=token_dict, text_pages=True)
+        page = extractor.tokenize(HtmlPage(None, {}, EXTRACT_PAGE4))
+        actual_output, _ = extractor.extract(page)
+        self.assertEqual(actual_output[0],
+                         {'features': [u'feature1', u'feature2', u'feature3']})
+        self.assertIsNone(page.token_text)
+
+    def test_many_repeated_elements(self):
+        """all the repeated elements of long pages are extracted"""
+        features = [u'feature%d' % i for i in range(1000)]
+        page = u'<ul>\n%s</ul>' % u''.join(
+            u'<li>%s</li>\n' % feature for feature in features)
+        extractor = InstanceBasedLearningExtractor(
+            [(HtmlPage(None, {}, ANNOTATED_PAGE4), DEFAULT_DESCRIPTOR)])
+        for text_pages in (False, True):
+            extractor.text_pages = text_pages
+            actual_output, _ = extractor.extract(HtmlPage(None, {}, page))
+            self.assertEqual(actual_output[0], {'features': features})
+
+    def test_threads(self):
+        """pages can be extracted from several threads"""
+        extractors = []
+        for name, templates, page, descriptor, expected_output in TEST_DATA:
+            template_pages = [HtmlPage(None, {}, t) for t in templates]
+            extractors.append(InstanceBasedLearningExtractor(
+                [(t, descriptor) for t in template_pages], freeze_tokens=True))
+        results = {}
+
+        def extract(thread):
+            for i, (_, _, page, _, _) in enumerate(TEST_DATA):
+                output, _ = extractors[i].extract(HtmlPage(None, {}, page))
+                results[thread, i] = output and output[0]
+        threads = [threading.Thread(target=extract, args=(thread,))
+                   for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i, (name, _, _, _, expected_output) in enumerate(TEST_DATA):
+            for thread in range(4):
+                self.assertEqual(expected_output, results[thread, i], name)
+
+    def test_short_max_context_length(self):
+        """regions whose limited context matches elsewhere are still found"""
+        template = HtmlPage(None, {}, ANNOTATED_CONTEXT)
+        page = HtmlPage(None, {}, EXTRACT_CONTEXT)
+        # the 5 tokens before the annotation are the shortest unique prefix,
+        # shorter limits are extended
+        for max_context_length, expected_output in [
+                (None, {u'name': [u'the name']}),
+                (5, {u'name': [u'the name']}),
+                (4, {u'name': [u'the name']}),
+                (1, {u'name': [u'the name']})]:
+            for index_pages in (False, True):
+                extractor = InstanceBasedLearningExtractor(
+                    [(template, None)], index_pages=index_pages,
+                    max_context_length=max_context_length)
+                actual_output, _ = extractor.extract(page)
+                self.assertEqual(actual_output, [expected_output])
+        for max_context_length in (0, -1):
+            self.assertRaises(ValueError, InstanceBasedLearningExtractor,
+                              [(template, None)],
+                              max_context_length=max_context_length)
+            self.assertRaises(ValueError, TemplatePageExtractor, None, [],
+                              max_context_length)
+
+
+class _RegionRecorder(object):
+    """Extractor returning the (start, end) regions it is asked to extract"""
+
+    def __init__(self):
+        self.annotation = AnnotationTag(0, 1)
+
+    def extract(self, page, start_index, end_index, ignored_regions,
+                **kwargs):
+        return [(start_index, end_index)]
+
+
+def _greedy_regions(tokens, prefix, suffix, start_index, end_index):
+    """Regions found by scanning the tokens for a prefix, then for the first
+    suffix after it, and going on from that suffix"""
+    prefixlen, suffixlen = len(prefix), len(suffix)
+    index = max(0, start_index - prefixlen)
+    max_index = min(len(tokens) - suffixlen, end_index + suffixlen)
+    regions = []
+    while index <= max_index - prefixlen:
+        prefix_end = index + prefixlen
+        if list(tokens[index:prefix_end]) == prefix:
+            for peek in range(prefix_end, max_index + 1):
+                if list(tokens[peek:peek + suffixlen]) == suffix:
+                    regions.append((prefix_end - 1, peek))
+                    index = max(peek, index + 1)
+                    break
+            else:
+                break
+        else:
+            index += 1
+    return regions
+
+
+class TestRepeatedDataExtractor(TestCase):
+    """prefixes and suffixes are paired as by a greedy scan of the tokens"""
+
+    def _test_regions(self, tokens, prefix, suffix, start_index=0,
+                      end_index=None):
+        if end_index is None:
+            end_index = len(tokens)
+        page = Page(None, TokenDict(), tokens)
+        extractor = RepeatedDataExtractor(prefix, suffix, [_RegionRecorder()])
+        regions = extractor.extract(page, start_index, end_index, None)
+        self.assertEqual(regions, _greedy_regions(
+            tokens, prefix, suffix, start_index, end_index))
+        return regions
+
+    def test_prefix_without_suffix(self):
+        # the last prefix has no later suffix
+        regions = self._test_regions([1, 2, 5, 3, 1, 2, 5, 5], [1, 2], [3])
+        self.assertEqual(regions, [(1, 3)])
+
+    def test_overlapping_prefixes(self):
+        # prefixes overlap each other, several before the same suffix
+        regions = self._test_regions([1, 1, 1, 5, 3, 1, 1, 3], [1, 1], [3])
+        self.assertEqual(regions, [(1, 4), (6, 7)])
+
+    def test_back_to_back_records(self):
+        # the suffix of each record is the prefix of the next one
+        regions = self._test_regions([7, 1, 5, 1, 6, 1, 8, 1], [1], [1])
+        self.assertEqual(regions, [(1, 3), (3, 5), (5, 7)])
+        regions = self._test_regions([1, 2, 5, 3, 1, 2, 6, 3, 1, 2, 7, 3],
+                                     [1, 2], [3])
+        self.assertEqual(regions, [(1, 3), (5, 7), (9, 11)])
+
+    def test_random_tokens(self):
+        rng = np.random.RandomState(3)
+        for _ in range(300):
+            tokens = rng.randint(0, 3, rng.randint(0, 30)).tolist()
+            prefix = rng.randint(0, 3, rng.randint(1, 3)).tolist()
+            suffix = rng.randint(0, 3, rng.randint(1, 3)).tolist()
+            start_index, end_index = sorted(rng.randint(0, 32, 2))
+            self._test_regions(tokens, prefix, suffix, start_index,
+                               end_index)
@@ -6,8 +6,11 @@ import copy
 import json
 from unittest import TestCase
 
+from scrapely import htmlpage
 from scrapely.htmlpage import (
-    parse_html, HtmlTag, HtmlDataFragment, HtmlPage, url_to_page
+    parse_html, HtmlTag, HtmlDataFragment, HtmlPage, url_to_page,
+    HtmlFragmentKind, HtmlTagType, HtmlParser, HtmlParsedBody,
+    parse_attributes, set_attributes_cache
 )
 from .test_htmlpage_data import *
 from . import iter_samples
@@ -157,6 +160,225 @@ class TestParseHtml(TestCase):
         parsed = list(parse_html(u"<p>The text</p><?xml:namespace blabla/><p>is here</p>"))
         self.assertFalse(parsed[3].is_text_content)
 
+    def test_long_attributes(self):
+        """attribute text is kept whole however long it is"""
+        value = u'{"a": [1, 2], "b": "<c>"} ' * 1000
+        parsed = parse_html(u"<div data-x='%s' id=a / >x</div>" % value)
+        self.assertEqual(parsed[0].attributes,
+                         {u'data-x': value, u'id': u'a', u'/': None})
+        self.assertEqual(parsed[1].start, len(value) + 23)
+
+    def test_parse_attributes(self):
+        self.assertEqual(
+            parse_attributes(u' A="1" b= \'2\' c=3/ d e="" a=4 f="g />'),
+            {u'a': u'1', u'b': u'2', u'c': u'3/', u'd': None, u'e': None,
+             u'f': u'"g'})
+
+    def test_attributes_cache(self):
+        """tags with the same attribute text share their attributes"""
+        parsed = parse_html(u'<p class="x">a</p><p class="x">b</p>')
+        self.assertFalse(parsed[0].attributes is parsed[3].attributes)
+        set_attributes_cache(10)
+        try:
+            parsed = parse_html(u'<p class="x">a</p><p class="x">b</p>')
+            attributes = parsed[0].attributes
+            self.assertEqual(attributes, {u'class': u'x'})
+            self.assertTrue(parsed[3].attributes is attributes)
+            self.assertRaises(TypeError, attributes.pop, u'class')
+            self.assertTrue(copy.deepcopy(attributes) is attributes)
+        finally:
+            set_attributes_cache(0)
+
+    def test_parsed_body_columns(self):
+        """parse_html stores the fragments by columns"""
+        parsed = parse_html(u'<p class="a">text<!-- c --><br/></p>')
+        self.assertEqual(len(parsed), 5)
+        self.assertEqual(list(parsed.starts), [0, 13, 17, 27, 32])
+        self.assertEqual(list(parsed.ends), [13, 17, 27, 32, 36])
+        self.assertEqual(list(parsed.kinds), [
+            HtmlFragmentKind.TAG, HtmlFragmentKind.TEXT, HtmlFragmentKind.DATA,
+            HtmlFragmentKind.TAG, HtmlFragmentKind.TAG])
+        self.assertEqual(list(parsed.tag_types), [
+            HtmlTagType.OPEN_TAG, 0, 0, HtmlTagType.UNPAIRED_TAG,
+            HtmlTagType.CLOSE_TAG])
+        self.assertEqual(parsed.tag_names, [u'p', u'br'])
+        self.assertEqual(list(parsed.tag_ids), [0, -1, -1, 1, 0])
+        self.assertEqual(list(parsed.tag_indexes()), [0, 3, 4])
+
+    def test_parsed_body_fragments(self):
+        """fragments are created lazily and reused"""
+        parsed = parse_html(u'<p class="a">text<!-- c --><br/></p>')
+        tag = parsed[0]
+        self.assertTrue(isinstance(tag, HtmlTag))
+        self.assertEqual(tag.attributes, {u'class': u'a'})
+        self.assertTrue(parsed[0] is tag)
+        self.assertTrue(parsed[-1] is parsed[4])
+        self.assertEqual([f.start for f in parsed[3::-2]], [27, 13])
+        self.assertTrue(parsed[1].is_text_content is True)
+        self.assertTrue(parsed[2].is_text_content is False)
+        self.assertEqual(parsed.index(parsed[3]), 3)
+        self.assertRaises(ValueError, parsed.index, HtmlTag(1, u'br', u'', 27, 32))
+        self.assertRaises(IndexError, parsed.__getitem__, 5)
+
+    def test_parsed_body_pairs(self):
+        """open and close tags are paired, also in malformed html"""
+        parsed = parse_html(u'</i><div><p>a<p>b</p><br></div><b>c</div>')
+        self.assertEqual(list(parsed.matches),
+                         [-1, 8, -1, -1, 6, -1, 4, -1, 1, -1, -1, -1])
+        self.assertEqual(list(parsed.depths),
+                         [0, 0, 1, 1, 1, 2, 1, 1, 0, 0, 0, 0])
+        self.assertTrue(copy.deepcopy(parsed).matches is parsed.matches)
+
+    def test_parsed_body_tag_tokens(self):
+        """tag tokens are created once per distinct tag, in page order"""
+        calls = []
+
+        def tokenid(tag, tag_type):
+            calls.append((tag, tag_type))
+            return len(calls) * 10
+        parsed = parse_html(u'<p>a<br/><i>b</i></p><p>c</p>')
+        tokens, indexes = parsed.tag_tokens(tokenid)
+        self.assertEqual(calls, [(u'p', 1), (u'br', 3), (u'i', 1), (u'i', 2),
+                                 (u'p', 2)])
+        self.assertEqual(list(tokens), [10, 20, 30, 40, 50, 10, 50])
+        self.assertEqual(list(indexes), [0, 2, 3, 5, 6, 7, 9])
+
+    def test_incremental_parse(self):
+        """parsing in chunks gives the same result as parsing at once"""
+        for source in (PAGE, PAGE2, PAGE3, PAGE4, PAGE8, PAGE9):
+            for size in (1, 3, 16):
+                parser = HtmlParser()
+                completed = 0
+                for i in range(0, len(source), size):
+                    count = parser.feed(source[i:i + size])
+                    self.assertTrue(count >= completed)
+                    completed = count
+                parsed = HtmlParsedBody(*parser.close())
+                self.assertTrue(len(parsed) >= completed)
+                self.assertEqual([_encode_element(e) for e in parsed],
+                                 [_encode_element(e) for e in parse_html(source)])
+
+    def test_page_from_chunks(self):
+        chunks = [PAGE[i:i + 100] for i in range(0, len(PAGE), 100)]
+        page = HtmlPage.from_chunks(iter(chunks), url='http://www.example.com')
+        self.assertEqual(page.body, PAGE)
+        self.assertEqual([_encode_element(e) for e in page.parsed_body],
+                         [_encode_element(e) for e in parse_html(PAGE)])
+
+    def test_lazy_parsing(self):
+        """the body is parsed on first access and again after changing it"""
+        page = HtmlPage(body=u'<p>text</p>')
+        self.assertTrue(page._parsed_body is None)
+        parsed = page.parsed_body
+        self.assertEqual(parsed[0].tag, u'p')
+        self.assertTrue(page.parsed_body is parsed)
+        page.body = u'<b>text</b>'
+        self.assertTrue(page._parsed_body is None)
+        self.assertEqual(page.parsed_body[0].tag, u'b')
+
+    def test_insert_attributes(self):
+        """inserting attributes parses the body as parsing it again would"""
+        for body, index in [(u'<p>a</p><b>b</b>', 3),
+                            (u'<script>x</script><p>a</p>', 2),
+                            (u'<script>x</script><p>a</p>', 0),
+                            (u'<p>a</p><style>b</style>', 3)]:
+            page = HtmlPage(body=body)
+            page.parsed_body
+            page.insert_attributes(index, u' x')
+            self.assertEqual(
+                [_encode_element(e) for e in page.parsed_body],
+                [_encode_element(e) for e in parse_html(page.body)])
+
+    def test_page_from_bytes(self):
+        """utf-8 pages are parsed on the bytes, only read regions decoded"""
+        body = u'<p title="caf\xe9">\u4e2d\u6587 text</p><b\xe9b>\xa0x</b\xe9b>'
+        page = HtmlPage.from_bytes(body.encode('utf-8'), 'utf-8')
+        text_page = HtmlPage(body=body)
+        self.assertEqual(page._body is None, htmlpage._PARSE_BYTES)
+        self.assertEqual(page.parsed_body[0].attributes, {u'title': u'caf\xe9'})
+        self.assertEqual(page.parsed_body[1].start, 16)
+        self.assertEqual(page.parsed_body[3].tag, u'b\xe9b')
+        self.assertEqual(
+            [_encode_element(e) for e in page.parsed_body],
+            [_encode_element(e) for e in text_page.parsed_body])
+        self.assertEqual(
+            [page.fragment_data(f) for f in page.parsed_body],
+            [text_page.fragment_data(f) for f in text_page.parsed_body])
+        self.assertEqual(page.body_slice(17, 23), body[17:23])
+        self.assertEqual(page.subregion(1, 3), text_page.subregion(1, 3))
+        self.assertEqual(page.subregion().text_content,
+                         text_page.subregion().text_content)
+        self.assertEqual(page._body is None, htmlpage._PARSE_BYTES)
+        # the body is decoded once, its offsets are those of the fragments
+        self.assertEqual(page.body, body)
+        self.assertTrue(page.body is page.body)
+        self.assertEqual([page.body[f.start:f.end] for f in page.parsed_body],
+                         [page.fragment_data(f) for f in page.parsed_body])
+
+    def test_page_from_bytes_offsets(self):
+        """character offsets of pages with invalid utf-8 or a byte order
+        mark"""
+        data = b'<p>\xff\xe4\xb8text</p><b>\xe4\xb8\xad</b>'
+        page = HtmlPage.from_bytes(data, 'utf-8')
+        text_page = HtmlPage(body=data.decode('utf-8', 'replace'))
+        self.assertEqual(
+            [_encode_element(e) for e in page.parsed_body],
+            [_encode_element(e) for e in text_page.parsed_body])
+        self.assertEqual(
+            [page.fragment_data(f) for f in page.parsed_body],
+            [text_page.fragment_data(f) for f in text_page.parsed_body])
+        page = HtmlPage.from_bytes(b'\xef\xbb\xbf<p>\xc3\xa9</p>', 'utf-8-sig')
+        self.assertEqual(page._body, u'<p>\xe9</p>')
+        self.assertEqual(page.parsed_body[1].start, 3)
+
+    def test_raw_whitespace(self):
+        """whitespace outside ASCII separates markup in bytes as in text"""
+        body = u'<p\xa0class="x"\u3000id=y>t</p\xa0>'
+        expected = [_encode_element(e) for e in parse_html(body)]
+        page = HtmlPage.from_bytes(body.encode('utf-8'), 'utf-8')
+        self.assertEqual([_encode_element(e) for e in page.parsed_body],
+                         expected)
+        self.assertEqual(page.parsed_body[0].attributes,
+                         {u'class': u'x', u'id': u'y'})
+        data = body.encode('utf-8')
+        for split in range(1, len(data)):
+            parser = HtmlParser('utf-8')
+            parser.feed(data[:split])
+            parser.feed(data[split:])
+            parsed = HtmlParsedBody(*parser.close())
+            self.assertEqual([(e.tag, e.attributes) for e in parsed
+                              if isinstance(e, HtmlTag)],
+                             [(u'p', {u'class': u'x', u'id': u'y'}),
+                              (u'p', {})])
+
+    def test_page_from_bytes_tag_names(self):
+        """pages from bytes with non-ASCII tag names have the fragments of
+        pages from text, also decoded without the compiled parser"""
+        bodies = [u'<div\U0001f600data-x=1>a</div>', u'a <\U0001f600 b',
+                  u'<p\u2030x>', u'<di\xe9v id=\u4e2d>']
+        parse_bytes = htmlpage._PARSE_BYTES
+        try:
+            for parse in (parse_bytes, False):
+                htmlpage._PARSE_BYTES = parse
+                for body in bodies:
+                    page = HtmlPage.from_bytes(body.encode('utf-8'), 'utf-8')
+                    self.assertEqual(page._body is None, parse)
+                    self.assertEqual(
+                        [_encode_element(e) for e in page.parsed_body],
+                        [_encode_element(e) for e in parse_html(body)])
+        finally:
+            htmlpage._PARSE_BYTES = parse_bytes
+
+    def test_page_from_bytes_decoded(self):
+        """pages in encodings that are not ASCII compatible are decoded"""
+        body = u'<p>\u4e2d\u6587</p>'
+        page = HtmlPage.from_bytes(body.encode('utf-16'), 'utf-16')
+        self.assertEqual(page._body, body)
+        self.assertEqual(page.fragment_data(page.parsed_body[1]),
+                         u'\u4e2d\u6587')
+        page = HtmlPage.from_bytes(body.encode('iso-2022-jp'), 'iso-2022-jp')
+        self.assertEqual(page._body, body)
+
     def test_copy(self):
         """Test copy/deepcopy"""
         page = HtmlPage(url='http://www.example.com', body=PAGE)
@@ -174,6 +396,26 @@ class TestParseHtml(TestCase):
         self.assertFalse(region is regiondeepcopy)
         self.assertFalse(region.htmlpage is regiondeepcopy.htmlpage)
 
+    def test_copy_shares_body(self):
+        """copies share the parsed body until the body of one changes"""
+        page = HtmlPage(body=PAGE)
+        pagecopy = copy.copy(page)
+        parsed = pagecopy.parsed_body
+        self.assertTrue(page._parsed_body is parsed)
+        self.assertTrue(page.parsed_body is parsed)
+        pagecopy.body = u'<b>text</b>'
+        self.assertTrue(page.parsed_body is parsed)
+        self.assertEqual(page.body, PAGE)
+        self.assertEqual(pagecopy.parsed_body[0].tag, u'b')
+
+        deep = copy.deepcopy(page)
+        self.assertFalse(deep.parsed_body is parsed)
+        self.assertTrue(deep.parsed_body.starts.base is parsed.starts.base)
+        self.assertFalse(deep.parsed_body[0] is parsed[0])
+        self.assertEqual(_encode_element(deep.parsed_body[0]),
+                         _encode_element(parsed[0]))
+        self.assertFalse(parsed.starts.flags.writeable)
+
     def test_load_page_from_url(self):
         filepath = os.path.join(BASE_PATH, 'samples/samples_htmlpage_0')
         url = 'file://{}.{}'.format(filepath, 'html')
@@ -182,3 +424,12 @@ class TestParseHtml(TestCase):
         parsed = [_decode_element(d) for d in parsed]
         self.assertEqual(page.url, url)
         self._test_sample(page.body, parsed, 1)
+
+    def test_load_page_from_url_with_encoding(self):
+        filepath = os.path.join(BASE_PATH, 'samples/samples_htmlpage_0')
+        url = 'file://{}.{}'.format(filepath, 'html')
+        page = url_to_page(url, encoding='utf-8')
+        parsed = json.load(open('{}.{}'.format(filepath, 'json')))
+        parsed = [_decode_element(d) for d in parsed]
+        self.assertEqual(page.encoding, 'utf-8')
+        self._test_sample(page.body, parsed, 1)
@@ -247,6 +247,7 @@ class TestPageParsing(TestCase):
         epp = _parse_page(ExtractionPageParser, SIMPLE_PAGE)
         ep = epp.to_extraction_page()
         self.assertEqual(len(ep.page_tokens), 4)
+        self.assertEqual(ep.page_tokens.dtype, TokenDict.dtype)
         self.assertEqual(ep.htmlpage.fragment_data(ep.htmlpage_tag(0)), '<html>')
         self.assertEqual(ep.htmlpage.fragment_data(ep.htmlpage_tag(1)), '<p some-attr="foo">')
 
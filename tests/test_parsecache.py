@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from scrapely.htmlpage import HtmlPage, parse_html, set_parse_cache
+from scrapely.parsecache import ParseCache
+from scrapely.extraction.pageobjects import TokenDict
+from scrapely.extraction.pageparsing import parse_extraction_page
+
+from .test_htmlpage_data import PAGE, PAGE2
+
+
+def _columns(parsed):
+    return [parsed.starts.tolist(), parsed.ends.tolist(),
+            parsed.kinds.tolist(), parsed.tag_types.tolist(),
+            parsed.tag_ids.tolist(), list(parsed.tag_names),
+            list(parsed.attr_texts)]
+
+
+class ParseCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_parse(self):
+        cache = ParseCache(self.directory)
+        parsed = cache.parse(PAGE)
+        self.assertEqual(_columns(parsed), _columns(parse_html(PAGE)))
+        self.assertEqual(len(self._files()), 1)
+        loaded = cache.parse(PAGE)
+        self.assertFalse(loaded is parsed)
+        self.assertEqual(_columns(loaded), _columns(parsed))
+        self.assertEqual([f.attributes for f in loaded if hasattr(f, 'tag')],
+                         [f.attributes for f in parsed if hasattr(f, 'tag')])
+        self.assertEqual(len(self._files()), 1)
+
+    def test_bytes(self):
+        cache = ParseCache(self.directory)
+        body = PAGE.encode('utf-8')
+        cache.parse(body, 'utf-8')
+        self.assertEqual(_columns(cache.parse(body, 'utf-8')),
+                         _columns(parse_html(body, 'utf-8')))
+        cache.parse(PAGE)
+        self.assertEqual(len(self._files()), 2)
+
+    def test_corrupted_entry(self):
+        cache = ParseCache(self.directory)
+        cache.parse(PAGE)
+        path = os.path.join(self.directory, self._files()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(100)
+        self.assertEqual(_columns(cache.parse(PAGE)),
+                         _columns(parse_html(PAGE)))
+
+    def test_eviction(self):
+        cache = ParseCache(self.directory)
+        cache.parse(PAGE)
+        path = os.path.join(self.directory, self._files()[0])
+        os.utime(path, (0, 0))
+        size = os.path.getsize(path)
+        cache = ParseCache(self.directory, max_size=size + 1)
+        cache.parse(PAGE2)
+        self.assertEqual(self._files(), [cache.key(PAGE2) + cache.suffix])
+        cache.clear()
+        self.assertEqual(self._files(), [])
+
+    def test_overwritten_entry(self):
+        cache = ParseCache(self.directory)
+        cache.parse(PAGE)
+        path = os.path.join(self.directory, self._files()[0])
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(100)
+        cache = ParseCache(self.directory)
+        # the corrupted entry is replaced and only counted once
+        cache.parse(PAGE)
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(cache._size, size)
+
+    def test_page(self):
+        cache = ParseCache(self.directory)
+        set_parse_cache(cache)
+        try:
+            page = HtmlPage(body=PAGE)
+            self.assertEqual(_columns(page.parsed_body),
+                             _columns(parse_html(PAGE)))
+            self.assertEqual(self._files(), [cache.key(PAGE) + cache.suffix])
+        finally:
+            set_parse_cache(None)
+
+    def test_tag_tokens(self):
+        cache = ParseCache(self.directory)
+        token_dict = TokenDict()
+        page = parse_extraction_page(token_dict, HtmlPage(body=PAGE), cache)
+        version = token_dict.version
+        self.assertEqual(len(self._files()), 1)
+        token_dict = TokenDict(token_dict.tokens())
+        token_dict.freeze()
+        loaded = parse_extraction_page(token_dict, HtmlPage(body=PAGE), cache)
+        self.assertEqual(loaded.page_tokens.tolist(), page.page_tokens.tolist())
+        self.assertEqual(loaded.token_page_indexes.tolist(),
+                         page.token_page_indexes.tolist())
+        self.assertEqual(self._files(),
+                         [cache.key(PAGE, None, version) + cache.suffix])
+        # new tokens are stored for the version that has them
+        tokens, _ = cache.tag_tokens(PAGE, TokenDict())
+        self.assertEqual(tokens.tolist(), page.page_tokens.tolist())
+        self.assertEqual(self._files(), sorted(
+            [cache.key(PAGE) + cache.suffix,
+             cache.key(PAGE, None, version) + cache.suffix]))
@@ -35,3 +35,24 @@ class ScraperTest(TestCase):
         sc = Scraper.fromfile(f)
         extracted_data = sc.scrape_page(page2)
         self._assert_extracted(extracted_data, data2)
+
+    def test_stored_tokens(self):
+        """stored scrapers keep the token ids"""
+        [(html1, data1), (html2, data2)] = list(iter_samples(
+            'scraper_loadstore', html_encoding='latin1'))
+        sc = Scraper()
+        sc.train_from_htmlpage(HtmlPage(body=html1, encoding='latin1'), data1)
+        f = StringIO()
+        # storing the scraper does not tokenize its templates
+        sc.tofile(f)
+        self.assertEqual(sc.token_dict.token_ids, {})
+        self.assertNotIn('tokens', f.getvalue())
+        page = sc.tokenize(HtmlPage(body=html2, encoding='latin1'))
+        f = StringIO()
+        sc.tofile(f)
+        f.seek(0)
+        loaded = Scraper.fromfile(f)
+        self.assertEqual(loaded.token_dict.token_ids, sc.token_dict.token_ids)
+        self.assertEqual(loaded.token_dict.version, sc.token_dict.version)
+        extracted_data = loaded.scrape_page(page)
+        self._assert_extracted(extracted_data, data2)
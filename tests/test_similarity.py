@@ -0,0 +1,220 @@
+"""
+Unit tests for similarity
+"""
+from unittest import TestCase, skipIf
+
+import numpy as np
+
+from scrapely.extraction import _pysimilarity
+from scrapely.extraction.pageobjects import PageRegion
+from scrapely.extraction.similarity import (
+    similar_region, first_longest_subsequence, MatchPolicy, set_match_policy,
+    TokenContext, TokenIndex)
+
+try:
+    from scrapely.extraction import _similarity
+except ImportError:
+    _similarity = None
+
+# (sequence, pattern) searched, as token arrays and as strings
+SEARCHES = [
+    (np.array([6, 3, 2, 4, 3, 2, 5], dtype=np.int32), np.array([2, 4, 3])),
+    (np.array([6, 3, 2, 4, 3, 2, 5], dtype=np.int32), np.array([3, 2])),
+    (np.array([1, 2, 1, 2, 1, 2, 3]), np.array([1, 2, 3])),
+    (np.array([1, 2, 3], dtype=np.uint16), np.array([7, 8])),
+    (np.array([], dtype=np.int32), np.array([1, 2])),
+    (np.array([1, 2, 3], dtype=np.int32), np.array([], dtype=np.int32)),
+    (u'abcabd', u'abd'),
+    (u'abcab', u'ab'),
+    (u'abc', u'xy'),
+    (u'', u'ab'),
+    (u'abc', u''),
+]
+
+
+class TestSimilarRegion(TestCase):
+
+    def test_max_context_length_ties(self):
+        """regions are found as without the limit when several candidates
+        match the whole limited context"""
+        template = np.array([8, 1, 2, 3, 4, 20, 21, 5, 6, 7, 9])
+        region = PageRegion(4, 7)
+        # both prefixes end with 1, 2, 3, 4, only the second one has the 8
+        # before them
+        tokens = np.array([0, 1, 2, 3, 4, 30, 5, 6, 7, 0,
+                           8, 1, 2, 3, 4, 31, 5, 6, 7, 9, 0])
+        for kwargs in [{}, {'best_match': first_longest_subsequence},
+                       {'token_index': TokenIndex(tokens)}]:
+            self.assertEqual(similar_region(tokens, template, region,
+                                            **kwargs), (9, 14, 16))
+            for max_context_length in (1, 2, 3, 4, 8):
+                score, start, end = similar_region(
+                    tokens, template, region,
+                    max_context_length=max_context_length, **kwargs)
+                self.assertEqual((start, end), (14, 16))
+                self.assertTrue(score <= 9)
+
+
+def _matches(sequence, pattern, start, end):
+    """(index, length) of the matches of pattern starting in [start, end),
+    comparing every item"""
+    matches = []
+    for index in range(max(start, 0), min(end, len(sequence))):
+        length = 0
+        while (length < len(pattern) and index + length < len(sequence) and
+               sequence[index + length] == pattern[length]):
+            length += 1
+        if length:
+            matches.append((index, length))
+    return matches
+
+
+def _unique_longest(matches):
+    longest = max([length for _, length in matches] or [None])
+    best = [match for match in matches if match[1] == longest]
+    return best[0] if len(best) == 1 else (None, None)
+
+
+def _first_longest(matches):
+    longest = max([length for _, length in matches] or [None])
+    best = [match for match in matches if match[1] == longest]
+    return best[0] if best else (None, None)
+
+
+class TestPureMatching(TestCase):
+    """the pure Python matching functions give the results of comparing
+    every item, and those of the compiled ones"""
+
+    modules = [_pysimilarity] + ([_similarity] if _similarity else [])
+
+    def test_longest_match(self):
+        for sequence, pattern in SEARCHES:
+            for start, end in [(0, len(sequence)), (1, 4), (3, 2)]:
+                matches = _matches(sequence, pattern, start, end)
+                for module in self.modules:
+                    self.assertEqual(
+                        module.naive_match_length(sequence, pattern, start,
+                                                  end), matches)
+                    self.assertEqual(
+                        module.unique_longest_match(sequence, pattern, start,
+                                                    end),
+                        _unique_longest(matches))
+                    self.assertEqual(
+                        module.first_longest_match(sequence, pattern, start,
+                                                   end),
+                        _first_longest(matches))
+
+    def test_match_at(self):
+        for sequence, pattern in SEARCHES:
+            matches = _matches(sequence, pattern, 0, len(sequence))
+            starts = np.array([index for index, _ in matches], dtype=np.intp)
+            for module in self.modules:
+                self.assertEqual(
+                    module.match_lengths(sequence, pattern, starts), matches)
+                self.assertEqual(
+                    module.unique_longest_match_at(sequence, pattern, starts),
+                    _unique_longest(matches))
+                self.assertEqual(
+                    module.first_longest_match_at(sequence, pattern, starts),
+                    _first_longest(matches))
+
+    @skipIf(_similarity is None, 'the compiled matching is not available')
+    def test_random_tokens(self):
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            sequence = rng.randint(0, 3, rng.randint(0, 40)).astype(np.int32)
+            pattern = rng.randint(0, 3, rng.randint(1, 8))
+            start, end = sorted(rng.randint(0, 45, 2))
+            for name in ('naive_match_length', 'unique_longest_match',
+                         'first_longest_match'):
+                self.assertEqual(
+                    getattr(_pysimilarity, name)(sequence, pattern, start, end),
+                    getattr(_similarity, name)(sequence, pattern, start, end))
+
+
+class TestOccurrenceMatching(TestCase):
+    """matching at the occurrences of the first token of the pattern finds
+    the matches of comparing at every index of the range"""
+
+    def setUp(self):
+        # always match from the occurrences
+        set_match_policy(MatchPolicy(kmp_pattern_length=2 ** 31,
+                                     index_range_length=0))
+
+    def tearDown(self):
+        set_match_policy(MatchPolicy())
+
+    def _test_matches(self, sequence, pattern, start, end):
+        matches = _matches(sequence, pattern, start, end)
+        for context in (TokenContext(sequence), TokenIndex(sequence)):
+            self.assertEqual(
+                context.longest_unique_subsequence(pattern, start, end),
+                _unique_longest(matches))
+            self.assertEqual(
+                context.first_longest_subsequence(pattern, start, end),
+                _first_longest(matches))
+
+    def test_repeated_best_match(self):
+        sequence = np.array([1, 2, 3, 9, 1, 2, 3, 1, 2, 4, 1, 2, 3],
+                            dtype=np.int32)
+        # the longest match is at 0, 4 and 10, and unique after 5
+        for start, end in [(0, 13), (1, 13), (5, 13), (5, 10), (0, 1)]:
+            self._test_matches(sequence, np.array([1, 2, 3]), start, end)
+        self._test_matches(sequence, np.array([1, 2, 4, 1]), 0, 13)
+
+    def test_random_tokens(self):
+        rng = np.random.RandomState(1)
+        for _ in range(200):
+            sequence = rng.randint(0, 3, rng.randint(1, 40)).astype(np.int32)
+            pattern = rng.randint(0, 3, rng.randint(1, 8))
+            start, end = sorted(rng.randint(0, 45, 2))
+            self._test_matches(sequence, pattern, start, end)
+
+
+@skipIf(_similarity is None, 'the compiled matching is not available')
+class TestEarlyExit(TestCase):
+    """the compiled search stops once the best match and the runner-up
+    decide the result, which is the one of checking every match"""
+
+    # the runner-up ties the best match, early or at the end of the
+    # sequence, or is shorter
+    CASES = [
+        ([1, 2, 3, 1, 2, 3], [1, 2, 3]),
+        ([1, 2, 3, 1, 2], [1, 2, 3]),
+        ([1, 2, 9, 1, 2, 3, 1, 2, 3, 1], [1, 2, 3]),
+        ([1, 2, 1, 2, 3, 1, 2], [1, 2, 3]),
+        ([5, 1, 2, 1, 2], [1, 2, 3]),
+        ([1, 2, 1], [1, 2]),
+        ([1, 1, 1, 1], [1, 1]),
+    ]
+
+    def _test_search(self, sequence, pattern, start, end):
+        matches = _matches(sequence, pattern, start, end)
+        starts = np.array([index for index, _ in matches], dtype=np.intp)
+        for kmp in (False, True):
+            self.assertEqual(
+                _similarity.unique_longest_match(sequence, pattern, start,
+                                                 end, kmp),
+                _unique_longest(matches))
+            self.assertEqual(
+                _similarity.first_longest_match(sequence, pattern, start,
+                                                end, kmp),
+                _first_longest(matches))
+        self.assertEqual(
+            _similarity.unique_longest_match_at(sequence, pattern, starts),
+            _unique_longest(matches))
+
+    def test_runner_up(self):
+        for sequence, pattern in self.CASES:
+            sequence = np.array(sequence, dtype=np.int32)
+            for start in range(len(sequence)):
+                self._test_search(sequence, np.array(pattern), start,
+                                  len(sequence))
+
+    def test_random_tokens(self):
+        rng = np.random.RandomState(2)
+        for _ in range(300):
+            sequence = rng.randint(0, 2, rng.randint(1, 30)).astype(np.int32)
+            pattern = rng.randint(0, 2, rng.randint(1, 6))
+            start, end = sorted(rng.randint(0, 32, 2))
+            self._test_search(sequence, pattern, start, end)
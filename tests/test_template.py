@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from scrapely.htmlpage import HtmlPage
+from scrapely.htmlpage import HtmlPage, TextPage, parse_html
 from scrapely.template import TemplateMaker, FragmentNotFound, \
     FragmentAlreadyAnnotated, best_match
 from scrapely.extraction import InstanceBasedLearningExtractor
@@ -44,6 +44,20 @@ class TemplateMakerTest(TestCase):
         self.assertEqual(ex.extract(self.PAGE)[0],
             [{u'field1': [u"More text with unpaired tag <img />and that's it"]}])
 
+    def test_annotate_parsed_body(self):
+        """annotating updates the parsed body as parsing the new body would"""
+        tm = TemplateMaker(self.PAGE)
+        tm.annotate('field1', best_match('text to annotate'), best_match=False)
+        tm.annotate('field2', best_match('Some title'))
+        tpl = tm.get_template()
+        self.assertFalse(tpl.parsed_body is self.PAGE.parsed_body)
+        expected = parse_html(tpl.body)
+        self.assertEqual(
+            [(f.start, f.end, getattr(f, 'attributes', None))
+             for f in tpl.parsed_body],
+            [(f.start, f.end, getattr(f, 'attributes', None))
+             for f in expected])
+
     def test_annotate_fragment_not_found(self):
         tm = TemplateMaker(self.PAGE)
         self.assertRaises(FragmentNotFound, tm.annotate, 'field1', best_match("missing text"))
@@ -61,6 +75,19 @@ class TemplateMakerTest(TestCase):
             [u'<p>Some text to annotate here</p>', \
             u'<p>Another text to annotate there</p>'])
 
+    def test_selected_data_fragment_list(self):
+        """parsed bodies given as lists of fragments are walked"""
+        page = HtmlPage(self.PAGE.url, body=self.PAGE.body)
+        page.parsed_body = list(page.parsed_body)
+        tm = TemplateMaker(page)
+        indexes = tm.select(best_match('text to annotate'))
+        self.assertEqual([tm.selected_data(i) for i in indexes],
+                         [TemplateMaker(self.PAGE).selected_data(i)
+                          for i in indexes])
+        text_page = TextPage(body=u'Some text')
+        self.assertRaises(FragmentNotFound,
+                          TemplateMaker(text_page).selected_data, 0)
+
     def test_annotations(self):
         tm = TemplateMaker(self.PAGE)
         tm.annotate('field1', best_match('text to annotate'), best_match=False)